@@ -1,15 +1,17 @@
 """Renders admin pages for ops and other management tasks.
 
-Currently just /admin/responses, which shows active responses with tasks that
-haven't completed yet.
+Includes /admin/responses, which shows active responses with tasks that haven't
+completed yet, /admin/sources, which shows sources whose last poll failed, and
+/admin/poll_stats, which shows where recent polls spent their time.
 """
+import collections
 import datetime
 import itertools
 import json
 
 import appengine_config
 from oauth_dropins.webutil import handlers
-from models import BlogPost, Response, Source
+from models import BlogPost, PollStats, Response, Source
 import util
 
 from google.appengine.ext import ndb
@@ -78,6 +80,34 @@ class SourcesHandler(handlers.TemplateHandler):
     }
 
 
+class PollStatsHandler(handlers.TemplateHandler):
+  """Shows the sources whose recent polls took the longest, and why."""
+  NUM_SOURCES = 50
+
+  def template_file(self):
+    return 'admin_poll_stats.html'
+
+  def template_vars(self):
+    stats = PollStats.query().order(-PollStats.updated).fetch(self.NUM_SOURCES)
+    sources = ndb.get_multi(s.source for s in stats)
+
+    rows = []
+    phases = collections.defaultdict(float)
+    for stat, source in zip(stats, sources):
+      if source:
+        averages = stat.averages()
+        rows.append((source, averages))
+        for name, ms in averages['phases'].items():
+          phases[name] += ms
+
+    rows.sort(key=lambda row: row[1]['total_ms'], reverse=True)
+    return {
+      'rows': rows,
+      'phase_names': sorted(phases.keys()),
+      'phase_totals': sorted(phases.items(), key=lambda p: p[1], reverse=True),
+    }
+
+
 class MarkCompleteHandler(util.Handler):
 
   def post(self):
@@ -92,5 +122,6 @@ class MarkCompleteHandler(util.Handler):
 application = webapp2.WSGIApplication([
     ('/admin/responses', ResponsesHandler),
     ('/admin/sources', SourcesHandler),
+    ('/admin/poll_stats', PollStatsHandler),
     ('/admin/mark_complete', MarkCompleteHandler),
     ], debug=appengine_config.DEBUG)
@@ -7,6 +7,7 @@ import logging
 import math
 import string
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 import appengine_config
 
@@ -21,20 +22,93 @@ import webapp2
 TWITTER_API_USER_LOOKUP = 'users/lookup.json?screen_name=%s'
 TWITTER_USERS_PER_LOOKUP = 100  # max # of users per API call
 
+# DispatchPolls adds poll tasks in batches of this many, spaced out by this
+# much, up to this many batches per run. due sources beyond that wait for the
+# next run.
+POLL_DISPATCH_BATCH_SIZE = 100
+POLL_DISPATCH_BATCH_SPACING = datetime.timedelta(seconds=10)
+POLL_DISPATCH_MAX_BATCHES = 6
+
 
 class ReplacePollTasks(webapp2.RequestHandler):
-  """Finds sources missing their poll tasks and adds new ones."""
+  """Finds sources missing their poll tasks and adds new ones.
+
+  Skips sources that :class:`DispatchPolls` handles, ie sources of types with
+  USE_POLL_SCHEDULER that have a next_poll_at. Sources stored before next_poll_at
+  existed don't have it in the index, so :class:`DispatchPolls` can't find
+  them, and this is their fallback until they're polled once.
+  """
 
   def get(self):
     now = datetime.datetime.now()
     queries = [cls.query(Source.features == 'listen', Source.status == 'enabled')
                for cls in models.sources.values()]
-    for source in itertools.chain(*queries):
-      age = now - source.last_poll_attempt
-      if age > max(source.poll_period() * 2, datetime.timedelta(hours=2)):
-        logging.info('%s last polled %s ago. Adding new poll task.',
-                     source.bridgy_url(self), age)
-        util.add_poll_task(source)
+    with util.batch_tasks():
+      for source in itertools.chain(*queries):
+        if source.USE_POLL_SCHEDULER and source.next_poll_at:
+          continue
+        age = now - source.last_poll_attempt
+        if age > max(source.poll_period() * 2, datetime.timedelta(hours=2)):
+          logging.info('%s last polled %s ago. Adding new poll task.',
+                       source.bridgy_url(self), age)
+          util.add_poll_task(source)
+
+
+class DispatchPolls(webapp2.RequestHandler):
+  """Adds poll tasks for sources that are due, ie whose next_poll_at has passed.
+
+  Only for source types with USE_POLL_SCHEDULER set. Sources with no
+  next_poll_at, e.g. whose polls never finished, are due too. Uses a memcache
+  marker per source to avoid adding another task for a source while its task is
+  still queued. :class:`tasks.Poll` deletes the marker when it finishes or drops
+  the task, and it expires after POLL_LEASE otherwise. Duplicates that slip
+  through are dropped by :class:`tasks.Poll`.
+  """
+
+  def get(self):
+    now = util.now_fn()
+    batches = 0
+    for cls in models.sources.values():
+      if not cls.USE_POLL_SCHEDULER:
+        continue
+
+      for due in Source.next_poll_at <= now, Source.next_poll_at == None:
+        batches = self.dispatch(
+          cls, cls.query(Source.features == 'listen',
+                         Source.status == 'enabled', due),
+          batches)
+
+    logging.info('Dispatched %d batches of poll tasks', batches)
+
+  @staticmethod
+  def dispatch(cls, query, batches):
+    """Adds poll tasks for the sources in a query, in batches.
+
+    Args:
+      cls: :class:`models.Source` subclass
+      query: :class:`ndb.Query` for cls
+      batches: integer, number of batches already dispatched in this run
+
+    Returns:
+      integer, number of batches dispatched in this run, including this query's
+    """
+    cursor = None
+    more = True
+    while more and batches < POLL_DISPATCH_MAX_BATCHES:
+      keys, cursor, more = query.fetch_page(
+        POLL_DISPATCH_BATCH_SIZE, keys_only=True, start_cursor=cursor)
+      markers = {util.poll_dispatch_marker(key): True for key in keys}
+      not_added = set(memcache.add_multi(
+        markers, time=int(cls.POLL_LEASE.total_seconds())))
+
+      countdown = (POLL_DISPATCH_BATCH_SPACING * batches).total_seconds()
+      with util.batch_tasks():
+        for key in keys:
+          if util.poll_dispatch_marker(key) not in not_added:
+            util.add_scheduled_poll_task(key, countdown=countdown)
+      batches += 1
+
+    return batches
 
 
 class UpdateTwitterPictures(webapp2.RequestHandler):
@@ -146,6 +220,7 @@ def maybe_update_picture(source, new_actor, handler):
 
 application = webapp2.WSGIApplication([
     ('/cron/replace_poll_tasks', ReplacePollTasks),
+    ('/cron/dispatch_polls', DispatchPolls),
     ('/cron/update_twitter_pictures', UpdateTwitterPictures),
     ('/cron/update_instagram_pictures', UpdateInstagramPictures),
     ('/cron/update_flickr_pictures', UpdateFlickrPictures),
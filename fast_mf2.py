@@ -0,0 +1,240 @@
+"""Fast, partial microformats2 parser for original post discovery.
+
+Original post discovery only needs a few things from each page: h-entry and
+h-feed structure, u-url, u-syndication, dt-published, dt-updated, and rel
+links like rel=syndication and rel=feed. This extracts just those in a single
+streaming pass with :class:`HTMLParser.HTMLParser`, without building a
+BeautifulSoup tree or running the full mf2py parser.
+
+:func:`parse()` returns the same structure that :func:`mf2py.parse` would for
+those parts, and nothing else. When the markup needs parsing rules this
+doesn't implement, e.g. implied u-url from a child element, value-class
+pattern, or microformats1 backward compatibility, it returns None and the
+caller should fall back to the full parser.
+"""
+import HTMLParser
+import logging
+import re
+import urlparse
+
+# the properties we extract, and nothing else
+PROPERTIES = frozenset(('u-url', 'u-syndication', 'dt-published', 'dt-updated'))
+
+# microformats1 root classes that mf2py converts to h-entry and h-feed
+MF1_ROOTS = frozenset(('hentry', 'hfeed'))
+
+ROOT_RE = re.compile(r'^h-([a-z0-9]+-)?[a-z]+(-[a-z]+)*$')
+PROPERTY_RE = re.compile(r'^(p|u|dt|e)-([a-z0-9]+-)?[a-z]+(-[a-z]+)*$')
+
+# tags that never have an end tag
+VOID_TAGS = frozenset((
+  'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'keygen', 'link',
+  'meta', 'param', 'source', 'track', 'wbr'))
+
+# HTML parsers implicitly close these tags when they see certain other tags
+BLOCK_TAGS = frozenset((
+  'address', 'article', 'aside', 'blockquote', 'details', 'div', 'dl',
+  'fieldset', 'figcaption', 'figure', 'footer', 'form', 'h1', 'h2', 'h3', 'h4',
+  'h5', 'h6', 'header', 'hr', 'main', 'menu', 'nav', 'ol', 'p', 'pre',
+  'section', 'table', 'ul'))
+CLOSED_BY = {
+  'p': BLOCK_TAGS,
+  'li': frozenset(('li',)),
+  'dt': frozenset(('dt', 'dd')),
+  'dd': frozenset(('dt', 'dd')),
+  'option': frozenset(('option',)),
+  'tr': frozenset(('tr',)),
+  'td': frozenset(('td', 'th', 'tr')),
+  'th': frozenset(('td', 'th', 'tr')),
+}
+
+# where u-* and dt-* property values come from, by tag
+URL_ATTRS = {
+  'a': 'href',
+  'area': 'href',
+  'link': 'href',
+  'img': 'src',
+  'audio': 'src',
+  'video': 'src',
+  'source': 'src',
+  'object': 'data',
+}
+DATETIME_ATTRS = {
+  'time': 'datetime',
+  'ins': 'datetime',
+  'del': 'datetime',
+  'abbr': 'title',
+  'data': 'value',
+  'input': 'value',
+}
+
+
+class Ambiguous(Exception):
+  """Raised when a page needs the full mf2 parser."""
+  pass
+
+
+class _Element(object):
+  """An open element on the parser's stack."""
+  __slots__ = ('tag', 'item', 'significant')
+
+  def __init__(self, tag, item=None, significant=False):
+    self.tag = tag
+    self.item = item  # mf2 item dict, if this is a root
+    # whether it's a root or has a property we extract
+    self.significant = significant
+
+
+class _Parser(HTMLParser.HTMLParser):
+  """Streaming parser that builds a partial mf2 dict. Raises :class:`Ambiguous`."""
+
+  def __init__(self, url):
+    HTMLParser.HTMLParser.__init__(self)
+    self.base_url = url
+    self.saw_base = False
+    self.stack = []
+    self.roots = []  # open root elements' items, innermost last
+    self.items = []
+    self.rels = {}
+    self.rel_urls = {}
+
+  def handle_starttag(self, tag, attrs):
+    self.start(tag, attrs, void=tag in VOID_TAGS)
+
+  def handle_startendtag(self, tag, attrs):
+    self.start(tag, attrs, void=True)
+
+  def start(self, tag, attrs, void=False):
+    # emulate HTML parsers' implied end tags, e.g. <p> before <div>
+    while self.stack and tag in CLOSED_BY.get(self.stack[-1].tag, ()):
+      self.end(self.stack.pop())
+
+    attrs = dict(attrs)
+    if tag == 'base' and not self.saw_base and attrs.get('href'):
+      self.base_url = urlparse.urljoin(self.base_url, attrs['href'])
+      self.saw_base = True
+
+    rel = attrs.get('rel')
+    if rel and tag in ('a', 'area', 'link') and attrs.get('href') is not None:
+      self.add_rel(rel.split(), attrs)
+
+    classes = (attrs.get('class') or '').split()
+    roots = sorted(set(c for c in classes if ROOT_RE.match(c)))
+    props = [c for c in classes if PROPERTY_RE.match(c)]
+    wanted = [p for p in props if p in PROPERTIES]
+
+    if not roots and MF1_ROOTS.intersection(classes):
+      raise Ambiguous('microformats1 root class %s' % classes)
+
+    element = _Element(tag, significant=bool(roots or wanted))
+    if roots:
+      if wanted:
+        raise Ambiguous('%s is both a root and a %s property' % (roots, wanted))
+      element.item = self.start_item(tag, roots, props, attrs)
+    elif wanted and self.roots:
+      props = self.roots[-1]['properties']
+      for prop in wanted:
+        name = prop.split('-', 1)[1]
+        props.setdefault(name, []).append(self.property_value(tag, prop, attrs))
+
+    if void:
+      self.end(element)
+    else:
+      self.stack.append(element)
+
+  def start_item(self, tag, types, props, attrs):
+    item = {'type': types, 'properties': {}}
+    if props and self.roots:
+      # a property of its parent, not a child. we don't extract it.
+      item['_property'] = True
+    elif self.roots:
+      self.roots[-1].setdefault('children', []).append(item)
+    else:
+      self.items.append(item)
+
+    if 'h-entry' in types and tag in ('a', 'area') and attrs.get('href'):
+      # implied u-url. only used if there's no explicit u-url.
+      item['_implied_url'] = urlparse.urljoin(self.base_url, attrs['href'])
+
+    self.roots.append(item)
+    return item
+
+  def property_value(self, tag, prop, attrs):
+    attr = (URL_ATTRS if prop.startswith('u-') else DATETIME_ATTRS).get(tag)
+    value = attrs.get(attr) if attr else None
+    if value is None:
+      raise Ambiguous('%s on <%s> without %s' % (prop, tag, attr or 'attribute'))
+    return (urlparse.urljoin(self.base_url, value) if prop.startswith('u-')
+            else value)
+
+  def add_rel(self, rels, attrs):
+    url = urlparse.urljoin(self.base_url, attrs['href'])
+    rel_url = self.rel_urls.setdefault(url, {})
+    for rel in rels:
+      urls = self.rels.setdefault(rel, [])
+      if url not in urls:
+        urls.append(url)
+      rel_url_rels = rel_url.setdefault('rels', [])
+      if rel not in rel_url_rels:
+        rel_url_rels.append(rel)
+    for attr in 'media', 'hreflang', 'type', 'title':
+      if attrs.get(attr) and attr not in rel_url:
+        rel_url[attr] = attrs[attr]
+
+  def handle_endtag(self, tag):
+    if not any(element.tag == tag for element in self.stack):
+      return  # stray end tag
+
+    while True:
+      element = self.stack.pop()
+      if element.tag == tag:
+        self.end(element)
+        return
+      if element.significant and element.tag not in CLOSED_BY:
+        raise Ambiguous('unclosed <%s> with microformats' % element.tag)
+      self.end(element)
+
+  def end(self, element):
+    item = element.item
+    if item is None:
+      return
+
+    assert self.roots and self.roots[-1] is item
+    self.roots.pop()
+    implied = item.pop('_implied_url', None)
+    if item.pop('_property', False):
+      return
+    if 'h-entry' in item['type'] and 'url' not in item['properties']:
+      if not implied:
+        raise Ambiguous('h-entry without explicit or simple implied u-url')
+      item['properties']['url'] = [implied]
+
+  def finish(self):
+    HTMLParser.HTMLParser.close(self)
+    while self.stack:
+      self.end(self.stack.pop())
+    return {'items': self.items, 'rels': self.rels, 'rel-urls': self.rel_urls}
+
+
+def parse(html, url):
+  """Extracts h-entry and h-feed structure, a few properties, and rels.
+
+  Args:
+    html: unicode or string HTML document
+    url: string, the document's URL, for resolving relative URLs
+
+  Returns:
+    dict with items, rels, and rel-urls like :func:`mf2py.parse`, or None if
+    the markup is ambiguous and needs the full parser. Items only have the
+    u-url, u-syndication, dt-published, and dt-updated properties.
+  """
+  parser = _Parser(url)
+  try:
+    parser.feed(html)
+    return parser.finish()
+  except Ambiguous as e:
+    logging.debug('Falling back to full mf2 parser for %s: %s', url, e)
+  except HTMLParser.HTMLParseError as e:
+    logging.debug("Couldn't parse %s, falling back to full mf2 parser: %s",
+                  url, e)
+  return None
@@ -46,6 +46,7 @@ class Instagram(models.Source):
   GR_CLASS = gr_instagram.Instagram
   SHORT_NAME = 'instagram'
   FAST_POLL = datetime.timedelta(minutes=60)
+  ADAPTIVE_POLL_MIN = FAST_POLL
   RATE_LIMITED_POLL = models.Source.SLOW_POLL
 
   URL_CANONICALIZER = util.UrlCanonicalizer(
@@ -1,14 +1,17 @@
 """Datastore model classes.
 """
+import collections
 import datetime
+import itertools
 import json
 import logging
+import math
 import re
+import threading
 
 import appengine_config
 from appengine_config import HTTP_TIMEOUT
 
-from google.appengine.api import memcache
 from granary import microformats2
 from granary import source as gr_source
 from oauth_dropins.webutil.models import StringIdModel
@@ -17,6 +20,7 @@ from webmentiontools import send
 import superfeedr
 import util
 
+from google.appengine.api.datastore import MAX_ALLOWABLE_QUERIES
 from google.appengine.ext import ndb
 
 VERB_TYPES = ('post', 'comment', 'like', 'react', 'repost', 'rsvp')
@@ -90,6 +94,34 @@ class Source(StringIdModel):
   # how long to wait after signup for a successful webmention before dropping to
   # the lower frequency poll
   FAST_POLL_GRACE_PERIOD = datetime.timedelta(days=7)
+  # if True, poll tasks don't re-add themselves. instead, cron.DispatchPolls
+  # adds them for sources whose next_poll_at has passed.
+  USE_POLL_SCHEDULER = False
+  # how long a poll can take before cron.DispatchPolls assumes it died and
+  # polls again
+  POLL_LEASE = datetime.timedelta(hours=1)
+  # if True, poll_period() adapts to how often polls find new responses and
+  # public posts, based on poll_stats, instead of using the fixed periods above.
+  ADAPTIVE_POLL = False
+  # bounds for adaptive poll periods
+  ADAPTIVE_POLL_MIN = datetime.timedelta(minutes=10)
+  ADAPTIVE_POLL_MAX = datetime.timedelta(days=2)
+  # adaptive polling aims to find about this many new responses and posts per
+  # poll
+  ADAPTIVE_POLL_TARGET = 1.0
+  # half life of the counts in poll_stats
+  POLL_STATS_HALF_LIFE = datetime.timedelta(days=7)
+  # if True, most polls only fetch responses for posts whose activity_summary()
+  # has changed since the last poll. subclasses should only enable this if
+  # their silo's activity summaries reflect new responses.
+  INCREMENTAL_POLL = False
+  # how often incremental polling sources do a full poll instead
+  FULL_POLL_PERIOD = datetime.timedelta(hours=6)
+  # max number of activity summaries that incremental polling keeps
+  MAX_ACTIVITY_SUMMARIES = 200
+  # if True, polls group new responses by webmention receiver and propagate
+  # each group in a single task. see Response.add_tasks_by_receiver().
+  BATCH_PROPAGATE = False
   # how often refetch author url to look for updated syndication links
   FAST_REFETCH = datetime.timedelta(hours=6)
   # refetch less often (this often) if it's been >2w since the last synd link
@@ -126,6 +158,13 @@ class Source(StringIdModel):
   #
   last_polled = ndb.DateTimeProperty(default=util.EPOCH)
   last_poll_attempt = ndb.DateTimeProperty(default=util.EPOCH)
+  # exponentially decayed counts of new responses and public posts found by
+  # polls, with half life POLL_STATS_HALF_LIFE, as of last_polled. a dict with
+  # keys 'responses' and 'posts'. see update_poll_stats().
+  poll_stats = ndb.JsonProperty()
+  # when cron.DispatchPolls should poll this source next. set by every poll,
+  # but only used if USE_POLL_SCHEDULER is True.
+  next_poll_at = ndb.DateTimeProperty()
   last_webmention_sent = ndb.DateTimeProperty()
   last_public_post = ndb.DateTimeProperty()
   recent_private_posts = ndb.IntegerProperty()
@@ -145,7 +184,17 @@ class Source(StringIdModel):
   last_activity_id = ndb.StringProperty()
   last_activities_etag = ndb.StringProperty()
   last_activities_cache_json = ndb.TextProperty()
+  # for INCREMENTAL_POLL. JSON dict mapping activity id to activity_summary()
+  # as of the last poll that saw it, least recently updated first, and the last
+  # time we fetched responses for all posts.
+  last_activities_summary_json = ndb.TextProperty()
+  last_full_poll = ndb.DateTimeProperty(default=util.EPOCH)
+  # deprecated; replaced by seen_response_fingerprints. Poll migrates and
+  # clears it.
   seen_responses_cache_json = ndb.TextProperty(compressed=True)
+  # maps response id to util.response_fingerprint() for the responses returned
+  # by the last poll that found new ones
+  seen_response_fingerprints = ndb.JsonProperty(compressed=True)
 
   # maps updated property names to values that put_updates() writes back to the
   # datastore transactionally. set this to {} before beginning.
@@ -262,6 +311,11 @@ class Source(StringIdModel):
       return self.RATE_LIMITED_POLL
     elif now < self.created + self.FAST_POLL_GRACE_PERIOD:
       return self.FAST_POLL
+    elif self.ADAPTIVE_POLL:
+      rate = self.poll_rate()
+      period = (datetime.timedelta(seconds=self.ADAPTIVE_POLL_TARGET / rate)
+                if rate else self.ADAPTIVE_POLL_MAX)
+      return min(max(period, self.ADAPTIVE_POLL_MIN), self.ADAPTIVE_POLL_MAX)
     elif not self.last_webmention_sent:
       return self.SLOW_POLL
     elif self.last_webmention_sent > now - datetime.timedelta(days=7):
@@ -271,6 +325,34 @@ class Source(StringIdModel):
     else:
       return self.SLOW_POLL
 
+  def poll_rate(self):
+    """Returns the recent rate of new responses and public posts, per second.
+
+    Derived from :attr:`poll_stats`. A decayed count c with half life h
+    corresponds to a rate of c * ln(2) / h.
+    """
+    count = sum((self.poll_stats or {}).values())
+    return count * math.log(2) / self.POLL_STATS_HALF_LIFE.total_seconds()
+
+  def update_poll_stats(self, now, responses, posts):
+    """Returns new :attr:`poll_stats` after a poll. Doesn't modify this source.
+
+    Decays the existing counts by the time since :attr:`last_polled`, then adds
+    the new counts.
+
+    Args:
+      now: :class:`datetime.datetime`, the new last_polled
+      responses: integer, number of new or changed responses found
+      posts: integer, number of new public posts found
+    """
+    elapsed = max((now - self.last_polled).total_seconds(), 0)
+    decay = .5 ** (elapsed / self.POLL_STATS_HALF_LIFE.total_seconds())
+    stats = self.poll_stats or {}
+    return {
+      'responses': stats.get('responses', 0) * decay + responses,
+      'posts': stats.get('posts', 0) * decay + posts,
+    }
+
   def should_refetch(self):
     """Returns True if we should run OPD refetch on this source now."""
     now = datetime.datetime.now()
@@ -330,6 +412,34 @@ class Source(StringIdModel):
   def get_activities(self, **kwargs):
     return self.get_activities_response(**kwargs)['items']
 
+  def activity_summary(self, activity):
+    """Returns a summary of an activity's responses, for incremental polling.
+
+    Polls fetch responses for posts whose summary has changed since the last
+    poll. The summary should only use fields that the silo returns whether or
+    not responses are fetched, e.g. response counts. The default uses the reply
+    count, the like, share and total tag counts, and the updated time. Sources
+    whose silos only return likes and shares when they're fetched should
+    override this with counts that the silo does return. May be overridden by
+    subclasses.
+
+    Args:
+      activity: dict, ActivityStreams activity
+
+    Returns:
+      JSON-serializable value
+    """
+    obj = activity.get('object') or activity
+    tags = obj.get('tags') or []
+    verbs = [tag.get('verb') for tag in tags]
+    return {
+      'replies': (obj.get('replies') or {}).get('totalItems'),
+      'likes': verbs.count('like'),
+      'shares': verbs.count('share'),
+      'tags': len(tags),
+      'updated': obj.get('updated') or activity.get('updated'),
+    }
+
   def get_comment(self, comment_id, **kwargs):
     """Returns a comment from this source.
 
@@ -472,7 +582,8 @@ class Source(StringIdModel):
 
     if 'listen' in source.features:
       util.add_poll_task(source, now=True)
-      util.add_poll_task(source, countdown=source.poll_period().total_seconds())
+      if not source.USE_POLL_SCHEDULER:
+        util.add_poll_task(source, countdown=source.poll_period().total_seconds())
 
     return source
 
@@ -677,6 +788,11 @@ class Webmentions(StringIdModel):
   """
   STATUSES = ('new', 'processing', 'complete', 'error')
 
+  # max entities that get_or_save_multi() stores in each transaction along with
+  # their propagate tasks. App Engine allows 5 transactional tasks per
+  # transaction.
+  MAX_TRANSACTIONAL_TASKS = 5
+
   # Turn off instance and memcache caching. See Source for details.
   _use_cache = False
   _use_memcache = False
@@ -684,6 +800,9 @@ class Webmentions(StringIdModel):
   source = ndb.KeyProperty()
   status = ndb.StringProperty(choices=STATUSES, default='new')
   leased_until = ndb.DateTimeProperty()
+  # incremented every time a task leases this entity, so that the task can tell
+  # if another task has leased it since. see tasks.SendWebmentions.lease().
+  lease_version = ndb.IntegerProperty(default=0, indexed=False)
   created = ndb.DateTimeProperty(auto_now_add=True)
   updated = ndb.DateTimeProperty(auto_now=True)
 
@@ -727,25 +846,97 @@ class Webmentions(StringIdModel):
           if resp:
             return resp
 
-    if self.unsent or self.error:
-      logging.debug('New webmentions to propagate! %s', self.label())
+    if self._prepare_new():
       self.add_task(transactional=True)
-    else:
-      self.status = 'complete'
 
     self.put()
     return self
 
-  def restart(self):
-    """Moves status and targets to 'new' and adds a propagate task."""
-    self.status = 'new'
-    self.unsent = util.dedupe_urls(self.unsent + self.sent + self.error +
-                                   self.failed + self.skipped)
-    self.sent = self.error = self.failed = self.skipped = []
+  def _prepare_new(self):
+    """Returns True if this new entity has targets to propagate to.
 
-    # clear any cached webmention endpoints
-    memcache.delete_multi(util.webmention_endpoint_cache_key(url)
-                          for url in self.unsent)
+    Otherwise, marks it complete.
+    """
+    if self.unsent or self.error:
+      logging.debug('New webmentions to propagate! %s', self.label())
+      return True
+
+    self.status = 'complete'
+    return False
+
+  @staticmethod
+  def get_or_save_multi(entities):
+    """Bulk version of :meth:`get_or_save()`.
+
+    Loads existing entities with a single batch get. Stores new entities that
+    need propagating in small transactions along with their propagate tasks, and
+    the rest with a single batch put.
+
+    Args:
+      entities: sequence of :class:`Webmentions`, not yet stored
+
+    Returns:
+      list of :class:`Webmentions`, the stored version of each input entity,
+      in the same order
+    """
+    keys = [entity.key for entity in entities]
+    existing = {key: entity for key, entity in zip(keys, ndb.get_multi(keys))
+                if entity}
+
+    results = []
+    to_put = []
+    to_propagate = []
+    for entity in entities:
+      stored = existing.get(entity.key)
+      if not stored:
+        if entity._prepare_new():
+          to_propagate.append(entity)
+        to_put.append(entity)
+        existing[entity.key] = stored = entity
+      results.append(stored)
+
+    Webmentions._put_multi_and_add_tasks(to_put, to_propagate)
+    return results
+
+  @staticmethod
+  def _put_multi_and_add_tasks(to_put, to_propagate):
+    """Stores entities and adds propagate tasks for some of them.
+
+    Each entity in to_propagate is stored in the same transaction that adds its
+    task, :attr:`MAX_TRANSACTIONAL_TASKS` at a time, so that it's never stored
+    without one. The rest are stored with a single batch put.
+
+    Args:
+      to_put: sequence of :class:`Webmentions`
+      to_propagate: sequence of :class:`Webmentions`, a subset of to_put
+    """
+    propagate_keys = set(entity.key for entity in to_propagate)
+    ndb.put_multi([e for e in to_put if e.key not in propagate_keys])
+
+    size = Webmentions.MAX_TRANSACTIONAL_TASKS
+    for i in xrange(0, len(to_propagate), size):
+      Webmentions._put_and_add_tasks(to_propagate[i:i + size])
+
+  @staticmethod
+  @ndb.transactional(xg=True)
+  def _put_and_add_tasks(entities):
+    """Stores entities and adds their propagate tasks, in one transaction.
+
+    Args:
+      entities: sequence of at most :attr:`MAX_TRANSACTIONAL_TASKS`
+        :class:`Webmentions`
+    """
+    ndb.put_multi(entities)
+    for entity in entities:
+      entity.add_task(transactional=True)
+
+  def restart(self, **kwargs):
+    """Moves status and targets to 'new' and adds a propagate task.
+
+    Args:
+      kwargs: passed through to :meth:`prepare_restart()`
+    """
+    self.prepare_restart(**kwargs)
 
     @ndb.transactional
     def finish():
@@ -754,12 +945,28 @@ class Webmentions(StringIdModel):
 
     finish()
 
+  def prepare_restart(self):
+    """Moves status and targets to 'new'. Doesn't store or add a task."""
+    self.status = 'new'
+    self.unsent = util.dedupe_urls(self.unsent + self.sent + self.error +
+                                   self.failed + self.skipped)
+    self.sent = self.error = self.failed = self.skipped = []
+
+    # clear any cached webmention endpoints
+    util.WebmentionEndpoint.invalidate(self.unsent)
+
 
 class Response(Webmentions):
   """A comment, like, or repost to be propagated.
 
   The key name is the comment object id as a tag URI.
   """
+  # max number of responses that a single propagate task handles. see
+  # add_tasks_by_receiver(). at most 25, the most entity groups a cross-group
+  # transaction can use, since get_or_save_multi() stores each task's responses
+  # in one.
+  PROPAGATE_BATCH_SIZE = 20
+
   # ActivityStreams JSON activity and comment, like, or repost
   type = ndb.StringProperty(choices=VERB_TYPES, default='comment')
   # These are TextProperty, and not JsonProperty, so that their plain text is
@@ -791,21 +998,136 @@ class Response(Webmentions):
   def get_or_save(self, source, restart=False):
     resp = super(Response, self).get_or_save()
 
-    if (self.type != resp.type or
-        source.gr_source.activity_changed(json.loads(resp.response_json),
-                                         json.loads(self.response_json),
-                                         log=True)):
-      logging.info('Response changed! Re-propagating. Original: %s' % resp)
-      resp.old_response_jsons = resp.old_response_jsons[:10] + [resp.response_json]
-      resp.response_json = self.response_json
-      resp.restart(source)
+    if self._changed(resp, source):
+      resp.restart(source=source)
     elif restart and resp is not self:  # ie it already existed
-      resp.restart(source)
+      resp.restart(source=source)
 
     return resp
 
-  def restart(self, source=None):
-    """Moves status and targets to 'new' and adds a propagate task."""
+  def _changed(self, existing, source):
+    """Returns True if this response differs from an existing stored version.
+
+    If it does, also moves the existing version's response_json to
+    old_response_jsons and replaces it with this one's.
+
+    Args:
+      existing: :class:`Response`
+      source: :class:`Source`
+    """
+    if (self.type != existing.type or
+        source.gr_source.activity_changed(json.loads(existing.response_json),
+                                         json.loads(self.response_json),
+                                         log=True)):
+      logging.info('Response changed! Re-propagating. Original: %s' % existing)
+      existing.old_response_jsons = (existing.old_response_jsons[:10] +
+                                     [existing.response_json])
+      existing.response_json = self.response_json
+      return True
+
+    return False
+
+  @staticmethod
+  def get_or_save_multi(source, responses, restart=False):
+    """Bulk version of :meth:`get_or_save()`.
+
+    Loads all existing responses, including legacy Facebook ids, with a single
+    batch get. Like :meth:`Webmentions.get_or_save_multi()`, stores responses
+    that need propagating in small transactions along with their propagate
+    tasks, so that a failure never leaves a stored response without one, and
+    the rest with a single batch put.
+
+    Args:
+      source: :class:`Source`
+      responses: sequence of :class:`Response`, not yet stored
+      restart: boolean, whether to restart responses that already exist
+
+    Returns:
+      list of :class:`Response`, the stored version of each input response, in
+      the same order
+    """
+    # TODO: take this out along with the legacy fb_id lookup in get_or_save().
+    legacy_keys = {}
+    for resp in responses:
+      fb_id = json.loads(resp.response_json).get('fb_id')
+      if fb_id:
+        tag_fb_id = 'tag:facebook.com,2013:' + fb_id
+        if tag_fb_id != resp.key.id():
+          legacy_keys[resp.key] = ndb.Key(Response, tag_fb_id)
+
+    keys = [resp.key for resp in responses]
+    keys += [key for key in legacy_keys.values() if key not in keys]
+    existing = {key: entity for key, entity in zip(keys, ndb.get_multi(keys))
+                if entity}
+
+    results = []
+    to_put = []
+    to_propagate = []
+    for resp in responses:
+      stored = existing.get(resp.key) or existing.get(legacy_keys.get(resp.key))
+      if not stored:
+        if resp._prepare_new():
+          to_propagate.append(resp)
+        to_put.append(resp)
+        existing[resp.key] = stored = resp
+      elif resp._changed(stored, source) or restart:
+        stored.prepare_restart(source=source)
+        to_put.append(stored)
+        to_propagate.append(stored)
+      results.append(stored)
+
+    if source.BATCH_PROPAGATE:
+      propagate_keys = set(resp.key for resp in to_propagate)
+      ndb.put_multi([r for r in to_put if r.key not in propagate_keys])
+      Response.add_tasks_by_receiver(to_propagate, put=True)
+    else:
+      Webmentions._put_multi_and_add_tasks(to_put, to_propagate)
+    return results
+
+  @staticmethod
+  def add_tasks_by_receiver(responses, put=False):
+    """Adds propagate tasks that each handle a group of responses.
+
+    Groups responses by their targets' receivers, ie their cached webmention
+    endpoints, or their domains if we haven't discovered their endpoints yet.
+    Each task handles up to :attr:`PROPAGATE_BATCH_SIZE` responses.
+
+    Args:
+      responses: sequence of :class:`Response`
+      put: boolean, whether to also store each group's responses, in the same
+        transaction that adds its task
+    """
+    cached = util.WebmentionEndpoint.load_multi(
+      set(itertools.chain(*(resp.unsent for resp in responses))))
+
+    groups = collections.OrderedDict()
+    for resp in responses:
+      receivers = set()
+      for url in resp.unsent:
+        endpoint = cached[url] and cached[url].endpoint
+        receivers.add(endpoint or util.domain_from_link(url))
+      groups.setdefault(frozenset(receivers), []).append(resp)
+
+    @ndb.transactional(xg=True)
+    def put_and_add_task(group):
+      ndb.put_multi(group)
+      util.add_propagate_task(*group, transactional=True)
+
+    size = Response.PROPAGATE_BATCH_SIZE
+    with util.batch_tasks():
+      for group in groups.values():
+        for i in xrange(0, len(group), size):
+          if put:
+            put_and_add_task(group[i:i + size])
+          else:
+            util.add_propagate_task(*group[i:i + size])
+
+  def prepare_restart(self, source=None):
+    """Moves status and targets to 'new'. Doesn't store or add a task.
+
+    Args:
+      source: :class:`Source`, optional. Loaded if not provided.
+    """
     # add original posts with syndication URLs
     # TODO: unify with Poll.repropagate_old_responses()
     if not source:
@@ -825,7 +1147,7 @@ class Response(Webmentions):
                       SyndicatedPost.query(SyndicatedPost.syndication.IN(synd_urls))
                       if synd.original]
 
-    return super(Response, self).restart()
+    super(Response, self).prepare_restart()
 
 
 class BlogPost(Webmentions):
@@ -915,6 +1237,8 @@ class SyndicatedPost(ndb.Model):
 
   When a :class:`SyndicatedPost` entity is about to be stored,
   :meth:`source.Source.on_new_syndicated_post()` is called before it's stored.
+
+  To store many relationships at once, use :class:`SyndicatedPostWriter`.
   """
 
   # Turn off instance and memcache caching. See Response for details.
@@ -926,6 +1250,11 @@ class SyndicatedPost(ndb.Model):
   created = ndb.DateTimeProperty(auto_now_add=True)
   updated = ndb.DateTimeProperty(auto_now=True)
 
+  # thread local. while its skip attribute is True, puts in this thread don't
+  # call on_new_syndicated_post(). SyndicatedPostWriter sets it around its bulk
+  # put, since it calls on_new_syndicated_post() itself.
+  _hooks = threading.local()
+
   @classmethod
   @ndb.transactional(xg=True)
   def insert_original_blank(cls, source, original):
@@ -996,4 +1325,236 @@ class SyndicatedPost(ndb.Model):
     return r
 
   def _pre_put_hook(self):
-    self.key.parent().get().on_new_syndicated_post(self)
+    if not getattr(self._hooks, 'skip', False):
+      self.key.parent().get().on_new_syndicated_post(self)
+
+
+class SyndicatedPostWriter(object):
+  """Collects :class:`SyndicatedPost` writes for a source and stores them in bulk.
+
+  Makes the same changes as :meth:`SyndicatedPost.insert()`,
+  :meth:`SyndicatedPost.insert_original_blank()`, and deleting relationships
+  individually would, but :meth:`flush()` does them all in one transaction with
+  a few chunked IN queries, one :func:`ndb.delete_multi`, one
+  :func:`ndb.put_multi`, and one :meth:`Source.on_new_syndicated_post()` pass.
+
+  Not thread safe.
+
+  Attributes:
+    source: :class:`Source` subclass
+    inserts: OrderedDict mapping (syndication, original) tuple to unstored
+      :class:`SyndicatedPost`
+    original_blanks: list of string original URLs
+    deletes: list of :class:`SyndicatedPost`
+  """
+
+  def __init__(self, source):
+    self.source = source
+    self.inserts = collections.OrderedDict()
+    self.original_blanks = []
+    self.deletes = []
+
+  def insert(self, syndication, original):
+    """Queues a new (non-blank) syndication -> original relationship.
+
+    Args:
+      syndication: string (not None)
+      original: string (not None)
+
+    Returns:
+      :class:`SyndicatedPost`. Not stored until :meth:`flush()`, and not
+      stored at all if the relationship already exists.
+    """
+    return self.inserts.setdefault(
+      (syndication, original),
+      SyndicatedPost(parent=self.source.key, syndication=syndication,
+                     original=original))
+
+  def insert_original_blank(self, original):
+    """Queues a new original -> None relationship, if none exists at flush time.
+
+    Args:
+      original: string
+    """
+    self.original_blanks.append(original)
+
+  def delete(self, syndpost):
+    """Queues a stored :class:`SyndicatedPost` for deletion.
+
+    Args:
+      syndpost: :class:`SyndicatedPost`
+    """
+    self.deletes.append(syndpost)
+
+  def flush(self):
+    """Stores all queued changes and clears the queue.
+
+    Returns:
+      list of newly stored :class:`SyndicatedPost`\ s, including blanks. Queued
+      inserts that aren't in it weren't stored because they already existed.
+    """
+    if not (self.inserts or self.original_blanks or self.deletes):
+      return []
+
+    stored = self._flush()
+    self.inserts.clear()
+    del self.original_blanks[:]
+    del self.deletes[:]
+    return stored
+
+  @ndb.transactional(xg=True)
+  def _flush(self):
+    """Transactional part of :meth:`flush()`.
+
+    Everything here is recomputed if the transaction retries, including the
+    :meth:`Source.on_new_syndicated_post()` calls, which get a freshly loaded
+    source each time, so that their changes are rolled back and redone along
+    with ours. Entities that an earlier attempt tried to put may have keys even
+    if they aren't stored, so callers should only trust the returned list.
+    """
+    parent = self.source.key
+    inserts = self.inserts.values()
+
+    def query(prop, values):
+      values = list(values)
+      return itertools.chain.from_iterable(
+        SyndicatedPost.query(prop.IN(values[i:i + MAX_ALLOWABLE_QUERIES]),
+                             ancestor=parent)
+        for i in xrange(0, len(values), MAX_ALLOWABLE_QUERIES))
+
+    # load every existing relationship that might conflict, in one pass
+    deleting = set(r.key for r in self.deletes)
+    existing = {}
+    for r in itertools.chain(
+        query(SyndicatedPost.syndication, set(r.syndication for r in inserts)),
+        query(SyndicatedPost.original,
+              set(r.original for r in inserts) | set(self.original_blanks))):
+      if r.key not in deleting:
+        existing[r.key] = r
+    existing = existing.values()
+
+    # skip exact matches, then delete the blanks that new relationships replace
+    pairs = set((r.syndication, r.original) for r in existing)
+    to_put = [r for r in inserts if (r.syndication, r.original) not in pairs]
+    new_syndications = set(r.syndication for r in to_put)
+    new_originals = set(r.original for r in to_put)
+    for r in existing:
+      if ((r.original is None and r.syndication in new_syndications) or
+          (r.syndication is None and r.original in new_originals)):
+        deleting.add(r.key)
+
+    # only add original blanks for originals with no other relationships
+    originals = new_originals | set(r.original for r in existing
+                                    if r.key not in deleting)
+    for original in self.original_blanks:
+      if original not in originals:
+        to_put.append(SyndicatedPost(parent=parent, original=original,
+                                     syndication=None))
+        originals.add(original)
+
+    if to_put:
+      source = parent.get()
+      for r in to_put:
+        source.on_new_syndicated_post(r)
+
+    ndb.delete_multi(list(deleting))
+    SyndicatedPost._hooks.skip = True
+    try:
+      ndb.put_multi(to_put)
+    finally:
+      SyndicatedPost._hooks.skip = False
+    return to_put
+
+
+class FetchValidators(ndb.Model):
+  """HTTP validators for a page that original post discovery has processed.
+
+  Lets :mod:`original_post_discovery` send conditional GETs and skip pages that
+  haven't changed since it last processed them. Child of the :class:`Source`
+  it was processed for, since what we find in a page depends on the source.
+  Ignored once the source's domains or other relevant properties change.
+
+  Key id is the URL.
+  """
+  etag = ndb.StringProperty(indexed=False)
+  last_modified = ndb.StringProperty(indexed=False)
+  body_hash = ndb.StringProperty(indexed=False)  # SHA1 hex digest
+  # for author pages, the rel-feed URLs we found on them
+  feed_urls = ndb.StringProperty(repeated=True, indexed=False)
+  # SHA1 hex digest of the source properties that affect what we find in the
+  # page. See original_post_discovery._source_state().
+  source_state = ndb.StringProperty(indexed=False)
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+  def request_headers(self):
+    """Returns a dict of conditional request headers from these validators."""
+    headers = {}
+    if self.etag:
+      headers['If-None-Match'] = self.etag
+    if self.last_modified:
+      headers['If-Modified-Since'] = self.last_modified
+    return headers
+
+
+class PollStats(StringIdModel):
+  """Timings and HTTP stats for a source's most recent polls.
+
+  Key id is the source's urlsafe key. Rendered in /admin/poll_stats.
+  """
+  # how many polls to keep
+  POLLS_KEPT = 20
+  # fraction of polls to record, since each one costs a datastore read and write
+  SAMPLE_RATE = .1
+
+  # Turn off instance and memcache caching. See Source for details.
+  _use_cache = False
+  _use_memcache = False
+
+  source = ndb.KeyProperty()
+  # list of dicts, oldest first, each with keys time (ISO 8601 string),
+  # total_ms, phases (dict mapping phase name to ms), http_calls, and http_bytes.
+  # see util.RequestStats.
+  polls = ndb.JsonProperty(compressed=True)
+  updated = ndb.DateTimeProperty(auto_now=True)
+
+  @classmethod
+  def record(cls, source, stats, total_ms):
+    """Adds a poll's stats to a source's PollStats and stores it.
+
+    Callers should only record a :attr:`SAMPLE_RATE` fraction of polls.
+
+    Args:
+      source: :class:`Source`
+      stats: :class:`util.RequestStats`
+      total_ms: integer, total poll time in milliseconds
+    """
+    id = source.key.urlsafe()
+    entity = cls.get_by_id(id) or cls(id=id, source=source.key)
+    poll = stats.to_dict()
+    poll.update({
+      'time': util.now_fn().isoformat(),
+      'total_ms': total_ms,
+    })
+    entity.polls = ((entity.polls or []) + [poll])[-cls.POLLS_KEPT:]
+    entity.put()
+
+  def averages(self):
+    """Returns the mean of each stat over the stored polls.
+
+    Returns:
+      dict with keys total_ms, phases (dict mapping phase name to ms),
+      http_calls, and http_bytes
+    """
+    polls = self.polls or []
+    num = float(len(polls)) or 1
+    phases = collections.defaultdict(int)
+    for poll in polls:
+      for name, ms in poll.get('phases', {}).items():
+        phases[name] += ms
+
+    return {
+      'total_ms': sum(p.get('total_ms', 0) for p in polls) / num,
+      'phases': {name: ms / num for name, ms in phases.items()},
+      'http_calls': sum(p.get('http_calls', 0) for p in polls) / num,
+      'http_bytes': sum(p.get('http_bytes', 0) for p in polls) / num,
+    }
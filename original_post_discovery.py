@@ -27,16 +27,20 @@ lookups in the following primary cases:
 
 import collections
 import datetime
+import hashlib
 import itertools
+import json
 import logging
 import mf2util
 import requests
-import urlparse
+import threading
 import util
 
+import fast_mf2
 from granary import microformats2
 from granary import source as gr_source
 from google.appengine.api.datastore import MAX_ALLOWABLE_QUERIES
+from google.appengine.ext import ndb
 import models
 from models import SyndicatedPost
 
@@ -45,10 +49,32 @@ from google.appengine.api import memcache
 MAX_PERMALINK_FETCHES = 10
 MAX_PERMALINK_FETCHES_BETA = 50
 MAX_FEED_ENTRIES = 100
+# max concurrent permalink fetches per host when prefetching an author's
+# permalinks, so that we don't hammer their site
+MAX_PERMALINK_FETCHES_PER_HOST = 4
+
+# Send conditional GETs for author pages, rel-feeds, and permalinks, and skip
+# processing them when they haven't changed. See models.FetchValidators.
+CONDITIONAL_GET = True
+# Ignore stored validators older than this, so that we periodically process
+# everything from scratch anyway.
+VALIDATORS_MAX_AGE = datetime.timedelta(days=7)
+# Validators are keyed by URL, so don't store them for very long URLs.
+MAX_VALIDATORS_URL_LENGTH = 500
+
+# Parse pages with fast_mf2 when possible instead of the full mf2py parser.
+FAST_PARSE = True
+
+# Serialize posse post discovery's h-feed fetches per author URL, so that when
+# discover() runs in parallel threads with a shared already_fetched_hfeeds, only
+# one thread fetches and processes each h-feed and the rest wait for it. URLs
+# are hashed onto a fixed number of locks so that the table doesn't grow.
+HFEED_LOCK_STRIPES = 64
+_hfeed_locks = [threading.Lock() for _ in xrange(HFEED_LOCK_STRIPES)]
 
 
 def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True,
-             already_fetched_hfeeds=None):
+             already_fetched_hfeeds=None, preloaded=None):
   """Augments the standard original_post_discovery algorithm with a
   reverse lookup that supports posts without a backlink or citation.
 
@@ -66,11 +92,13 @@ def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True,
       well as their final destination URLs
     already_fetched_hfeeds: set, URLs that we have already fetched and run
       posse-post-discovery on, so we can avoid running it multiple times
+    preloaded: dict, optional, returned by :func:`preload_syndicated_posts()`
+      for a batch of activities that includes this one
 
   Returns:
     (set(string original post URLs), set(string mention URLs)) tuple
   """
-  if not source.updates:
+  if source.updates is None:
     source.updates = {}
 
   if already_fetched_hfeeds is None:
@@ -98,7 +126,8 @@ def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True,
       logging.debug('running original post discovery on attachment: %s',
                     att.get('id'))
       att_origs, _ = discover(
-        source, att, include_redirect_sources=include_redirect_sources)
+        source, att, include_redirect_sources=include_redirect_sources,
+        preloaded=preloaded)
       logging.debug('original post discovery found originals for attachment, %s',
                     att_origs)
       mentions.update(att_origs)
@@ -133,7 +162,7 @@ def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True,
     if syndication_url:
       originals.update(_posse_post_discovery(
         source, activity, syndication_url, fetch_hfeed,
-        already_fetched_hfeeds))
+        already_fetched_hfeeds, preloaded=preloaded))
     originals = set(util.dedupe_urls(originals))
   else:
     logging.debug('no syndication url, cannot process h-entries')
@@ -141,6 +170,55 @@ def discover(source, activity, fetch_hfeed=True, include_redirect_sources=True,
   return originals, mentions
 
 
+def preload_syndicated_posts(source, activities):
+  """Loads the stored relationships for a batch of activities, e.g. a poll.
+
+  Canonicalizes the syndication URLs of the activities and their attachments,
+  like :func:`discover()` does, and looks them all up with a few chunked IN
+  queries instead of one query per activity. Pass the result to
+  :func:`discover()` as preloaded.
+
+  Call this before running :func:`discover()` on any of the activities, since
+  the relationships it returns are only as fresh as that.
+
+  Args:
+    source: :class:`models.Source` subclass
+    activities: sequence of activity dicts
+
+  Returns:
+    dict mapping canonical syndication URL to list of
+    :class:`models.SyndicatedPost`\ s, possibly empty, for every syndication
+    URL in activities
+  """
+  if not source.get_author_urls():
+    return {}
+
+  urls = set()
+  for activity in activities:
+    obj = activity.get('object', {})
+    for a in [activity] + [
+        att for att in obj.get('attachments', [])
+        if (att.get('objectType') in ('note', 'article')
+            and att.get('author', {}).get('id') == source.user_tag_id())]:
+      url = a.get('object', {}).get('url') or a.get('url')
+      if url:
+        url = source.canonicalize_url(url)
+        if url:
+          urls.add(url)
+
+  preloaded = {url: [] for url in urls}
+  urls = list(urls)
+  for r in itertools.chain.from_iterable(
+      SyndicatedPost.query(
+        SyndicatedPost.syndication.IN(urls[i:i + MAX_ALLOWABLE_QUERIES]),
+        ancestor=source.key)
+      for i in xrange(0, len(urls), MAX_ALLOWABLE_QUERIES)):
+    preloaded[r.syndication].append(r)
+
+  logging.debug('preloaded relationships for %d syndication URLs', len(urls))
+  return preloaded
+
+
 def refetch(source):
   """Refetch the author's URLs and look for new or updated syndication
   links that might not have been there the first time we looked.
@@ -153,7 +231,7 @@ def refetch(source):
   Returns:
     dict: mapping syndicated_url to a list of new :class:`models.SyndicatedPost`\ s
   """
-  if not source.updates:
+  if source.updates is None:
     source.updates = {}
 
   logging.debug('attempting to refetch h-feed for %s', source.label())
@@ -187,7 +265,7 @@ def targets_for_response(resp, originals, mentions):
 
 
 def _posse_post_discovery(source, activity, syndication_url, fetch_hfeed,
-                          already_fetched_hfeeds):
+                          already_fetched_hfeeds, preloaded=None):
   """Performs the actual meat of the posse-post-discover.
 
   Args:
@@ -199,7 +277,8 @@ def _posse_post_discovery(source, activity, syndication_url, fetch_hfeed,
       author's feed if we don't have a previously stored
       relationship
     already_fetched_hfeeds: set, URLs we've already fetched in a
-      previous iteration
+      previous iteration, or in another thread
+    preloaded: dict, optional, from :func:`preload_syndicated_posts()`
 
   Return:
     sequence of string original post urls, possibly empty
@@ -207,9 +286,23 @@ def _posse_post_discovery(source, activity, syndication_url, fetch_hfeed,
   logging.info('starting posse post discovery with syndicated %s',
                syndication_url)
 
-  relationships = SyndicatedPost.query(
-    SyndicatedPost.syndication == syndication_url,
-    ancestor=source.key).fetch()
+  def query():
+    return SyndicatedPost.query(SyndicatedPost.syndication == syndication_url,
+                                ancestor=source.key).fetch()
+
+  if preloaded is not None and syndication_url in preloaded:
+    # loaded before this poll fetched any h-feeds, so if one has been fetched
+    # since, we may need to look again below.
+    fetched_before = set()
+    relationships = preloaded[syndication_url]
+    if (relationships and not any(r.original for r in relationships) and
+        any(url in already_fetched_hfeeds for url in _get_author_urls(source))):
+      # just blanks, and an h-feed has been fetched since, which may have
+      # replaced them. look again.
+      relationships = query()
+  else:
+    fetched_before = set(already_fetched_hfeeds)
+    relationships = query()
 
   if not relationships and fetch_hfeed:
     # a syndicated post we haven't seen before! fetch the author's URLs to see
@@ -218,14 +311,20 @@ def _posse_post_discovery(source, activity, syndication_url, fetch_hfeed,
     # TODO: Consider using the actor's url, with get_author_urls() as the
     # fallback in the future to support content from non-Bridgy users.
     results = {}
+    fetched_since = False
     for url in _get_author_urls(source):
-      if url not in already_fetched_hfeeds:
-        results.update(_process_author(source, url))
-        already_fetched_hfeeds.add(url)
-      else:
-        logging.debug('skipping %s, already fetched this round', url)
+      with _hfeed_lock(url):
+        if url not in already_fetched_hfeeds:
+          results.update(_process_author(source, url))
+          already_fetched_hfeeds.add(url)
+        else:
+          logging.debug('skipping %s, already fetched this round', url)
+          fetched_since |= url not in fetched_before
 
     relationships = results.get(syndication_url, [])
+    if not relationships and fetched_since:
+      # another thread processed this h-feed after we queried. look again.
+      relationships = query()
 
   if not relationships:
     # No relationships were found. Remember that we've seen this
@@ -242,6 +341,11 @@ def _posse_post_discovery(source, activity, syndication_url, fetch_hfeed,
   return originals
 
 
+def _hfeed_lock(url):
+  """Returns the :class:`threading.Lock` for a given author URL."""
+  return _hfeed_locks[hash(url) % HFEED_LOCK_STRIPES]
+
+
 def _process_author(source, author_url, refetch=False, store_blanks=True):
   """Fetch the author's domain URL, and look for syndicated posts.
 
@@ -261,13 +365,27 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
   if not ok:
     return {}
 
+  # we can skip the author page if it and its feeds haven't changed, since we
+  # already processed all of their permalinks. when refetching, that's only true
+  # if we get syndication links from the feeds, not the permalinks themselves.
+  author_validators = None
+  if store_blanks and (not refetch or source.last_feed_syndication_url):
+    author_validators = _get_validators(source, [author_url]).get(author_url)
+
   try:
     logging.debug('fetching author url %s', author_url)
-    author_resp = util.requests_get(author_url)
     # TODO for error codes that indicate a temporary error, should we make
     # a certain number of retries before giving up forever?
-    author_resp.raise_for_status()
-    author_dom = util.beautifulsoup_parse(author_resp.text)
+    author_resp, new_author_validators = _conditional_get(
+      source, author_url, author_validators)
+    if not new_author_validators:
+      if _feeds_unchanged(source, author_validators.feed_urls):
+        logging.info('%s and its feeds are unchanged since %s. Skipping.',
+                     author_url, author_validators.updated)
+        return {}
+      # a feed changed, so we need the author page after all
+      author_resp, new_author_validators = _conditional_get(source, author_url)
+    author_parsed = _mf2_parse(author_resp.text, author_url)
   except AssertionError:
     raise  # for unit tests
   except BaseException:
@@ -276,18 +394,15 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
     logging.info('Could not fetch author url %s', author_url, exc_info=True)
     return {}
 
-  feeditems = _find_feed_items(author_url, author_dom)
+  feeditems = _find_feed_items(author_url, author_parsed)
 
   # look for all other feed urls using rel='feed', type='text/html'
   feed_urls = set()
-  for rel_feed_node in (author_dom.find_all('link', rel='feed')
-                        + author_dom.find_all('a', rel='feed')):
-    feed_url = rel_feed_node.get('href')
-    if not feed_url:
+  for feed_url, rel_url in author_parsed.get('rel-urls', {}).items():
+    if 'feed' not in rel_url.get('rels', []):
       continue
 
-    feed_url = urlparse.urljoin(author_url, feed_url)
-    feed_type = rel_feed_node.get('type')
+    feed_type = rel_url.get('type')
     if feed_type and feed_type != 'text/html':
       feed_ok = False
     else:
@@ -301,11 +416,16 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
     else:
       feed_urls.add(feed_url)
 
-  for feed_url in feed_urls:
+  new_author_validators.feed_urls = sorted(feed_urls)
+  new_validators = [new_author_validators]
+  # if any feed fails, don't store validators, so we don't skip this author
+  # next time
+  validators_ok = True
+  for feed_url in sorted(feed_urls):
     try:
       logging.debug("fetching author's rel-feed %s", feed_url)
-      feed_resp = util.requests_get(feed_url)
-      feed_resp.raise_for_status()
+      feed_resp, feed_validators = _conditional_get(source, feed_url)
+      new_validators.append(feed_validators)
       logging.debug("author's rel-feed fetched successfully %s", feed_url)
       feeditems = _merge_hfeeds(feeditems,
                                 _find_feed_items(feed_url, feed_resp.text))
@@ -321,6 +441,7 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
       raise  # reraise assertions for unit tests
     except BaseException:
       logging.info('Could not fetch h-feed url %s.', feed_url, exc_info=True)
+      validators_ok = False
 
   # sort by dt-updated/dt-published
   def updated_or_published(item):
@@ -359,14 +480,53 @@ def _process_author(source, author_url, refetch=False, store_blanks=True):
   for r in preexisting_list:
     preexisting.setdefault(r.original, []).append(r)
 
+  to_fetch = [permalink for permalink in permalinks_list
+              if refetch or not preexisting.get(permalink)]
+  # when refetching, we can skip permalinks that haven't changed
+  permalink_validators = {}
+  if refetch and store_blanks:
+    permalink_validators = _get_validators(
+      source, [p for p in to_fetch if preexisting.get(p)])
+
+  # resolve and fetch the permalinks we'll process in parallel first, then look
+  # for relationships serially, since that reads and writes the datastore.
+  def prefetch(permalink):
+    entry = permalink_to_entry[permalink]
+    return _prefetch_permalink(source, permalink,
+                               fetch=_should_fetch_permalink(source, entry),
+                               validators=permalink_validators.get(permalink))
+
+  prefetched = dict(zip(to_fetch, util.map_in_parallel(
+    prefetch, to_fetch, key=util.domain_from_link,
+    max_per_key=MAX_PERMALINK_FETCHES_PER_HOST)))
+
+  # collect all of the feed's relationship changes and store them at once
+  writer = models.SyndicatedPostWriter(source)
   results = {}
   for permalink, entry in permalink_to_entry.iteritems():
+    if permalink in prefetched and not prefetched[permalink]:
+      logging.debug('permalink %s is unchanged. Skipping.', permalink)
+      continue
     logging.debug('processing permalink: %s', permalink)
     new_results = process_entry(
       source, permalink, entry, refetch, preexisting.get(permalink, []),
-      store_blanks=store_blanks)
+      store_blanks=store_blanks, prefetched=prefetched.get(permalink),
+      writer=writer)
     for key, value in new_results.iteritems():
       results.setdefault(key, []).extend(value)
+    if prefetched.get(permalink):
+      new_validators.append(prefetched[permalink][4])
+
+  # relationships that turned out to exist already weren't stored
+  queued = set(id(r) for r in writer.inserts.values())
+  stored = set(id(r) for r in writer.flush())
+  results = {url: [r for r in rs if id(r) in stored or id(r) not in queued]
+             for url, rs in results.iteritems()}
+  results = {url: rs for url, rs in results.iteritems() if rs}
+
+  if CONDITIONAL_GET and store_blanks and validators_ok:
+    ndb.put_multi(v for v in new_validators
+                  if v and len(v.key.id()) <= MAX_VALIDATORS_URL_LENGTH)
 
   if source.updates is not None and results:
     # keep track of the last time we've seen rel=syndication urls for
@@ -406,13 +566,14 @@ def _find_feed_items(feed_url, feed_doc):
 
   Args:
     feed_url: a string. the URL passed to mf2py parser
-    feed_doc: a string or BeautifulSoup object. document is passed to
-      mf2py parser
+    feed_doc: a string or BeautifulSoup object, which is passed to
+      :func:`_mf2_parse()`, or an already parsed mf2 dict
 
   Returns:
     a list of dicts, each one representing an mf2 h-* item
   """
-  parsed = util.mf2py_parse(feed_doc, feed_url)
+  parsed = (feed_doc if isinstance(feed_doc, dict)
+            else _mf2_parse(feed_doc, feed_url))
 
   feeditems = parsed['items']
   hfeeds = mf2util.find_all_entries(parsed, ('h-feed',))
@@ -430,8 +591,211 @@ def _find_feed_items(feed_url, feed_doc):
   return feeditems
 
 
+def _mf2_parse(doc, url):
+  """Parses the parts of a page that we need, with :mod:`fast_mf2` if possible.
+
+  Falls back to the full mf2py parser if :const:`FAST_PARSE` is off, doc is
+  already a BeautifulSoup object, or its markup is too complicated for
+  :mod:`fast_mf2`.
+
+  Args:
+    doc: string HTML or BeautifulSoup object
+    url: string, the page's URL
+
+  Returns:
+    mf2 dict
+  """
+  if FAST_PARSE and isinstance(doc, basestring):
+    parsed = fast_mf2.parse(doc, url)
+    if parsed is not None:
+      return parsed
+  return util.mf2py_parse(doc, url)
+
+
+def _should_fetch_permalink(source, feed_entry):
+  """Returns True if we know up front that we'll need a permalink's page.
+
+  We also fetch it if the h-feed entry's u-syndication links don't yield any
+  relationships, but :func:`process_entry()` only finds that out later.
+  """
+  return (not feed_entry.get('properties', {}).get('syndication') and
+          (not source.last_feed_syndication_url or not feed_entry))
+
+
+def _prefetch_permalink(source, permalink, fetch, validators=None):
+  """Resolves a permalink and optionally fetches and parses its page.
+
+  Doesn't touch the datastore, so it's safe to run in parallel threads.
+
+  Args:
+    source: :class:`models.Source`
+    permalink: string url of the post
+    fetch: boolean, whether to fetch the page too
+    validators: :class:`models.FetchValidators` for the permalink, or None
+
+  Returns:
+    (string resolved permalink, boolean type_ok, mf2 dict or None, boolean
+    success or None, :class:`models.FetchValidators` or None) tuple. The last
+    three come from :func:`_fetch_permalink()`, or are all None if fetch is
+    False. Returns None instead if the page hasn't changed since validators.
+  """
+  resolved, _, type_ok = util.get_webmention_target(permalink)
+  parsed = success = new_validators = None
+  if fetch:
+    parsed, success, new_validators = _fetch_permalink(
+      source, resolved, type_ok, validators=validators)
+    if validators and type_ok and success and not new_validators:
+      return None
+    if new_validators:
+      # key by the original permalink, since that's what we look them up by
+      new_validators.key = ndb.Key(models.FetchValidators, permalink,
+                                   parent=source.key)
+
+  return resolved, type_ok, parsed, success, new_validators
+
+
+def _fetch_permalink(source, permalink, type_ok, validators=None):
+  """Fetches a permalink page and parses its microformats2.
+
+  Args:
+    source: :class:`models.Source`
+    permalink: string url of the post, already resolved
+    type_ok: boolean, whether the permalink is HTML, ie worth fetching
+    validators: :class:`models.FetchValidators`, if we want a conditional GET
+
+  Returns:
+    (mf2 dict or None, boolean success, :class:`models.FetchValidators` or
+    None) tuple. success is False if the fetch failed. The validators are new
+    and unsaved, and None if we didn't fetch or the page hasn't changed.
+  """
+  try:
+    logging.debug('fetching post permalink %s', permalink)
+    if type_ok:
+      resp, new_validators = _conditional_get(source, permalink, validators)
+      if not new_validators:
+        return None, True, None
+      return _mf2_parse(resp.text, permalink), True, new_validators
+  except AssertionError:
+    raise  # for unit tests
+  except BaseException:
+    # TODO limit the number of allowed failures
+    logging.info('Could not fetch permalink %s', permalink, exc_info=True)
+    return None, False, None
+
+  return None, True, None
+
+
+def _feeds_unchanged(source, feed_urls):
+  """Returns True if none of the given feeds have changed since we processed them.
+
+  Args:
+    source: :class:`models.Source`
+    feed_urls: sequence of string URLs
+  """
+  validators = _get_validators(source, feed_urls)
+  for url in feed_urls:
+    if url not in validators:
+      return False
+    try:
+      logging.debug("checking author's rel-feed %s", url)
+      _, new_validators = _conditional_get(source, url, validators[url])
+      if new_validators:
+        return False
+    except AssertionError:
+      raise  # for unit tests
+    except BaseException:
+      logging.info('Could not fetch h-feed url %s.', url, exc_info=True)
+      return False
+
+  return True
+
+
+def _get_validators(source, urls):
+  """Loads the stored, unexpired :class:`models.FetchValidators` for some URLs.
+
+  Always returns an empty dict if :const:`CONDITIONAL_GET` is off.
+
+  Args:
+    source: :class:`models.Source`
+    urls: sequence of string URLs
+
+  Returns:
+    dict mapping string URL to :class:`models.FetchValidators`
+  """
+  if not CONDITIONAL_GET:
+    return {}
+
+  min_updated = util.now_fn() - VALIDATORS_MAX_AGE
+  state = _source_state(source)
+  keys = [ndb.Key(models.FetchValidators, url, parent=source.key)
+          for url in urls if len(url) <= MAX_VALIDATORS_URL_LENGTH]
+  return {v.key.id(): v for v in ndb.get_multi(keys)
+          if v and v.updated >= min_updated and v.source_state == state}
+
+
+def _source_state(source):
+  """Returns a hash of the source properties that affect processing a page.
+
+  Pages can produce different results when these change even if the pages
+  themselves haven't, so validators stored under a different state are stale.
+  last_feed_syndication_url only matters when it goes from unset to set, so we
+  only include whether it's set. Otherwise every poll that found a link would
+  invalidate all of the source's validators.
+
+  Args:
+    source: :class:`models.Source`
+
+  Returns:
+    string SHA1 hex digest
+  """
+  state = json.dumps([sorted(source.domain_urls), sorted(source.domains),
+                      bool(source.last_feed_syndication_url)])
+  return hashlib.sha1(state).hexdigest()
+
+
+def _conditional_get(source, url, validators=None):
+  """Fetches a URL, conditionally if we have validators for it.
+
+  Args:
+    source: :class:`models.Source`
+    url: string
+    validators: :class:`models.FetchValidators`, or None to fetch
+      unconditionally
+
+  Returns:
+    (:class:`requests.Response`, :class:`models.FetchValidators` or None)
+    tuple. The validators are new and unsaved, to be stored after the page is
+    processed. They're None if the page hasn't changed since validators, ie it
+    returned HTTP 304 or the same body.
+
+  Raises:
+    :class:`requests.HTTPError` if the fetch fails
+  """
+  headers = validators.request_headers() if validators else None
+  # _conditional_get() runs in prefetch threads, so use this thread's session
+  session = util.http_session()
+  if headers:
+    resp = util.requests_get(url, session=session, headers=headers)
+  else:
+    resp = util.requests_get(url, session=session)
+
+  if resp.status_code == 304:
+    return resp, None
+  resp.raise_for_status()
+
+  body_hash = hashlib.sha1(resp.content).hexdigest()
+  if validators and validators.body_hash == body_hash:
+    return resp, None
+
+  return resp, models.FetchValidators(
+    parent=source.key, id=url, body_hash=body_hash,
+    etag=resp.headers.get('ETag'),
+    last_modified=resp.headers.get('Last-Modified'),
+    source_state=_source_state(source))
+
+
 def process_entry(source, permalink, feed_entry, refetch, preexisting,
-                  store_blanks=True):
+                  store_blanks=True, prefetched=None, writer=None):
   """Fetch and process an h-entry and save a new :class:`models.SyndicatedPost`.
 
   Args:
@@ -444,6 +808,12 @@ def process_entry(source, permalink, feed_entry, refetch, preexisting,
       for this permalink
     store_blanks: boolean, whether we should store blank
       :class:`models.SyndicatedPost`\ s when we don't find a relationship
+    prefetched: optional tuple returned by :func:`_prefetch_permalink()` for
+      this permalink. If not provided, resolves the permalink here, and fetches
+      it here if necessary.
+    writer: optional :class:`models.SyndicatedPostWriter`. If provided, queues
+      relationship changes in it instead of storing them here, and the caller
+      must flush it.
 
   Returns:
     a dict from syndicated url to a list of new :class:`models.SyndicatedPost`\ s
@@ -463,31 +833,23 @@ def process_entry(source, permalink, feed_entry, refetch, preexisting,
 
   # first try with the h-entry from the h-feed. if we find the syndication url
   # we're looking for, we don't have to fetch the permalink
-  permalink, _, type_ok = util.get_webmention_target(permalink)
+  if not prefetched:
+    prefetched = _prefetch_permalink(source, permalink, fetch=False)
+  permalink, type_ok, parsed, success, _ = prefetched
   usynd = feed_entry.get('properties', {}).get('syndication', [])
   if usynd:
     logging.debug('u-syndication links on the h-feed h-entry: %s', usynd)
   results = _process_syndication_urls(source, permalink, set(
-    url for url in usynd if isinstance(url, basestring)), preexisting)
-  success = True
+    url for url in usynd if isinstance(url, basestring)), preexisting,
+    writer=writer)
 
   if results:
     source.updates['last_feed_syndication_url'] = util.now_fn()
+    success = True
   elif not source.last_feed_syndication_url or not feed_entry:
     # fetch the full permalink page if we think it might have more details
-    parsed = None
-    try:
-      logging.debug('fetching post permalink %s', permalink)
-      if type_ok:
-        resp = util.requests_get(permalink)
-        resp.raise_for_status()
-        parsed = util.mf2py_parse(resp.text, permalink)
-    except AssertionError:
-      raise  # for unit tests
-    except BaseException:
-      # TODO limit the number of allowed failures
-      logging.info('Could not fetch permalink %s', permalink, exc_info=True)
-      success = False
+    if success is None:
+      parsed, success, _ = _fetch_permalink(source, permalink, type_ok)
 
     if parsed:
       syndication_urls = set()
@@ -506,15 +868,18 @@ def process_entry(source, permalink, feed_entry, refetch, preexisting,
         syndication_urls.update(url for url in usynd
                                 if isinstance(url, basestring))
       results = _process_syndication_urls(
-        source, permalink, syndication_urls, preexisting)
+        source, permalink, syndication_urls, preexisting, writer=writer)
 
   # detect and delete SyndicatedPosts that were removed from the site
-  if success:
+  if success is not False:
     result_syndposts = itertools.chain(*results.values())
     for syndpost in list(preexisting):
       if syndpost.syndication and syndpost not in result_syndposts:
         logging.info('deleting relationship that disappeared: %s', syndpost)
-        syndpost.key.delete()
+        if writer:
+          writer.delete(syndpost)
+        else:
+          syndpost.key.delete()
         preexisting.remove(syndpost)
 
   if not results:
@@ -526,7 +891,10 @@ def process_entry(source, permalink, feed_entry, refetch, preexisting,
       # particular source
       logging.debug('saving empty relationship so that %s will not be '
                     'searched again', permalink)
-      SyndicatedPost.insert_original_blank(source, permalink)
+      if writer:
+        writer.insert_original_blank(permalink)
+      else:
+        SyndicatedPost.insert_original_blank(source, permalink)
 
   # only return results that are not in the preexisting list
   new_results = {}
@@ -541,7 +909,7 @@ def process_entry(source, permalink, feed_entry, refetch, preexisting,
 
 
 def _process_syndication_urls(source, permalink, syndication_urls,
-                              preexisting):
+                              preexisting, writer=None):
   """Process a list of syndication URLs looking for one that matches the
   current source. If one is found, stores a new :class:`models.SyndicatedPost`
   in the db.
@@ -552,6 +920,8 @@ def _process_syndication_urls(source, permalink, syndication_urls,
     syndication_urls: a collection of strings. the unfitered list
       of syndication urls
     preexisting: a list of previously discovered :class:`models.SyndicatedPost`\ s
+    writer: optional :class:`models.SyndicatedPostWriter` to queue new
+      relationships in instead of storing them immediately
 
   Returns:
     dict mapping string syndication url to list of :class:`models.SyndicatedPost`\ s
@@ -577,8 +947,11 @@ def _process_syndication_urls(source, permalink, syndication_urls,
                          and sp.original == permalink), None)
     if not relationship:
       logging.debug('saving discovered relationship %s -> %s', url, permalink)
-      relationship = SyndicatedPost.insert(
-        source, syndication=url, original=permalink)
+      if writer:
+        relationship = writer.insert(syndication=url, original=permalink)
+      else:
+        relationship = SyndicatedPost.insert(
+          source, syndication=url, original=permalink)
     results.setdefault(url, []).append(relationship)
 
   return results
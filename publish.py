@@ -473,7 +473,7 @@ class Handler(webmention.WebmentionHandler):
         # special-cases to that method
         logging.debug('expand_target_urls fetching field=%s, url=%s', field, url)
         try:
-          resp = util.requests_get(url)
+          resp = util.requests_get(url, session=util.http_session())
           resp.raise_for_status()
           data = util.mf2py_parse(resp.text, url)
         except AssertionError:
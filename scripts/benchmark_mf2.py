@@ -0,0 +1,122 @@
+#!/usr/local/bin/python
+"""Benchmarks fast_mf2 against full mf2py parsing on a corpus of pages.
+
+For each HTML file, times fast_mf2.parse() (falling back to the full parser if
+it returns None, like original post discovery does) against
+util.mf2py_parse(), which builds a BeautifulSoup tree and runs mf2py. Checks
+that both extract the same h-entry structure, properties, and rels, and prints
+per page and total times and speedups.
+
+The default corpus in scripts/mf2_corpus/ has h-feeds and a permalink page
+marked up like WordPress with an mf2 theme, Known, and a static site generator.
+To benchmark against real pages, save them with e.g. curl and pass the files
+or directories on the command line, optionally with the URL they came from
+after a comma:
+
+  python scripts/benchmark_mf2.py [--runs 20] [FILE[,URL] | DIR ...]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import fast_mf2
+import util
+
+logging.getLogger().setLevel(logging.ERROR)
+
+CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'mf2_corpus')
+DEFAULT_URL = 'https://example.com/'
+
+PROPERTIES = ('url', 'syndication', 'published', 'updated')
+RELS = ('syndication', 'feed')
+
+
+def trim(items):
+  """Trims full mf2py items down to what fast_mf2 extracts."""
+  trimmed = []
+  for item in items:
+    new = {'type': item['type'],
+           'properties': {name: vals for name, vals in item['properties'].items()
+                          if name in PROPERTIES}}
+    if item.get('children'):
+      new['children'] = trim(item['children'])
+    trimmed.append(new)
+  return trimmed
+
+
+def extract(parsed):
+  """Returns the parts of a parsed mf2 dict that original post discovery uses."""
+  return trim(parsed['items']), {rel: parsed['rels'].get(rel) for rel in RELS}
+
+
+def pages(args):
+  """Yields (filename, URL) tuples from the command line args."""
+  for arg in args or [CORPUS_DIR]:
+    path, _, url = arg.partition(',')
+    if os.path.isdir(path):
+      for name in sorted(os.listdir(path)):
+        if name.endswith('.html') or name.endswith('.htm'):
+          yield os.path.join(path, name), url or DEFAULT_URL
+    else:
+      yield path, url or DEFAULT_URL
+
+
+def time_parse(fn, html, url, runs):
+  """Returns (result, average time in ms) of calling fn(html, url)."""
+  start = time.time()
+  for _ in range(runs):
+    result = fn(html, url)
+  return result, (time.time() - start) * 1000 / runs
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--runs', type=int, default=20,
+                      help='number of times to parse each page')
+  parser.add_argument('pages', nargs='*', metavar='FILE[,URL] | DIR',
+                      help='HTML files or directories of them, default %s' %
+                      CORPUS_DIR)
+  args = parser.parse_args()
+
+  print '%-32s %7s %9s %9s %8s' % ('page', 'KB', 'full ms', 'fast ms', 'speedup')
+  total_full = total_fast = 0
+  fallbacks = mismatches = 0
+
+  for filename, url in pages(args.pages):
+    with open(filename) as f:
+      html = f.read().decode('utf-8', 'replace')
+
+    fast, fast_ms = time_parse(fast_mf2.parse, html, url, args.runs)
+    note = ''
+    if fast is None:
+      # original post discovery falls back to the full parser, so count both
+      fast, fallback_ms = time_parse(util.mf2py_parse, html, url, args.runs)
+      fast_ms += fallback_ms
+      fallbacks += 1
+      note = ' (fell back)'
+
+    full, full_ms = time_parse(util.mf2py_parse, html, url, args.runs)
+    if extract(fast) != extract(full):
+      mismatches += 1
+      note += ' MISMATCH'
+
+    total_full += full_ms
+    total_fast += fast_ms
+    print '%-32s %7.1f %9.2f %9.2f %7.1fx%s' % (
+      os.path.basename(filename)[:32], len(html) / 1024.0, full_ms, fast_ms,
+      full_ms / fast_ms, note)
+
+  if total_fast:
+    print '%-32s %7s %9.2f %9.2f %7.1fx' % (
+      'total', '', total_full, total_fast, total_full / total_fast)
+  print '%d fell back to the full parser, %d mismatched' % (fallbacks, mismatches)
+  if mismatches:
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
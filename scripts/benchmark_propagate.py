@@ -0,0 +1,304 @@
+#!/usr/local/bin/python
+"""Benchmarks propagate task throughput against local stand-in receivers.
+
+Starts a local HTTP server that plays a set of webmention receivers, each on
+its own loopback address (127.0.0.1, 127.0.0.2, ...), so that per-domain limits
+and caches behave like they do against real sites. Target pages advertise their
+webmention endpoint in one of several discovery styles, and the server can add
+latency, endpoint errors, and redirects in front of target pages.
+
+Then creates synthetic Response and BlogPost entities that link to those
+targets and runs them through the PropagateResponse and PropagateBlogPost task
+handlers. Prints webmentions per second, p50/p99 latency for individual
+webmentions and whole tasks, and datastore RPCs per task.
+
+The datastore, memcache, and task queue are in process stubs, so absolute times
+aren't representative of production, but relative numbers between two versions
+of tasks.py are. Loopback addresses other than 127.0.0.1 work out of the box on
+Linux; on other OSes, use --receivers 1 or alias them first.
+
+Run from the repo root in the same environment as the unit tests:
+
+  python scripts/benchmark_propagate.py [--entities 50] [--targets 4] ...
+
+Run with --help for all options.
+"""
+import argparse
+import BaseHTTPServer
+import collections
+import json
+import logging
+import os
+import random
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+tb = testbed.Testbed()
+tb.activate()
+tb.init_datastore_v3_stub()
+tb.init_memcache_stub()
+tb.init_urlfetch_stub()
+tb.init_taskqueue_stub(root_path=os.path.join(os.path.dirname(__file__), '..'))
+
+import models
+import tasks
+from test.testutil import FakeSource
+import util
+
+logging.getLogger().setLevel(logging.ERROR)
+
+# how target pages advertise their webmention endpoint
+DISCOVERY_STYLES = ('header', 'relative-header', 'link', 'a', 'none')
+
+rpcs = collections.Counter()
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+  'benchmark_propagate',
+  lambda service, call, request, response: rpcs.update([call]),
+  'datastore_v3')
+
+
+class ReceiverHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves target pages, redirects, and webmention endpoints.
+
+  Paths:
+
+  * /page/STYLE/N: target page that advertises /endpoint in discovery STYLE
+  * /redirect/STYLE/N: 302 redirect to /page/STYLE/N
+  * /endpoint: webmention endpoint
+  """
+  protocol_version = 'HTTP/1.1'
+
+  # set by main()
+  latency = 0
+  error_rate = 0
+  random = random.Random()
+
+  def log_message(self, *args):
+    pass
+
+  def do_HEAD(self):
+    self.do_GET(body=False)
+
+  def do_GET(self, body=True):
+    self.sleep()
+    parts = urlparse.urlparse(self.path).path.strip('/').split('/')
+    if len(parts) != 3 or parts[1] not in DISCOVERY_STYLES:
+      return self.respond(404)
+
+    kind, style, n = parts
+    if kind == 'redirect':
+      return self.respond(302, headers={
+        'Location': 'http://%s/page/%s/%s' % (self.headers['Host'], style, n)})
+    elif kind != 'page':
+      return self.respond(404)
+
+    endpoint = 'http://%s/endpoint' % self.headers['Host']
+    headers = {'Content-Type': 'text/html; charset=utf-8'}
+    head = link = ''
+    if style == 'header':
+      headers['Link'] = '<%s>; rel="webmention"' % endpoint
+    elif style == 'relative-header':
+      headers['Link'] = '</endpoint>; rel="webmention"'
+    elif style == 'link':
+      head = '<link rel="webmention" href="%s" />' % endpoint
+    elif style == 'a':
+      link = '<a rel="webmention" href="/endpoint">webmentions</a>'
+
+    self.respond(200, headers=headers, body="""\
+<!DOCTYPE html>
+<html><head><title>Target %s</title>%s</head>
+<body><article class="h-entry"><p class="e-content">Target post %s</p>%s
+</article></body></html>
+""" % (n, head, n, link) if body else '')
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    self.sleep()
+    if self.path != '/endpoint':
+      return self.respond(404)
+    elif self.random.random() < self.error_rate:
+      return self.respond(500, body='Internal server error')
+    self.respond(202, body='Accepted')
+
+  def sleep(self):
+    if self.latency:
+      time.sleep(self.latency)
+
+  def respond(self, status, headers=None, body=''):
+    self.send_response(status)
+    for name, value in (headers or {}).items():
+      self.send_header(name, value)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    if body:
+      self.wfile.write(body)
+
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+
+send_times = []
+_send_webmention = tasks.SendWebmentions.send_webmention
+
+def timed_send_webmention(self, target, source_url):
+  """Wraps :meth:`tasks.SendWebmentions.send_webmention` to time each call."""
+  start = time.time()
+  try:
+    return _send_webmention(self, target, source_url)
+  finally:
+    send_times.append(time.time() - start)
+
+tasks.SendWebmentions.send_webmention = timed_send_webmention
+
+
+def percentile(times, pct):
+  """Returns the given percentile of a list of times, in ms."""
+  if not times:
+    return 0
+  times = sorted(times)
+  return times[min(len(times) - 1, int(len(times) * pct / 100.0))] * 1000
+
+
+def make_targets(args, port, rand):
+  """Returns a list of target URLs across receivers and discovery styles."""
+  styles = args.styles.split(',')
+  targets = []
+  for i in range(args.targets):
+    host = '127.0.0.%d:%d' % (rand.randrange(args.receivers) + 1, port)
+    kind = 'redirect' if rand.random() < args.redirect_rate else 'page'
+    targets.append('http://%s/%s/%s/%d' % (
+      host, kind, styles[i % len(styles)], rand.randrange(args.pages)))
+  return targets
+
+
+def make_responses(args, source, port, rand):
+  """Stores synthetic responses and returns their keys."""
+  responses = []
+  for i in range(args.entities):
+    id = 'tag:fa.ke,2013:%d_%d' % (i, i)
+    activity = {
+      'id': 'tag:fa.ke,2013:%d' % i,
+      'url': 'http://fa.ke/post/%d' % i,
+      'object': {'content': 'foo bar'},
+    }
+    responses.append(models.Response(
+      id=id, source=source.key, type='comment',
+      activities_json=[json.dumps(activity)],
+      response_json=json.dumps({'objectType': 'comment', 'id': id,
+                                'content': 'foo bar'}),
+      unsent=make_targets(args, port, rand)))
+  return ndb.put_multi(responses)
+
+
+def make_blogposts(args, source, port, rand):
+  """Stores synthetic blog posts and returns their keys."""
+  return ndb.put_multi(
+    models.BlogPost(id='http://fake.blog/post/%d' % i, source=source.key,
+                    unsent=make_targets(args, port, rand))
+    for i in range(args.entities))
+
+
+def run(label, path, param, keys, cold):
+  """Runs a task for each key and prints the results."""
+  del send_times[:]
+  task_times = []
+  rpcs.clear()
+  statuses = collections.Counter()
+
+  start = time.time()
+  for key in keys:
+    if cold:
+      memcache.flush_all()
+      util._webmention_endpoints.clear()
+      ndb.delete_multi(util.WebmentionEndpoint.query().iter(keys_only=True))
+
+    task_start = time.time()
+    resp = tasks.application.get_response(
+      path, method='POST', POST={param: key.urlsafe()})
+    task_times.append(time.time() - task_start)
+    statuses[resp.status_int] += 1
+  elapsed = time.time() - start
+
+  entities = ndb.get_multi(keys)
+  sent = sum(len(e.sent) for e in entities)
+  per_task = lambda n: float(n) / len(keys)
+  print '%s: %d tasks (HTTP %s), %d/%d webmentions sent' % (
+    label, len(keys),
+    ', '.join('%s x%d' % (s, n) for s, n in sorted(statuses.items())),
+    sent, len(send_times))
+  print '  %.1f webmentions/s, %.2fs total' % (len(send_times) / elapsed, elapsed)
+  print '  webmention latency p50 %.1fms p99 %.1fms' % (
+    percentile(send_times, 50), percentile(send_times, 99))
+  print '  task latency p50 %.1fms p99 %.1fms' % (
+    percentile(task_times, 50), percentile(task_times, 99))
+  print '  datastore RPCs per task: %s' % ', '.join(
+    '%s %.1f' % (call, per_task(n)) for call, n in sorted(rpcs.items()))
+  print
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--entities', type=int, default=50,
+                      help='number of responses and blog posts to propagate')
+  parser.add_argument('--targets', type=int, default=4,
+                      help='webmention targets per entity')
+  parser.add_argument('--receivers', type=int, default=4,
+                      help='number of receiver domains')
+  parser.add_argument('--pages', type=int, default=20,
+                      help='number of distinct target pages per discovery style')
+  parser.add_argument('--styles', default=','.join(DISCOVERY_STYLES),
+                      help='comma separated endpoint discovery styles, any of %s'
+                      % ', '.join(DISCOVERY_STYLES))
+  parser.add_argument('--latency', type=float, default=20,
+                      help='receiver latency per HTTP request, in ms')
+  parser.add_argument('--error-rate', type=float, default=0,
+                      help='fraction of webmention POSTs that return HTTP 500')
+  parser.add_argument('--redirect-rate', type=float, default=0,
+                      help='fraction of targets that redirect to their page')
+  parser.add_argument('--cold', action='store_true',
+                      help='clear webmention endpoint caches before each task')
+  parser.add_argument('--seed', type=int, default=0, help='random seed')
+  args = parser.parse_args()
+
+  for style in args.styles.split(','):
+    if style not in DISCOVERY_STYLES:
+      parser.error('unknown discovery style %s' % style)
+
+  rand = random.Random(args.seed)
+  ReceiverHandler.latency = args.latency / 1000
+  ReceiverHandler.error_rate = args.error_rate
+  ReceiverHandler.random = random.Random(args.seed)
+
+  server = ThreadingServer(('', 0), ReceiverHandler)
+  port = server.server_address[1]
+  thread = threading.Thread(target=server.serve_forever)
+  thread.daemon = True
+  thread.start()
+
+  source = FakeSource.new(None, features=['listen'], domains=['fake.blog'])
+  source.put()
+
+  print 'Receivers on 127.0.0.1-%d port %d, %.0fms latency\n' % (
+    args.receivers, port, args.latency)
+  run('PropagateResponse', '/_ah/queue/propagate', 'response_key',
+      make_responses(args, source, port, rand), args.cold)
+  run('PropagateBlogPost', '/_ah/queue/propagate-blogpost', 'key',
+      make_blogposts(args, source, port, rand), args.cold)
+
+  server.shutdown()
+
+
+if __name__ == '__main__':
+  main()
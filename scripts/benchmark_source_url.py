@@ -0,0 +1,117 @@
+#!/usr/local/bin/python
+"""Benchmarks generating source URLs for responses with many targets.
+
+Compares the old PropagateResponse.source_url(), which re-parsed
+urls_to_activity and the activity's tag URI and fetched the source for every
+target, with the current one, which builds each activity's source URL once per
+response in prepare_source_urls(). Prints wall clock time and datastore RPCs
+per response.
+
+Run from the repo root in the same environment as the unit tests:
+
+  python scripts/benchmark_source_url.py [NUM_TARGETS] [NUM_ACTIVITIES]
+"""
+import collections
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import testbed
+import webapp2
+
+tb = testbed.Testbed()
+tb.activate()
+tb.init_datastore_v3_stub()
+tb.init_memcache_stub()
+
+import models
+import tasks
+from test.testutil import FakeSource
+import util
+
+logging.getLogger().setLevel(logging.ERROR)
+
+RUNS = 100
+
+rpcs = collections.Counter()
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+  'benchmark_source_url',
+  lambda service, call, request, response: rpcs.update([call]),
+  'datastore_v3')
+
+
+def old_source_url(handler, target_url):
+  """The old per-target PropagateResponse.source_url()."""
+  activity = handler.activities[0]
+  if handler.entity.urls_to_activity:
+    urls_to_activity = json.loads(handler.entity.urls_to_activity)
+    if urls_to_activity:
+      activity = handler.activities[urls_to_activity[target_url]]
+
+  id = activity['id']
+  parsed = util.parse_tag_uri(id)
+  post_id = parsed[1] if parsed else id
+  source = handler.entity.source.get()
+  path = [handler.request.host_url, handler.entity.type, source.SHORT_NAME,
+          handler.entity.source.string_id(), post_id]
+  _, response_id = util.parse_tag_uri(handler.entity.key.string_id())
+  path.append(response_id)
+  return '/'.join(path)
+
+
+def new_source_urls(handler, targets):
+  handler.prepare_source_urls()
+  return [handler.source_url(target) for target in targets]
+
+
+def run(label, fn, handler, targets):
+  rpcs.clear()
+  start = time.time()
+  for _ in range(RUNS):
+    urls = fn(handler, targets)
+  per_run = lambda n: float(n) / RUNS
+  print '%-8s %8.3fms  %s' % (
+    label, per_run((time.time() - start) * 1000),
+    ', '.join('%s %.1f' % (call, per_run(n)) for call, n in sorted(rpcs.items()))
+    or 'no RPCs')
+  return urls
+
+
+def main():
+  num_targets = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+  num_activities = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+  source = FakeSource.new(None)
+  source.put()
+
+  activities = [{'id': 'tag:fa.ke,2013:%d' % i} for i in range(num_activities)]
+  targets = ['http://target/%d' % i for i in range(num_targets)]
+  response = models.Response(
+    id='tag:fa.ke,2013:0_123', source=source.key, type='comment',
+    activities_json=[json.dumps(a) for a in activities],
+    urls_to_activity=json.dumps({t: i % num_activities
+                                 for i, t in enumerate(targets)}),
+    unsent=targets)
+  response.put()
+
+  handler = tasks.PropagateResponse(webapp2.Request.blank('/'),
+                                    webapp2.Response())
+  handler.entity = response
+  handler.load_source()
+  handler.activities = activities
+
+  print 'Per response, %d targets over %d activities:\n' % (
+    num_targets, num_activities)
+  old = run('old', lambda h, ts: [old_source_url(h, t) for t in ts],
+            handler, targets)
+  new = run('new', new_source_urls, handler, targets)
+  assert old == new, 'Source URLs differ!'
+
+
+if __name__ == '__main__':
+  main()
@@ -81,6 +81,7 @@ def handle_feed(feed, source):
     logging.info("Dropping because source doesn't have webmention feature")
     return
 
+  blogposts = []
   for item in json.loads(feed).get('items', []):
     url = item.get('permalinkUrl') or item.get('id')
     if not url:
@@ -108,7 +109,9 @@ def handle_feed(feed, source):
     else:
       bp = models.BlogPost(id=url, source=source.key, feed_item=item, unsent=links)
 
-    bp.get_or_save()
+    blogposts.append(bp)
+
+  models.BlogPost.get_or_save_multi(blogposts)
 
 
 class NotifyHandler(util.Handler):
@@ -3,18 +3,20 @@
 """
 import bz2
 import calendar
+import collections
 import copy
 import datetime
-import gc
 import itertools
 import json
 import logging
 import random
+import sys
+import time
 import urlparse
 
 from oauth_dropins.webutil import logs
-from google.appengine.api import memcache
 from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
 from google.appengine.api.datastore_types import _MAX_STRING_LENGTH
 from google.appengine.ext import ndb
 from granary import source as gr_source
@@ -39,7 +41,6 @@ import twitter
 import util
 import wordpress_rest
 
-WEBMENTION_DISCOVERY_CACHE_TIME = 60 * 60 * 2  # 2h
 
 
 class Poll(webapp2.RequestHandler):
@@ -48,7 +49,8 @@ class Poll(webapp2.RequestHandler):
   Request parameters:
 
   * source_key: string key of source entity
-  * last_polled: timestamp, YYYY-MM-DD-HH-MM-SS
+  * last_polled: timestamp, YYYY-MM-DD-HH-MM-SS. Omitted by tasks from
+    cron.DispatchPolls, which are dropped if the source isn't due yet.
 
   Inserts a propagate task for each response that hasn't been seen before.
 
@@ -62,6 +64,11 @@ class Poll(webapp2.RequestHandler):
   1-4 are in backfeed(); 5 is in poll().
   """
   RESTART_EXISTING_TASKS = False  # overridden in Discover
+  # backfeed stores new responses in chunks of this many
+  BACKFEED_CHUNK_SIZE = 50
+  # max concurrent original post discovery threads per web site, so that one
+  # slow site can't tie up the whole pool
+  OPD_MAX_PER_HOST = 2
 
   def _last_poll_url(self, source):
     return '%s/%s' % (self.request.host_url,
@@ -78,24 +85,38 @@ class Poll(webapp2.RequestHandler):
     logging.info('Source: %s %s, %s', source.label(), source.key.string_id(),
                  source.bridgy_url(self))
 
-    last_polled = self.request.params['last_polled']
-    if last_polled != source.last_polled.strftime(util.POLL_TASK_DATETIME_FORMAT):
-      logging.warning('duplicate poll task! deferring to the other task.')
+    last_polled = self.request.get('last_polled')
+    if last_polled:
+      if last_polled != source.last_polled.strftime(util.POLL_TASK_DATETIME_FORMAT):
+        logging.warning('duplicate poll task! deferring to the other task.')
+        return
+    # a failed poll pushes next_poll_at out, so let the queue's retries of
+    # scheduled tasks through anyway, like it retries self-scheduled ones.
+    elif (source.next_poll_at and source.next_poll_at > util.now_fn() and
+          self.request.headers.get('X-AppEngine-TaskRetryCount', '0') == '0'):
+      logging.warning('scheduled poll task, but not due until %s. dropping.',
+                      source.next_poll_at)
+      memcache.delete(util.poll_dispatch_marker(source.key))
       return
 
     logging.info('Last poll: %s', self._last_poll_url(source))
 
-    # mark this source as polling
+    # mark this source as polling. push next_poll_at out so the scheduler
+    # doesn't start another poll while this one is running.
+    now = util.now_fn()
     source.updates = {
       'poll_status': 'polling',
-      'last_poll_attempt': util.now_fn(),
+      'last_poll_attempt': now,
       'rate_limited': False,
+      'next_poll_at': now + source.POLL_LEASE,
     }
     source = models.Source.put_updates(source)
 
     source.updates = {}
+    start = time.time()
     try:
-      self.poll(source)
+      with util.collect_stats() as stats:
+        self.poll(source)
     except Exception, e:
       source.updates['poll_status'] = 'error'
       code, body = util.interpret_http_exception(e)
@@ -124,16 +145,38 @@ class Poll(webapp2.RequestHandler):
       else:
         raise
     finally:
+      source.updates['next_poll_at'] = self._next_poll_at(source)
       source = models.Source.put_updates(source)
+      if source.USE_POLL_SCHEDULER:
+        # let the scheduler add our next task as soon as we're due again
+        memcache.delete(util.poll_dispatch_marker(source.key))
+      if random.random() < models.PollStats.SAMPLE_RATE:
+        try:
+          models.PollStats.record(source, stats,
+                                  int((time.time() - start) * 1000))
+        except Exception:
+          logging.warning("Couldn't store poll stats", exc_info=True)
 
-    # add new poll task. randomize task ETA to within +/- 20% to try to spread
-    # out tasks and prevent thundering herds.
-    task_countdown = source.poll_period().total_seconds() * random.uniform(.8, 1.2)
-    util.add_poll_task(source, countdown=task_countdown)
+    # add new poll task, unless the scheduler will.
+    if not source.USE_POLL_SCHEDULER:
+      task_countdown = (source.next_poll_at - util.now_fn()).total_seconds()
+      util.add_poll_task(source, countdown=task_countdown)
 
-    # feeble attempt to avoid hitting the instance memory limit
-    source = None
-    gc.collect()
+  @staticmethod
+  def _next_poll_at(source):
+    """Returns when to poll a source next, as a :class:`datetime.datetime`.
+
+    Randomizes within +/- 20% of its poll period to try to spread out polls and
+    prevent thundering herds.
+
+    Args:
+      source: :class:`models.Source`. Pending source.updates are taken into
+        account, e.g. rate_limited.
+    """
+    for name, val in source.updates.items():
+      setattr(source, name, val)
+    period = source.poll_period().total_seconds() * random.uniform(.8, 1.2)
+    return util.now_fn() + datetime.timedelta(seconds=period)
 
   def poll(self, source):
     """Actually runs the poll.
@@ -153,19 +196,39 @@ class Poll(webapp2.RequestHandler):
     if source.last_activities_cache_json:
       cache.update(json.loads(source.last_activities_cache_json))
 
-    # search for links first so that the user's activities and responses
-    # override them if they overlap
-    links = source.search_for_links()
-
-    # this user's own activities (and user mentions)
-    resp = source.get_activities_response(
-      fetch_replies=True, fetch_likes=True, fetch_shares=True,
-      fetch_mentions=True, count=50, etag=source.last_activities_etag,
-      min_id=source.last_activity_id, cache=cache)
+    # incremental polls only fetch responses for posts whose summary changed.
+    # every so often, we do a full poll instead.
+    incremental = (source.INCREMENTAL_POLL and
+                   source.last_activities_summary_json is not None and
+                   util.now_fn() < source.last_full_poll + source.FULL_POLL_PERIOD)
+    fetch_responses = not incremental
+
+    # the silo calls don't depend on each other, so run them concurrently.
+    # results come back in this order, which is also their precedence order.
+    def search():
+      # links to the user's web site(s)
+      with util.phase('search'):
+        return source.search_for_links()
+
+    def fetch_activities():
+      # this user's own activities (and user mentions)
+      with util.phase('fetch'):
+        return source.get_activities_response(
+          fetch_replies=fetch_responses, fetch_likes=fetch_responses,
+          fetch_shares=fetch_responses, fetch_mentions=True, count=50,
+          etag=source.last_activities_etag, min_id=source.last_activity_id,
+          cache=cache)
+
+    links, resp = self.fetch(source, [search, fetch_activities])
     etag = resp.get('etag')  # used later
     user_activities = resp.get('items', [])
+    if source.INCREMENTAL_POLL:
+      with util.phase('fetch'):
+        user_activities, summaries = self.refresh_changed(
+          source, user_activities, incremental)
 
-    # these map ids to AS objects
+    # these map ids to AS objects. links go first so that the user's
+    # activities and responses override them if they overlap.
     responses = {a['id']: a for a in links}
     activities = {a['id']: a for a in links + user_activities}
 
@@ -195,10 +258,24 @@ class Poll(webapp2.RequestHandler):
     source.updates['last_activities_cache_json'] = json.dumps(
       {k: v for k, v in cache.items() if k.split()[-1] in silo_activity_ids})
 
-    self.backfeed(source, responses, activities=activities)
-
-    source.updates.update({'last_polled': source.last_poll_attempt,
-                           'poll_status': 'ok'})
+    last_public_post = (source.last_public_post or util.EPOCH).isoformat()
+    num_responses = self.backfeed(source, responses, activities=activities,
+                                  incremental=incremental)
+    if source.INCREMENTAL_POLL:
+      # only now that the changed posts' responses are stored. if anything
+      # before this failed, the next poll will see them as changed again.
+      self.store_summaries(source, summaries, incremental)
+
+    # track how often we find new things, for adaptive poll periods
+    num_posts = len([a for a in user_activities
+                     if a.get('published', util.EPOCH_ISO) > last_public_post
+                     and source.is_activity_public(a)])
+    source.updates.update({
+      'last_polled': source.last_poll_attempt,
+      'poll_status': 'ok',
+      'poll_stats': source.update_poll_stats(source.last_poll_attempt,
+                                             num_responses, num_posts),
+    })
     if etag and etag != source.last_activities_etag:
       source.updates['last_activities_etag'] = etag
 
@@ -211,7 +288,8 @@ class Poll(webapp2.RequestHandler):
     # *ever* published a rel=syndication url
     if source.should_refetch():
       logging.info('refetching h-feed for source %s', source.label())
-      relationships = original_post_discovery.refetch(source)
+      with util.phase('refetch'):
+        relationships = original_post_discovery.refetch(source)
 
       now = util.now_fn()
       source.updates['last_hfeed_refetch'] = now
@@ -233,15 +311,145 @@ class Poll(webapp2.RequestHandler):
           'skipping refetch h-feed. last-syndication-url %s, last-refetch %s',
           source.last_syndication_url, source.last_hfeed_refetch)
 
-  def backfeed(self, source, responses=None, activities=None):
+  @staticmethod
+  def fetch(source, fetches):
+    """Runs a poll's independent silo fetches concurrently.
+
+    Args:
+      source: :class:`models.Source`
+      fetches: sequence of callables that take no arguments
+
+    Returns:
+      list of the fetches' return values, in the same order
+    """
+    logging.debug('Running %d fetches for %s', len(fetches), source.label())
+    return util.map_in_parallel(lambda fetch: fetch(), fetches)
+
+  def refresh_changed(self, source, activities, incremental):
+    """Fetches responses for activities whose summaries have changed.
+
+    Doesn't store the new summaries. Pass them to :meth:`store_summaries()`
+    once the activities' responses are stored.
+
+    Args:
+      source: :class:`models.Source`
+      activities: sequence of AS activity dicts. For incremental polls, fetched
+        without responses.
+      incremental: boolean, whether this is an incremental poll
+
+    Returns:
+      (activities, summaries) tuple. activities is a list of AS activity dicts,
+      the input activities with changed ones replaced by versions with
+      responses. summaries is a dict mapping activity id to
+      :meth:`models.Source.activity_summary()`.
+    """
+    summaries = {a['id']: source.activity_summary(a) for a in activities}
+    if not incremental:
+      return activities, summaries
+
+    last_summaries = json.loads(source.last_activities_summary_json)
+    changed = [a for a in activities
+               if last_summaries.get(a['id']) != summaries[a['id']]]
+    logging.info('Incremental poll; fetching responses for %d of %d activities',
+                 len(changed), len(activities))
+
+    def refresh(activity):
+      parsed = util.parse_tag_uri(activity['id'])
+      if not parsed:
+        return activity
+      fetched = source.get_activities(
+        fetch_replies=True, fetch_likes=True, fetch_shares=True,
+        activity_id=parsed[1], user_id=source.key.id())
+      return fetched[0] if fetched else activity
+
+    refreshed = dict(zip([a['id'] for a in changed],
+                         util.map_in_parallel(refresh, changed)))
+    return [refreshed.get(a['id'], a) for a in activities], summaries
+
+  @staticmethod
+  def store_summaries(source, summaries, incremental):
+    """Merges new activity summaries into the source's stored ones.
+
+    Polls often return only some posts, e.g. when the etag matches or with
+    min_id, so the other posts' summaries are kept. Keeps the
+    :attr:`models.Source.MAX_ACTIVITY_SUMMARIES` most recently updated ones.
+    Stores them in source.updates, and for full polls, the time.
+
+    Args:
+      source: :class:`models.Source`
+      summaries: dict mapping activity id to summary, from
+        :meth:`refresh_changed()`
+      incremental: boolean, whether this is an incremental poll
+    """
+    stored = collections.OrderedDict()
+    if source.last_activities_summary_json:
+      stored = json.loads(source.last_activities_summary_json,
+                          object_pairs_hook=collections.OrderedDict)
+
+    for id, summary in summaries.items():
+      stored.pop(id, None)
+      stored[id] = summary
+    while len(stored) > source.MAX_ACTIVITY_SUMMARIES:
+      stored.popitem(last=False)
+
+    source.updates['last_activities_summary_json'] = json.dumps(stored)
+    if not incremental:
+      source.updates['last_full_poll'] = util.now_fn()
+
+  def discover_originals(self, source, activities, fetched_hfeeds,
+                         preloaded=None):
+    """Runs original post discovery on activities in parallel.
+
+    Stores the discovered URLs in each activity's originals and mentions fields.
+
+    Args:
+      source: :class:`models.Source`
+      activities: sequence of AS activity dicts
+      fetched_hfeeds: set of author URLs whose h-feeds we've already fetched
+        during this poll. shared by all of the discovery threads.
+      preloaded: dict, optional, stored relationships from
+        :func:`original_post_discovery.preload_syndicated_posts()`
+    """
+    def discover(activity):
+      activity['originals'], activity['mentions'] = \
+        original_post_discovery.discover(
+          source, activity, fetch_hfeed=True, include_redirect_sources=False,
+          already_fetched_hfeeds=fetched_hfeeds, preloaded=preloaded)
+
+    def host(activity):
+      # discovery mostly fetches the activity's links, so group by the first
+      # one's domain. activities without links just fetch the author's h-feed.
+      obj = activity.get('object') or activity
+      links = util.extract_links(obj.get('content'))
+      return util.domain_from_link(links[0]) if links else None
+
+    if activities:
+      logging.info('Running original post discovery on %d activities',
+                   len(activities))
+    util.map_in_parallel(discover, activities, key=host,
+                         max_per_key=self.OPD_MAX_PER_HOST)
+
+  def backfeed(self, source, responses=None, activities=None, incremental=False):
     """Processes responses and activities and generates propagate tasks.
 
     Stores property names and values to update in source.updates.
 
+    Runs as a pipeline: classify activities as public or private, extract and
+    dedupe their responses, filter out responses we've already seen, then run
+    original post discovery and store the rest in chunks. Responses refer to
+    their activities by id, not directly, so none of this creates circular
+    references, and each chunk can be freed by refcounting as soon as it's
+    stored.
+
     Args:
       source: Source
       responses: dict mapping AS response id to AS object
       activities: dict mapping AS activity id to AS object
+      incremental: boolean, whether responses were only fetched for some
+        activities. If so, keeps the seen responses for the others.
+
+    Returns:
+      integer, number of new or changed responses
     """
     if responses is None:
       responses = {}
@@ -253,6 +461,130 @@ class Poll(webapp2.RequestHandler):
     fetched_hfeeds = set()
 
     # narrow down to just public activities
+    with util.phase('classify'):
+      public = self._public_activities(source, activities)
+
+    # look up stored relationships for all of the poll's syndication URLs at
+    # once, instead of one query per activity during original post discovery
+    with util.phase('preload'):
+      preloaded = original_post_discovery.preload_syndicated_posts(
+        source, public.values())
+
+    #
+    # Step 2: extract responses and dedupe them. resp_activities maps response
+    # id to the ids of its activities, most preferred first.
+    #
+    resp_activities = {}
+    with util.phase('extract'):
+      for resp, activity_id in self._extract_responses(
+          source, public, fetched_hfeeds, preloaded=preloaded):
+        id = resp['id']
+        if activity_id is None:
+          # the activity is itself the response, e.g. a user mention
+          resp_activities.pop(id, None)
+          responses[id] = resp
+          continue
+
+        # when we find two responses with the same id, the earlier one may have
+        # come from a link post or user mention, and this one is probably better
+        # since it probably came from the user's activity, so prefer this one.
+        # background: https://github.com/snarfed/bridgy/issues/533
+        activity_ids = [activity_id]
+        existing = responses.get(id)
+        if existing:
+          if source.gr_source.activity_changed(resp, existing, log=True):
+            logging.warning('Got two different versions of same response!\n%s\n%s',
+                            existing, resp)
+          activity_ids.extend(resp_activities.get(id, []))
+
+        resp_activities[id] = activity_ids
+        responses[id] = resp
+
+    #
+    # Step 3: filter out responses we've already seen
+    #
+    # fingerprints of seen responses for each source are stored in its entity.
+    with util.phase('dedupe'):
+      seen = source.seen_response_fingerprints
+      if seen is None and source.seen_responses_cache_json:
+        # migrate from the old cache of full response JSON objects
+        seen = {r['id']: util.response_fingerprint(r)
+                for r in json.loads(source.seen_responses_cache_json)}
+        source.updates.update({
+          'seen_response_fingerprints': seen,
+          'seen_responses_cache_json': None,
+        })
+
+      fingerprints = {id: util.response_fingerprint(resp)
+                      for id, resp in responses.items()}
+      if seen:
+        for id, fingerprint in fingerprints.items():
+          if seen.get(id) == fingerprint:
+            del responses[id]
+            resp_activities.pop(id, None)
+
+    num_new = len(responses)
+
+    #
+    # Step 4: store new responses and enqueue propagate tasks
+    #
+    # we'll usually have multiple responses for the same activity, so run
+    # original post discovery once per activity, all in parallel, and cache
+    # each activity's discovered webmention targets inside its object.
+    with util.phase('opd'):
+      undiscovered = []
+      for id, resp in responses.items():
+        for activity in ([public[a] for a in resp_activities.get(id, [])] or
+                         [resp]):
+          if (('originals' not in activity or 'mentions' not in activity) and
+              (activity is not resp or Response.get_type(resp) == 'post') and
+              not any(activity is a for a in undiscovered)):
+            undiscovered.append(activity)
+      self.discover_originals(source, undiscovered, fetched_hfeeds,
+                              preloaded=preloaded)
+
+    unstored = set(responses.keys())
+    try:
+      with util.phase('store'):
+        ids = responses.keys()
+        for i in range(0, len(ids), self.BACKFEED_CHUNK_SIZE):
+          chunk = ids[i:i + self.BACKFEED_CHUNK_SIZE]
+          resp_entities = [
+            self._response_entity(source, responses.pop(id),
+                                  [public[a] for a in resp_activities.pop(id, [])])
+            for id in chunk]
+          Response.get_or_save_multi(source, resp_entities,
+                                     restart=self.RESTART_EXISTING_TASKS)
+          unstored.difference_update(chunk)
+    finally:
+      # update cache, even if storing failed partway, but only with responses
+      # that were stored along with their propagate tasks. the rest will look
+      # new again next poll.
+      if num_new:
+        for id in unstored:
+          if seen and id in seen:
+            fingerprints[id] = seen[id]
+          else:
+            fingerprints.pop(id, None)
+        if incremental and seen:
+          seen.update(fingerprints)
+          fingerprints = seen
+        source.updates['seen_response_fingerprints'] = fingerprints
+
+    return num_new
+
+  def _public_activities(self, source, activities):
+    """Returns just the public activities. Updates public and private post stats.
+
+    Stores last_public_post and recent_private_posts in source.updates.
+
+    Args:
+      source: :class:`models.Source`
+      activities: dict mapping AS activity id to AS object
+
+    Returns:
+      dict mapping AS activity id to AS object
+    """
     public = {}
     private = {}
     for id, activity in activities.items():
@@ -273,19 +605,32 @@ class Poll(webapp2.RequestHandler):
       len([a for a in private.values()
            if a.get('published', util.EPOCH_ISO) > last_public_post])
 
-    #
-    # Step 2: extract responses, store their activities in response['activities']
-    #
-    # WARNING: this creates circular references in link posts found by search
-    # queries in step 1, since they are their own activity. We use
-    # prune_activity() and prune_response() in step 4 to remove these before
-    # serializing to JSON.
-    #
-    for id, activity in public.items():
+    return public
+
+  def _extract_responses(self, source, activities, fetched_hfeeds,
+                         preloaded=None):
+    """Generates the responses in activities, one activity at a time.
+
+    Generates (response, activity id) tuples. For user mentions and quote
+    mentions, the activity is itself the response, so this generates
+    (activity, None) instead.
+
+    Skips responses without ids and responses by blocked users.
+
+    Args:
+      source: :class:`models.Source`
+      activities: dict mapping AS activity id to AS object
+      fetched_hfeeds: set of h-feed URLs already fetched, passed through to
+        original post discovery
+      preloaded: dict, optional, stored relationships, passed through to
+        original post discovery
+    """
+    for id, activity in activities.items():
       obj = activity.get('object') or activity
 
       # handle user mentions
       user_id = source.user_tag_id()
+      mentioned = False
       if obj.get('author', {}).get('id') != user_id:
         for tag in obj.get('tags', []):
           urls = tag.get('urls')
@@ -294,9 +639,9 @@ class Poll(webapp2.RequestHandler):
               original_post_discovery.discover(
                 source, activity, fetch_hfeed=True,
                 include_redirect_sources=False,
-                already_fetched_hfeeds=fetched_hfeeds)
+                already_fetched_hfeeds=fetched_hfeeds, preloaded=preloaded)
             activity['mentions'].update(u.get('value') for u in urls)
-            responses[id] = activity
+            mentioned = True
             break
 
       # handle quote mentions
@@ -310,10 +655,13 @@ class Poll(webapp2.RequestHandler):
               original_post_discovery.discover(
                 source, activity, fetch_hfeed=True,
                 include_redirect_sources=False,
-                already_fetched_hfeeds=fetched_hfeeds)
-          responses[id] = activity
+                already_fetched_hfeeds=fetched_hfeeds, preloaded=preloaded)
+          mentioned = True
           break
 
+      if mentioned:
+        yield activity, None
+
       # extract replies, likes, reactions, reposts, and rsvps
       replies = obj.get('replies', {}).get('items', [])
       tags = obj.get('tags', [])
@@ -322,10 +670,9 @@ class Poll(webapp2.RequestHandler):
       reposts = [t for t in tags if Response.get_type(t) == 'repost']
       rsvps = Source.get_rsvps_from_event(obj)
 
-      # coalesce responses. drop any without ids
+      # drop any without ids
       for resp in replies + likes + reactions + reposts + rsvps:
-        id = resp.get('id')
-        if not id:
+        if not resp.get('id'):
           logging.error('Skipping response without id: %s', json.dumps(resp, indent=2))
           continue
 
@@ -334,92 +681,49 @@ class Poll(webapp2.RequestHandler):
                        json.dumps(resp.get('author') or resp.get('actor'), indent=2))
           continue
 
-        resp.setdefault('activities', []).append(activity)
+        yield resp, id
 
-        # when we find two responses with the same id, the earlier one may have
-        # come from a link post or user mention, and this one is probably better
-        # since it probably came from the user's activity, so prefer this one.
-        # background: https://github.com/snarfed/bridgy/issues/533
-        existing = responses.get(id)
-        if existing:
-          if source.gr_source.activity_changed(resp, existing, log=True):
-            logging.warning('Got two different versions of same response!\n%s\n%s',
-                            existing, resp)
-          resp['activities'].extend(existing.get('activities', []))
-
-        responses[id] = resp
+  def _response_entity(self, source, resp, activities):
+    """Returns a new, unsaved :class:`models.Response` for a response.
 
-    #
-    # Step 3: filter out responses we've already seen
-    #
-    # seen responses (JSON objects) for each source are stored in its entity.
-    unchanged_responses = []
-    if source.seen_responses_cache_json:
-      for seen in json.loads(source.seen_responses_cache_json):
-        id = seen['id']
-        resp = responses.get(id)
-        if resp and not source.gr_source.activity_changed(seen, resp, log=True):
-          unchanged_responses.append(seen)
-          del responses[id]
-
-    #
-    # Step 4: store new responses and enqueue propagate tasks
-    #
-    pruned_responses = []
-    for id, resp in responses.items():
-      resp_type = Response.get_type(resp)
-      activities = resp.pop('activities', [])
-      if not activities and resp_type == 'post':
-        activities = [resp]
-      too_long = set()
-      urls_to_activity = {}
-      for i, activity in enumerate(activities):
-        # we'll usually have multiple responses for the same activity, and the
-        # objects in resp['activities'] are shared, so cache each activity's
-        # discovered webmention targets inside its object.
-        if 'originals' not in activity or 'mentions' not in activity:
-          activity['originals'], activity['mentions'] = \
-            original_post_discovery.discover(
-              source, activity, fetch_hfeed=True,
-              include_redirect_sources=False,
-              already_fetched_hfeeds=fetched_hfeeds)
-
-        targets = original_post_discovery.targets_for_response(
-          resp, originals=activity['originals'], mentions=activity['mentions'])
-        if targets:
-          logging.info('%s has %d webmention target(s): %s', activity.get('url'),
-                       len(targets), ' '.join(targets))
-        for t in targets:
-          if len(t) <= _MAX_STRING_LENGTH:
-            urls_to_activity[t] = i
-          else:
-            logging.info('Giving up on target URL over %s chars! %s',
-                         _MAX_STRING_LENGTH, t)
-            too_long.add(t[:_MAX_STRING_LENGTH - 4] + '...')
-
-      # store/update response entity. the prune_*() calls are important to
-      # remove circular references in link responses, which are their own
-      # activities. details in the step 2 comment above.
-      pruned_response = util.prune_response(resp)
-      pruned_responses.append(pruned_response)
-      resp_entity = Response(
-        id=id,
-        source=source.key,
-        activities_json=[json.dumps(util.prune_activity(a, source))
-                         for a in activities],
-        response_json=json.dumps(pruned_response),
-        type=resp_type,
-        unsent=list(urls_to_activity.keys()),
-        failed=list(too_long),
-        original_posts=resp.get('originals', []))
-      if urls_to_activity and len(activities) > 1:
-        resp_entity.urls_to_activity=json.dumps(urls_to_activity)
-      resp_entity.get_or_save(source, restart=self.RESTART_EXISTING_TASKS)
-
-    # update cache
-    if pruned_responses:
-      source.updates['seen_responses_cache_json'] = json.dumps(
-        pruned_responses + unchanged_responses)
+    Args:
+      source: :class:`models.Source`
+      resp: AS response object. Its activities' original post discovery results
+        should already be in their originals and mentions fields.
+      activities: sequence of AS activity dicts that resp is a response to
+    """
+    resp_type = Response.get_type(resp)
+    if not activities and resp_type == 'post':
+      activities = [resp]
+    too_long = set()
+    urls_to_activity = {}
+    for i, activity in enumerate(activities):
+      targets = original_post_discovery.targets_for_response(
+        resp, originals=activity['originals'], mentions=activity['mentions'])
+      if targets:
+        logging.info('%s has %d webmention target(s): %s', activity.get('url'),
+                     len(targets), ' '.join(targets))
+      for t in targets:
+        if len(t) <= _MAX_STRING_LENGTH:
+          urls_to_activity[t] = i
+        else:
+          logging.info('Giving up on target URL over %s chars! %s',
+                       _MAX_STRING_LENGTH, t)
+          too_long.add(t[:_MAX_STRING_LENGTH - 4] + '...')
+
+    resp_entity = Response(
+      id=resp['id'],
+      source=source.key,
+      activities_json=[json.dumps(util.prune_activity(a, source))
+                       for a in activities],
+      response_json=json.dumps(util.prune_response(resp)),
+      type=resp_type,
+      unsent=list(urls_to_activity.keys()),
+      failed=list(too_long),
+      original_posts=resp.get('originals', []))
+    if urls_to_activity and len(activities) > 1:
+      resp_entity.urls_to_activity=json.dumps(urls_to_activity)
+    return resp_entity
 
   def repropagate_old_responses(self, source, relationships):
     """Find old Responses that match a new SyndicatedPost and repropagate them.
@@ -430,43 +734,44 @@ class Poll(webapp2.RequestHandler):
       source: :class:`models.Source`
       relationships: refetch result
     """
-    for response in (Response.query(Response.source == source.key)
-                     .order(-Response.updated)):
-      new_orig_urls = set()
-      for activity_json in response.activities_json:
-        activity = json.loads(activity_json)
-        activity_url = activity.get('url') or activity.get('object', {}).get('url')
-        if not activity_url:
-          logging.warning('activity has no url %s', activity_json)
-          continue
-
-        activity_url = source.canonicalize_url(activity_url, activity=activity)
-        if not activity_url:
-          continue
-
-        # look for activity url in the newly discovered list of relationships
-        for relationship in relationships.get(activity_url, []):
-          # won't re-propagate if the discovered link is already among
-          # these well-known upstream duplicates
-          if (relationship.original in response.sent or
-              relationship.original in response.original_posts):
-            logging.info(
-              '%s found a new rel=syndication link %s -> %s, but the '
-              'relationship had already been discovered by another method',
-              response.label(), relationship.original, relationship.syndication)
-          else:
-            logging.info(
-              '%s found a new rel=syndication link %s -> %s, and '
-              'will be repropagated with a new target!',
-              response.label(), relationship.original, relationship.syndication)
-            new_orig_urls.add(relationship.original)
-
-      if new_orig_urls:
-        # re-open a previously 'complete' propagate task
-        response.status = 'new'
-        response.unsent.extend(list(new_orig_urls))
-        response.put()
-        response.add_task()
+    with util.batch_tasks():
+      for response in (Response.query(Response.source == source.key)
+                       .order(-Response.updated)):
+        new_orig_urls = set()
+        for activity_json in response.activities_json:
+          activity = json.loads(activity_json)
+          activity_url = activity.get('url') or activity.get('object', {}).get('url')
+          if not activity_url:
+            logging.warning('activity has no url %s', activity_json)
+            continue
+
+          activity_url = source.canonicalize_url(activity_url, activity=activity)
+          if not activity_url:
+            continue
+
+          # look for activity url in the newly discovered list of relationships
+          for relationship in relationships.get(activity_url, []):
+            # won't re-propagate if the discovered link is already among
+            # these well-known upstream duplicates
+            if (relationship.original in response.sent or
+                relationship.original in response.original_posts):
+              logging.info(
+                '%s found a new rel=syndication link %s -> %s, but the '
+                'relationship had already been discovered by another method',
+                response.label(), relationship.original, relationship.syndication)
+            else:
+              logging.info(
+                '%s found a new rel=syndication link %s -> %s, and '
+                'will be repropagated with a new target!',
+                response.label(), relationship.original, relationship.syndication)
+              new_orig_urls.add(relationship.original)
+
+        if new_orig_urls:
+          # re-open a previously 'complete' propagate task
+          response.status = 'new'
+          response.unsent.extend(list(new_orig_urls))
+          response.put()
+          response.add_task()
 
 
 class Discover(Poll):
@@ -539,12 +844,25 @@ class SendWebmentions(webapp2.RequestHandler):
   Attributes:
 
   * entity: :class:`models.Webmentions` subclass instance (set in :meth:`lease_entity`)
-  * source: :class:`models.Source` entity (set in :meth:`send_webmentions`)
+  * source: :class:`models.Source` entity (set in :meth:`load_source`)
   """
 
   # request deadline (10m) plus some padding
   LEASE_LENGTH = datetime.timedelta(minutes=12)
 
+  # when all of a task's failed targets are blocked by their receivers' circuit
+  # breakers, it adds a new task for when they'll reopen instead of failing,
+  # until its entity is this old. matches the propagate queues' task_age_limit.
+  MAX_DEFER_AGE = datetime.timedelta(days=1)
+
+  # max number of webmentions to send to a single domain at once. targets on
+  # different domains are sent in parallel, up to util.MAX_FETCH_THREADS.
+  MAX_SENDS_PER_DOMAIN = 2
+
+  source = None
+  # dict of pending property updates for source, written by put_source_updates()
+  source_updates = None
+
   def source_url(self, target_url):
     """Return the source URL to use for a given target URL.
 
@@ -568,13 +886,33 @@ class SendWebmentions(webapp2.RequestHandler):
     """
     logging.info('Starting %s', self.entity.label())
 
-    self.source = self.entity.source.get()
+    self.load_source()
     try:
+      self.prepare_source_urls()
       self.do_send_webmentions()
     except:
       logging.info('Propagate task failed', exc_info=True)
       self.release('error')
       raise
+    finally:
+      self.put_source_updates()
+
+  def prepare_source_urls(self):
+    """Precomputes whatever :meth:`source_url()` needs. Subclasses may override.
+
+    Called by :meth:`send_webmentions()`, which releases the lease if this
+    raises.
+    """
+    pass
+
+  def load_source(self):
+    """Loads :attr:`source` for :attr:`entity`, unless it's already loaded.
+
+    Tasks that propagate multiple entities usually share a source.
+    """
+    if not self.source or self.source.key != self.entity.source:
+      self.source = self.entity.source.get()
+      self.source_updates = {}
 
   def do_send_webmentions(self):
     urls = self.entity.unsent + self.entity.error + self.entity.failed
@@ -595,74 +933,155 @@ class SendWebmentions(webapp2.RequestHandler):
           self.entity.failed.append(orig_url)
     self.entity.unsent = sorted(unsent)
 
-    while self.entity.unsent:
-      target = self.entity.unsent.pop(0)
-      source_url = self.source_url(target)
-      logging.info('Webmention from %s to %s', source_url, target)
-
-      # see if we've cached webmention discovery for this domain. the cache
-      # value is a string URL endpoint if discovery succeeded, a
-      # WebmentionSend error dict if it failed (semi-)permanently, or None.
-      cache_key = util.webmention_endpoint_cache_key(target)
-      cached = memcache.get(cache_key)
-      if cached:
-        logging.info('Using cached webmention endpoint %r: %s', cache_key, cached)
-
-      # send! and handle response or error
-      error = None
-      if isinstance(cached, dict):
-        error = cached
-      else:
-        mention = send.WebmentionSend(source_url, target, endpoint=cached)
-        headers = util.request_headers(source=self.source)
-        logging.info('Sending...')
-        try:
-          if not mention.send(timeout=999, headers=headers):
-            error = mention.error
-        except BaseException, e:
-          logging.info('', exc_info=True)
-          error = getattr(mention, 'error')
-          if not error:
-            error = ({'code': 'BAD_TARGET_URL', 'http_status': 499}
-                     if 'DNS lookup failed for URL:' in str(e)
-                     else {'code': 'EXCEPTION'})
-
-      error_code = error['code'] if error else None
-      if error_code != 'BAD_TARGET_URL' and not cached:
-        val = error if error_code == 'NO_ENDPOINT' else mention.receiver_endpoint
-        memcache.set(cache_key, val, time=WEBMENTION_DISCOVERY_CACHE_TIME)
-
-      if error is None:
+    # source URLs first, since source_url() may abort the request. then send
+    # concurrently, and record results serially, in target order.
+    targets = list(self.entity.unsent)
+    source_urls = [self.source_url(target) for target in targets]
+    results = util.map_in_parallel(
+      lambda args: self.send_webmention(*args), zip(targets, source_urls),
+      key=lambda args: util.domain_from_link(args[0]),
+      max_per_key=self.MAX_SENDS_PER_DOMAIN)
+
+    # targets whose receivers' circuit breakers are open, and how long until
+    # we can retry them
+    blocked = {}
+    for target, (mention, error) in zip(targets, results):
+      bucket = self.bucket(error)
+      if bucket == 'sent':
         logging.info('Sent! %s', mention.response)
         self.record_source_webmention(mention)
-        self.entity.sent.append(target)
+      elif error['code'] == 'CIRCUIT_OPEN':
+        logging.info("Not sending to %s, its receiver's circuit breaker is open",
+                     target)
+        blocked[target] = error['retry_after']
+      elif bucket == 'error':
+        self.fail('Error sending to endpoint: %s' % error, level=logging.INFO)
       else:
-        status = error.get('http_status', 0)
-        if (error_code == 'NO_ENDPOINT' or
-            (error_code == 'BAD_TARGET_URL' and status == 204)):  # No Content
-          logging.info('Giving up this target. %s', error)
-          self.entity.skipped.append(target)
-        elif status // 100 == 4:
-          # Give up on 4XX errors; we don't expect later retries to succeed.
-          logging.info('Giving up this target. %s', error)
-          self.entity.failed.append(target)
-        else:
-          self.fail('Error sending to endpoint: %s' % error, level=logging.INFO)
-          self.entity.error.append(target)
+        logging.info('Giving up this target. %s', error)
 
-      if target in self.entity.unsent:
-        self.entity.unsent.remove(target)
+      getattr(self.entity, bucket).append(target)
+      self.entity.unsent.remove(target)
 
-    if self.entity.error:
+    if (self.entity.error and len(blocked) == len(self.entity.error) and
+        util.now_fn() - self.entity.created < self.MAX_DEFER_AGE):
+      # only blocked by circuit breakers. instead of failing and letting the
+      # queue retry us, wait until they'll let us try again.
+      countdown = max(blocked.values()).total_seconds()
+      logging.info('Deferring propagate task for %ss', countdown)
+      self.release('error')
+      self.entity.add_task(countdown=countdown)
+    elif self.entity.error:
+      if blocked:
+        # blocked targets don't call fail() above, so do it here so that the
+        # queue retries us
+        self.fail('Giving up on deferring for circuit breakers: %s' %
+                  sorted(blocked), level=logging.INFO)
       logging.info('Propagate task failed')
       self.release('error')
     else:
       self.complete()
 
+  @staticmethod
+  def bucket(error):
+    """Returns the :class:`models.Webmentions` field to put a target in.
+
+    Args:
+      error: WebmentionSend error dict, or None if the webmention was sent
+
+    Returns:
+      string, 'sent', 'skipped', 'failed', or 'error'
+    """
+    if error is None:
+      return 'sent'
+
+    code = error['code']
+    status = error.get('http_status', 0)
+    if code == 'NO_ENDPOINT' or (code == 'BAD_TARGET_URL' and status == 204):
+      return 'skipped'  # No Content
+    elif status // 100 == 4:
+      # Give up on 4XX errors; we don't expect later retries to succeed.
+      return 'failed'
+    else:
+      return 'error'
+
+  def send_webmention(self, target, source_url):
+    """Discovers a target's webmention endpoint and sends it a webmention.
+
+    Runs in a :func:`util.map_in_parallel` thread, so it shouldn't touch
+    :attr:`entity` or the response.
+
+    Args:
+      target: string URL
+      source_url: string URL
+
+    Returns:
+      (:class:`webmentiontools.send.WebmentionSend` or None, error dict or
+      None) tuple
+    """
+    logging.info('Webmention from %s to %s', source_url, target)
+
+    # see if we've cached webmention discovery for this page or its site. send
+    # to a stale endpoint and rediscover it in the background, but rediscover
+    # stale errors now, since there's nothing to send to until we do.
+    endpoint = None
+    cached = util.WebmentionEndpoint.load(target)
+    if cached:
+      logging.info('Using cached webmention endpoint for %s: %s', target,
+                   cached.value)
+      if cached.error:
+        if cached.is_fresh():
+          return None, cached.error
+      else:
+        endpoint = cached.endpoint
+        if not cached.is_fresh():
+          util.add_discover_endpoint_task(target)
+
+    domain = util.domain_from_link(target)
+    blocked_for = util.receiver_blocked_for(domain)
+    if blocked_for:
+      return None, {'code': 'CIRCUIT_OPEN', 'retry_after': blocked_for}
+
+    # send! and handle response or error
+    error = None
+    mention = send.WebmentionSend(source_url, target, endpoint=endpoint)
+    headers = util.request_headers(source=self.source)
+    logging.info('Sending...')
+    try:
+      if not mention.send(timeout=999, headers=headers):
+        error = mention.error
+    except BaseException, e:
+      logging.info('', exc_info=True)
+      error = getattr(mention, 'error')
+      if not error:
+        error = ({'code': 'BAD_TARGET_URL', 'http_status': 499}
+                 if 'DNS lookup failed for URL:' in str(e)
+                 else {'code': 'EXCEPTION'})
+
+    error_code = error['code'] if error else None
+    util.record_receiver_result(domain, ok=self.bucket(error) != 'error')
+
+    if not endpoint:
+      if error_code == 'NO_ENDPOINT':
+        util.WebmentionEndpoint.store(target, error=error)
+      elif error_code != 'BAD_TARGET_URL' and mention.receiver_endpoint:
+        util.WebmentionEndpoint.store(target, endpoint=mention.receiver_endpoint)
+
+    return mention, error
+
   @ndb.transactional
   def lease(self, key):
     """Attempts to acquire and lease the :class:`models.Webmentions` entity.
 
+    Also increments its :attr:`models.Webmentions.lease_version`, which
+    :meth:`complete()` and :meth:`release()` compare against to detect stolen
+    leases.
+
+    Each entity gets two transactions: this one, then :meth:`complete()` or
+    :meth:`release()`. The datastore has no conditional put, so the duplicate
+    task and stolen lease checks have to read the entity in the same
+    transaction that writes it. Source bookkeeping for sent webmentions is
+    batched separately, in :meth:`put_source_updates()`.
+
     Returns True on success, False or None otherwise.
 
     TODO: unify with :meth:`complete()`
@@ -684,6 +1103,7 @@ class SendWebmentions(webapp2.RequestHandler):
       assert self.entity.status in ('new', 'processing', 'error'), self.entity.status
       self.entity.status = 'processing'
       self.entity.leased_until = util.now_fn() + self.LEASE_LENGTH
+      self.entity.lease_version = (self.entity.lease_version or 0) + 1
       self.entity.put()
       return True
 
@@ -705,6 +1125,10 @@ class SendWebmentions(webapp2.RequestHandler):
                     'https://github.com/snarfed/bridgy/issues/610')
     elif existing.status == 'new':
       self.fail('went backward from processing to new!', level=logging.ERROR)
+    elif existing.lease_version != self.entity.lease_version:
+      # let this task return 200 and finish. the other task will complete it.
+      logging.warning('another task stole this and is processing it. did my '
+                      'lease expire?')
     else:
       assert existing.status == 'processing', existing.status
       assert self.entity.status == 'processing', self.entity.status
@@ -718,11 +1142,14 @@ class SendWebmentions(webapp2.RequestHandler):
   def release(self, new_status):
     """Attempts to unlease the :class:`models.Webmentions` entity.
 
+    Does nothing if another task has leased it since we did.
+
     Args:
       new_status: string
     """
     existing = self.entity.key.get()
-    if existing and existing.status == 'processing':
+    if (existing and existing.status == 'processing' and
+        existing.lease_version == self.entity.lease_version):
       self.entity.status = new_status
       self.entity.leased_until = None
       self.entity.put()
@@ -734,25 +1161,32 @@ class SendWebmentions(webapp2.RequestHandler):
     logging.log(level, message)
     self.response.out.write(message)
 
-  @ndb.transactional
   def record_source_webmention(self, mention):
     """Sets this source's last_webmention_sent and maybe webmention_endpoint.
 
+    Only accumulates them in :attr:`source_updates`.
+    :meth:`put_source_updates()` writes them all at once when the entity is
+    done, so sending to N targets costs one source write instead of N.
+
     Args:
       mention: :class:`webmentiontools.send.WebmentionSend`
     """
-    self.source = self.source.key.get()
-    logging.info('Setting last_webmention_sent')
-    self.source.last_webmention_sent = util.now_fn()
+    self.source_updates['last_webmention_sent'] = util.now_fn()
 
-    if (mention.receiver_endpoint != self.source.webmention_endpoint and
+    endpoint = self.source_updates.get('webmention_endpoint',
+                                       self.source.webmention_endpoint)
+    if (mention.receiver_endpoint != endpoint and
         util.domain_from_link(mention.target_url) in self.source.domains):
       logging.info('Also setting webmention_endpoint to %s (discovered in %s; was %s)',
-                   mention.receiver_endpoint, mention.target_url,
-                   self.source.webmention_endpoint)
-      self.source.webmention_endpoint = mention.receiver_endpoint
+                   mention.receiver_endpoint, mention.target_url, endpoint)
+      self.source_updates['webmention_endpoint'] = mention.receiver_endpoint
 
-    self.source.put()
+  def put_source_updates(self):
+    """Writes :attr:`source_updates` to the source in one transaction, if any."""
+    if self.source_updates:
+      self.source.updates = self.source_updates
+      self.source = models.Source.put_updates(self.source)
+      self.source_updates = {}
 
 
 class PropagateResponse(SendWebmentions):
@@ -761,18 +1195,45 @@ class PropagateResponse(SendWebmentions):
   Attributes:
 
   * activities: parsed :attr:`models.Response.activities_json` list
+  * urls_to_activity: parsed :attr:`models.Response.urls_to_activity` dict
+  * activity_source_urls: list of source URLs, one per activity
 
   Request parameters:
 
-  * response_key: string key of :class:`models.Response` entity
+  * response_key: string key of :class:`models.Response` entity. May be
+    repeated, e.g. for responses grouped by
+    :meth:`models.Response.add_tasks_by_receiver()`. Each one is leased, sent,
+    and completed or released separately.
   """
 
   def post(self):
     logging.debug('Params: %s', self.request.params)
-    if not self.lease(ndb.Key(urlsafe=self.request.params['response_key'])):
+
+    # if one response fails, keep going, then reraise the first error so that
+    # the task is retried. the responses that succeeded will be skipped then
+    # since they're complete.
+    exc_info = None
+    for key in self.request.get_all('response_key'):
+      try:
+        self.propagate(ndb.Key(urlsafe=key))
+      except BaseException:
+        logging.warning('Propagating %s failed', key, exc_info=True)
+        exc_info = exc_info or sys.exc_info()
+
+    if exc_info:
+      raise exc_info[0], exc_info[1], exc_info[2]
+
+  def propagate(self, key):
+    """Leases and sends webmentions for a single response.
+
+    Args:
+      key: :class:`ndb.Key` of a :class:`models.Response`
+    """
+    if not self.lease(key):
       return
 
-    source = self.entity.source.get()
+    self.load_source()
+    source = self.source
     if not source:
       logging.warning('Source not found! Dropping response.')
       return
@@ -792,25 +1253,16 @@ class PropagateResponse(SendWebmentions):
 
     self.send_webmentions()
 
-  def source_url(self, target_url):
-    # determine which activity to use
-    try:
-      activity = self.activities[0]
-      if self.entity.urls_to_activity:
-        urls_to_activity = json.loads(self.entity.urls_to_activity)
-        if urls_to_activity:
-          activity = self.activities[urls_to_activity[target_url]]
-    except (KeyError, IndexError):
-      logging.warning("""\
-Hit https://github.com/snarfed/bridgy/issues/237 KeyError!
-target url %s not in urls_to_activity: %s
-activities: %s""", target_url, self.entity.urls_to_activity, self.activities)
-      self.abort(util.ERROR_HTTP_RETURN_CODE)
+  def prepare_source_urls(self):
+    """Decodes :attr:`urls_to_activity` and builds each activity's source URL.
+
+    Runs once per response, after it's leased, so that :meth:`source_url()`
+    is just a lookup for each target.
+    """
+    self.urls_to_activity = None
+    if self.entity.urls_to_activity:
+      self.urls_to_activity = json.loads(self.entity.urls_to_activity)
 
-    # generate source URL
-    id = activity['id']
-    parsed = util.parse_tag_uri(id)
-    post_id = parsed[1] if parsed else id
     # prefer brid-gy.appspot.com to brid.gy because non-browsers (ie OpenSSL)
     # currently have problems with brid.gy's SSL cert. details:
     # https://github.com/snarfed/bridgy/issues/20
@@ -820,20 +1272,37 @@ activities: %s""", target_url, self.entity.urls_to_activity, self.activities)
     else:
       host_url = self.request.host_url
 
-    path = [host_url, self.entity.type, self.entity.source.get().SHORT_NAME,
-            self.entity.source.string_id(), post_id]
-
+    suffix = []
     if self.entity.type != 'post':
       # parse and add response id. (we know Response key ids are always tag URIs)
       _, response_id = util.parse_tag_uri(self.entity.key.string_id())
       reaction_id = response_id
       if self.entity.type in ('like', 'react', 'repost', 'rsvp'):
         response_id = response_id.split('_')[-1]  # extract responder user id
-      path.append(response_id)
+      suffix.append(response_id)
       if self.entity.type == 'react':
-        path.append(reaction_id)
+        suffix.append(reaction_id)
 
-    return '/'.join(path)
+    self.activity_source_urls = []
+    for activity in self.activities:
+      id = activity['id']
+      parsed = util.parse_tag_uri(id)
+      post_id = parsed[1] if parsed else id
+      self.activity_source_urls.append('/'.join(
+        [host_url, self.entity.type, self.source.SHORT_NAME,
+         self.entity.source.string_id(), post_id] + suffix))
+
+  def source_url(self, target_url):
+    # determine which activity to use
+    try:
+      index = self.urls_to_activity[target_url] if self.urls_to_activity else 0
+      return self.activity_source_urls[index]
+    except (KeyError, IndexError):
+      logging.warning("""\
+Hit https://github.com/snarfed/bridgy/issues/237 KeyError!
+target url %s not in urls_to_activity: %s
+activities: %s""", target_url, self.entity.urls_to_activity, self.activities)
+      self.abort(util.ERROR_HTTP_RETURN_CODE)
 
 
 class PropagateBlogPost(SendWebmentions):
@@ -865,9 +1334,43 @@ class PropagateBlogPost(SendWebmentions):
     return self.entity.key.id()
 
 
+class DiscoverEndpoint(webapp2.RequestHandler):
+  """Task handler that rediscovers a stale cached webmention endpoint.
+
+  Request parameters:
+
+  * url: string target URL
+  """
+
+  def post(self):
+    logging.debug('Params: %s', self.request.params)
+    url = util.get_required_param(self, 'url')
+
+    mention = send.WebmentionSend(None, url)
+    mention.requests_kwargs = {
+      'timeout': appengine_config.HTTP_TIMEOUT,
+      'headers': util.REQUEST_HEADERS,
+    }
+    mention.error = None
+    try:
+      mention.discoverEndpoint()
+    except BaseException:
+      logging.info('Error discovering webmention endpoint', exc_info=True)
+      return
+
+    error = mention.error
+    if error and error.get('code') == 'NO_ENDPOINT':
+      util.WebmentionEndpoint.store(url, error=error)
+    elif not error and mention.receiver_endpoint:
+      util.WebmentionEndpoint.store(url, endpoint=mention.receiver_endpoint)
+    else:
+      logging.info('Discovery failed, keeping cached endpoint: %s', error)
+
+
 application = webapp2.WSGIApplication([
     ('/_ah/queue/poll(-now)?', Poll),
     ('/_ah/queue/discover', Discover),
     ('/_ah/queue/propagate', PropagateResponse),
     ('/_ah/queue/propagate-blogpost', PropagateBlogPost),
+    ('/_ah/queue/discover-endpoint', DiscoverEndpoint),
     ], debug=appengine_config.DEBUG)
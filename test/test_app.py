@@ -6,7 +6,6 @@ import json
 import urllib
 import urlparse
 
-from google.appengine.api import memcache
 from google.appengine.ext import ndb
 import mox
 from oauth_dropins import handlers as oauth_handlers
@@ -83,7 +82,7 @@ class AppTest(testutil.ModelsTest):
     SyndicatedPost.insert(source, 'https://fa.ke/3', 'http://orig/3')
 
     # cached webmention endpoint
-    memcache.set('W https skipped', 'asdf')
+    util.WebmentionEndpoint.store('https://skipped/', endpoint='asdf')
 
     key = resp.key.urlsafe()
     response = app.application.get_response(
@@ -105,7 +104,7 @@ class AppTest(testutil.ModelsTest):
       self.assertEqual([], field)
 
     # webmention endpoints for URL domains should be refreshed
-    self.assertIsNone(memcache.get('W https skipped'))
+    self.assertIsNone(util.WebmentionEndpoint.load('https://skipped/'))
 
     # shouldn't have refetched h-feed
     self.assertEqual(last_hfeed_refetch, source.key.get().last_hfeed_refetch)
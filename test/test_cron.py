@@ -93,6 +93,54 @@ class CronTest(HandlerTest):
     self.assert_equals(sources[4].urlsafe(),
                        testutil.get_task_params(tasks[0])['source_key'])
 
+  def test_replace_poll_tasks_skips_poll_scheduler(self):
+    self.mox.stubs.Set(FakeSource, 'USE_POLL_SCHEDULER', True)
+    FakeSource.new(None, features=['listen'],
+                   next_poll_at=util.now_fn() - datetime.timedelta(days=1)).put()
+    # no next_poll_at, so DispatchPolls may not find it
+    unscheduled = FakeSource.new(None, features=['listen']).put()
+
+    resp = cron.application.get_response('/cron/replace_poll_tasks')
+    self.assertEqual(200, resp.status_int)
+    tasks = self.taskqueue_stub.GetTasks('poll')
+    self.assertEqual(1, len(tasks))
+    self.assert_equals(unscheduled.urlsafe(),
+                       testutil.get_task_params(tasks[0])['source_key'])
+
+  def test_dispatch_polls(self):
+    self.mox.stubs.Set(FakeSource, 'USE_POLL_SCHEDULER', True)
+    minute = datetime.timedelta(minutes=1)
+    past = util.now_fn() - minute
+    due = FakeSource.new(None, features=['listen'], next_poll_at=past).put()
+    # not due yet, disabled, not signed up for listen
+    FakeSource.new(None, features=['listen'], next_poll_at=past + 2 * minute).put()
+    FakeSource.new(None, features=['listen'], status='disabled',
+                   next_poll_at=past).put()
+    FakeSource.new(None, next_poll_at=past).put()
+    # never scheduled
+    unscheduled = FakeSource.new(None, features=['listen']).put()
+
+    for _ in range(2):  # second run shouldn't add a duplicate task
+      resp = cron.application.get_response('/cron/dispatch_polls')
+      self.assertEqual(200, resp.status_int)
+
+      tasks = self.taskqueue_stub.GetTasks('poll')
+      self.assertItemsEqual(
+        [{'source_key': due.urlsafe()}, {'source_key': unscheduled.urlsafe()}],
+        [testutil.get_task_params(task) for task in tasks])
+
+  def test_dispatch_polls_batches(self):
+    self.mox.stubs.Set(FakeSource, 'USE_POLL_SCHEDULER', True)
+    self.mox.stubs.Set(cron, 'POLL_DISPATCH_BATCH_SIZE', 2)
+    self.mox.stubs.Set(cron, 'POLL_DISPATCH_MAX_BATCHES', 2)
+    past = util.now_fn() - datetime.timedelta(minutes=1)
+    for _ in range(5):
+      FakeSource.new(None, features=['listen'], next_poll_at=past).put()
+
+    resp = cron.application.get_response('/cron/dispatch_polls')
+    self.assertEqual(200, resp.status_int)
+    self.assertEqual(4, len(self.taskqueue_stub.GetTasks('poll')))
+
   def test_update_twitter_pictures(self):
     sources = []
     for screen_name in ('a', 'b', 'c'):
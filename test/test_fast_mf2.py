@@ -0,0 +1,106 @@
+# coding=utf-8
+"""Unit tests for fast_mf2.py.
+"""
+import mf2py
+
+import fast_mf2
+import testutil
+
+PROPERTIES = ('url', 'syndication', 'published', 'updated')
+
+
+def trim(items):
+  """Trims full mf2py items down to what fast_mf2 extracts."""
+  trimmed = []
+  for item in items:
+    props = {name: vals for name, vals in item['properties'].items()
+             if name in PROPERTIES}
+    new = {'type': item['type'], 'properties': props}
+    if item.get('children'):
+      new['children'] = trim(item['children'])
+    trimmed.append(new)
+  return trimmed
+
+
+class FastMf2Test(testutil.HandlerTest):
+
+  def assert_same_as_mf2py(self, html, url='http://author/'):
+    fast = fast_mf2.parse(html, url)
+    self.assertIsNotNone(fast)
+    full = mf2py.parse(doc=html, url=url)
+    self.assert_equals(trim(full['items']), fast['items'])
+    for rel in 'syndication', 'feed':
+      self.assert_equals(full['rels'].get(rel), fast['rels'].get(rel))
+
+  def test_hfeed(self):
+    self.assert_same_as_mf2py(u"""\
+<html>
+<head><link rel="feed" type="text/html" href="/notes"></head>
+<body class="h-feed">
+  <article class="h-entry">
+    <a class="u-url" href="/post/1">permalink</a>
+    <time class="dt-published" datetime="2017-01-01T00:00:00Z">Jan 1</time>
+    <a class="u-syndication" href="https://fa.ke/post/1">fa.ke</a>
+    <div class="p-author h-card"><a class="u-url" href="/">me</a></div>
+  </article>
+  <article class="h-entry">
+    <a class="u-url" href="/post/perma✁2"></a>
+    <time class="dt-updated" datetime="2017-01-02">Jan 2</time>
+  </article>
+  <a class="h-entry" href="/post/3"></a>
+</body>
+</html>""")
+
+  def test_permalink_rels(self):
+    self.assert_same_as_mf2py("""\
+<html>
+<head>
+  <base href="http://other/base/">
+  <link rel="syndication" href="https://fa.ke/post/1">
+</head>
+<body>
+  <div class="h-entry">
+    <a class="u-url" href="post/1"></a>
+    <a rel="syndication me" class="u-syndication" href="https://fa.ke/2"></a>
+  </div>
+</body>
+</html>""")
+
+  def test_implied_end_tags(self):
+    self.assert_same_as_mf2py("""\
+<div class="h-feed">
+  <p>intro
+  <ul>
+    <li class="h-entry"><a class="u-url" href="/1"></a>
+    <li class="h-entry"><a class="u-url" href="/2"></a>
+  </ul>
+</div>""")
+
+  def test_ambiguous_falls_back(self):
+    for html in (
+        # microformats1
+        '<div class="hentry"><a rel="bookmark" href="/1"></a></div>',
+        # implied u-url from a child
+        '<div class="h-entry"><a href="/1"></a></div>',
+        # u-url without an href
+        '<div class="h-entry"><span class="u-url">/1</span></div>',
+        # dt-published from text content
+        '<div class="h-entry"><a class="u-url" href="/1"></a>'
+        '<span class="dt-published">2017-01-01</span></div>',
+        # root that's also a property
+        '<div class="h-entry"><a class="u-url h-card" href="/1"></a></div>',
+        # unclosed element with microformats
+        '<div class="h-feed"><span class="h-entry">'
+        '<a class="u-url" href="/1"></a></div>',
+    ):
+      self.assertIsNone(fast_mf2.parse(html, 'http://author/'), html)
+
+  def test_nested_property_hentry_needs_no_url(self):
+    self.assert_equals([{
+      'type': ['h-entry'],
+      'properties': {'url': ['http://author/1']},
+    }], fast_mf2.parse("""\
+<div class="h-entry">
+  <a class="u-url" href="/1"></a>
+  <div class="p-comment h-entry">no url</div>
+</div>""", 'http://author/')['items'])
@@ -1,10 +1,14 @@
 # coding=utf-8
 """Unit tests for models.py.
 """
+import base64
 import datetime
 import json
+import math
 import re
+import urlparse
 
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 from granary import source as gr_source
 import mox
@@ -157,6 +161,77 @@ class ResponseTest(testutil.ModelsTest):
     self.assertEqual('complete', saved.status)
     self.assert_no_propagate_task()
 
+  def test_get_or_save_multi(self):
+    source = self.sources[0]
+    new, changed, same, no_targets = self.responses[:4]
+    no_targets.unsent = []
+
+    changed.put()
+    old_resp_json = changed.response_json
+    changed.response_json = json.dumps(dict(json.loads(old_resp_json),
+                                            content='new content'))
+    same.status = 'complete'
+    same.put()
+
+    saved = Response.get_or_save_multi(source, [new, changed, same, no_targets])
+    self.assertEqual([r.key for r in self.responses[:4]], [r.key for r in saved])
+
+    stored = ndb.get_multi(r.key for r in self.responses[:4])
+    self.assertEqual(['new', 'new', 'complete', 'complete'],
+                     [r.status for r in stored])
+    self.assertEqual(changed.response_json, stored[1].response_json)
+    self.assertEqual([old_resp_json], stored[1].old_response_jsons)
+
+    tasks = self.taskqueue_stub.GetTasks('propagate')
+    self.assertItemsEqual(
+      [new.key, changed.key],
+      [ndb.Key(urlsafe=testutil.get_task_params(t)['response_key']) for t in tasks])
+
+  def test_get_or_save_multi_task_add_fails(self):
+    """Responses shouldn't be stored without their propagate tasks."""
+    def fail(*args, **kwargs):
+      raise taskqueue.TransientError()
+    self.mox.stubs.Set(taskqueue, 'add', fail)
+
+    for batch in False, True:
+      self.mox.stubs.Set(FakeSource, 'BATCH_PROPAGATE', batch)
+      with self.assertRaises(taskqueue.TransientError):
+        Response.get_or_save_multi(self.sources[0], self.responses[:2])
+      self.assertEqual([None, None],
+                       ndb.get_multi(r.key for r in self.responses[:2]))
+
+  def test_get_or_save_multi_restart(self):
+    self.responses[0].put()
+    Response.get_or_save_multi(self.sources[0], self.responses[:1], restart=True)
+    self.assert_propagate_task()
+
+  def test_get_or_save_multi_batch_propagate(self):
+    self.mox.stubs.Set(FakeSource, 'BATCH_PROPAGATE', True)
+    source = self.sources[0]
+
+    # group by cached endpoint if we have one, otherwise by domain
+    util.WebmentionEndpoint.store('http://target1/post/url',
+                                  endpoint='http://wm/endpoint')
+    self.responses[2].unsent = ['http://target1/other']
+    self.responses[3].unsent = ['http://target2/post']
+    Response.get_or_save_multi(source, self.responses[:4])
+
+    tasks = self.taskqueue_stub.GetTasks('propagate')
+    self.assertEqual(2, len(tasks))
+    self.assertItemsEqual(
+      [[r.key.urlsafe() for r in self.responses[:3]],
+       [self.responses[3].key.urlsafe()]],
+      [urlparse.parse_qs(base64.b64decode(t['body']))['response_key']
+       for t in tasks])
+
+  def test_add_tasks_by_receiver_batch_size(self):
+    self.mox.stubs.Set(Response, 'PROPAGATE_BATCH_SIZE', 3)
+    Response.add_tasks_by_receiver(self.responses[:4])
+    self.assertItemsEqual(
+      [3, 1],
+      [len(urlparse.parse_qs(base64.b64decode(t['body']))['response_key'])
+       for t in self.taskqueue_stub.GetTasks('propagate')])
+
   def test_get_type(self):
     self.assertEqual('repost', Response.get_type(
         {'objectType': 'activity', 'verb': 'share'}))
@@ -534,6 +609,69 @@ class SourceTest(testutil.HandlerTest):
     source.rate_limited = True
     self.assertEqual(source.RATE_LIMITED_POLL, source.poll_period())
 
+  def test_poll_period_adaptive(self):
+    self.mox.stubs.Set(FakeSource, 'ADAPTIVE_POLL', True)
+    source = FakeSource.new(None)
+    source.put()
+    self.assertEqual(source.FAST_POLL, source.poll_period())  # grace period
+
+    source.created = datetime.datetime(2000, 1, 1)
+    self.assertEqual(source.ADAPTIVE_POLL_MAX, source.poll_period())
+
+    # about one new response per day
+    half_life = source.POLL_STATS_HALF_LIFE.total_seconds()
+    per_day = half_life / 86400 / math.log(2)
+    source.poll_stats = {'responses': per_day * .75, 'posts': per_day * .25}
+    self.assertAlmostEqual(86400, source.poll_period().total_seconds(), places=3)
+
+    source.poll_stats = {'responses': per_day * 1000, 'posts': 0}
+    self.assertEqual(source.ADAPTIVE_POLL_MIN, source.poll_period())
+
+    source.rate_limited = True
+    self.assertEqual(source.RATE_LIMITED_POLL, source.poll_period())
+
+  def test_update_poll_stats(self):
+    source = FakeSource.new(None, last_polled=testutil.NOW)
+    self.assertEqual(0, source.poll_rate())
+    self.assertEqual({'responses': 3, 'posts': 1},
+                     source.update_poll_stats(testutil.NOW, 3, 1))
+
+    source.poll_stats = {'responses': 4, 'posts': 2}
+    self.assertEqual(
+      {'responses': 3, 'posts': 1},
+      source.update_poll_stats(testutil.NOW + source.POLL_STATS_HALF_LIFE, 1, 0))
+
+  def test_poll_stats_record(self):
+    source = FakeSource.new(None)
+    source.put()
+
+    stats = util.RequestStats()
+    stats.add_phase('fetch', 100)
+    stats.add_http(2048)
+    models.PollStats.record(source, stats, 300)
+
+    stats = util.RequestStats()
+    stats.add_phase('fetch', 200)
+    stats.add_phase('store', 50)
+    models.PollStats.record(source, stats, 500)
+
+    poll_stats = models.PollStats.get_by_id(source.key.urlsafe())
+    self.assertEqual(source.key, poll_stats.source)
+    self.assertEqual(2, len(poll_stats.polls))
+    self.assertEqual({
+      'total_ms': 400,
+      'phases': {'fetch': 150, 'store': 25},
+      'http_calls': .5,
+      'http_bytes': 1024,
+    }, poll_stats.averages())
+
+    # only keeps the most recent polls
+    for _ in range(models.PollStats.POLLS_KEPT):
+      models.PollStats.record(source, util.RequestStats(), 0)
+    poll_stats = models.PollStats.get_by_id(source.key.urlsafe())
+    self.assertEqual(models.PollStats.POLLS_KEPT, len(poll_stats.polls))
+    self.assertEqual(0, poll_stats.averages()['total_ms'])
+
   def test_should_refetch(self):
     source = FakeSource.new(None)  # haven't found a synd url yet
     self.assertFalse(source.should_refetch())
@@ -728,3 +866,43 @@ class SyndicatedPostTest(testutil.ModelsTest):
     ).fetch()
 
     self.assertEqual(1, len(rs))
+
+  def test_writer(self):
+    """SyndicatedPostWriter should make the same changes as the individual
+    insert methods, all at once."""
+    notified = []
+    self.mox.stubs.Set(FakeSource, 'on_new_syndicated_post',
+                       lambda source, syndpost: notified.append(syndpost))
+
+    writer = models.SyndicatedPostWriter(self.source)
+    # exact duplicate
+    dupe = writer.insert('http://silo/post/url', 'http://original/post/url')
+    # replaces both blanks
+    writer.insert_original_blank('http://original/newly-discovered')
+    new = writer.insert('http://silo/no-original',
+                        'http://original/no-syndication')
+    # already has a relationship
+    writer.insert_original_blank('http://original/another/post')
+    # deleted, but its original still has another relationship
+    writer.delete(self.relationships[1])
+    writer.insert_original_blank('http://original/post/url')
+
+    stored = writer.flush()
+    self.assertEquals(2, len(stored))
+    self.assertIs(new, stored[0])
+    self.assertEquals(stored, notified)
+    self.assertFalse(any(r is dupe for r in stored))
+
+    self.assertItemsEqual([
+      ('http://original/post/url', 'http://silo/post/url'),
+      ('http://original/another/post', 'http://silo/post/url'),
+      ('http://original/no-syndication', 'http://silo/no-original'),
+      ('http://original/newly-discovered', None),
+    ], [(r.original, r.syndication)
+        for r in SyndicatedPost.query(ancestor=self.source.key)])
+
+    self.assertEquals([], writer.flush())
+
+    # individual puts still call the hook
+    SyndicatedPost(parent=self.source.key, original='http://original/x').put()
+    self.assertEquals(3, len(notified))
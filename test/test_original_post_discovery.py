@@ -4,12 +4,16 @@
 import datetime
 import json
 import string
+import threading
+import time
 
 from granary import facebook as gr_facebook
 from oauth_dropins import facebook as oauth_facebook
+import requests
 from requests.exceptions import HTTPError
 
 from facebook import FacebookPage
+import models
 from models import SyndicatedPost
 import original_post_discovery
 from original_post_discovery import discover, refetch
@@ -256,6 +260,51 @@ class OriginalPostDiscoveryTest(testutil.ModelsTest):
     # confirm that we do not fetch the h-feed again for the same syndicated post
     self.assertEquals((set(), set()), discover(self.source, self.activities[2]))
 
+  def test_hfeed_locks_bounded(self):
+    lock = original_post_discovery._hfeed_lock('http://author')
+    self.assertIs(lock, original_post_discovery._hfeed_lock('http://author'))
+    self.assertEquals(original_post_discovery.HFEED_LOCK_STRIPES, len(set(
+      original_post_discovery._hfeed_lock('http://author/%d' % i)
+      for i in xrange(1000))))
+
+  def test_parallel_discover_shares_fetched_hfeeds(self):
+    """Concurrent discover() calls should only fetch the h-feed once."""
+    for i, activity in enumerate(self.activities):
+      activity['object'].update({
+        'content': 'post content without backlinks',
+        'url': 'https://fa.ke/post/url%d' % (i + 1),
+      })
+
+    self.expect_requests_get('http://author', """
+    <html class="h-feed">
+      <div class="h-entry">
+        <a class="u-url" href="http://author/post/permalink1"></a>
+        <a class="u-syndication" href="https://fa.ke/post/url1"></a>
+      </div>
+      <div class="h-entry">
+        <a class="u-url" href="http://author/post/permalink2"></a>
+        <a class="u-syndication" href="https://fa.ke/post/url2"></a>
+      </div>
+    </html>""")
+    self.mox.ReplayAll()
+
+    fetched = set()
+    results = util.map_in_parallel(
+      lambda activity: discover(self.source, activity,
+                                already_fetched_hfeeds=fetched),
+      self.activities, max_threads=3)
+
+    self.assertEquals([
+      ({'http://author/post/permalink1'}, set()),
+      ({'http://author/post/permalink2'}, set()),
+      (set(), set()),
+    ], results)
+    self.assertEquals({'http://author'}, fetched)
+    self.assert_syndicated_posts(
+      ('http://author/post/permalink1', 'https://fa.ke/post/url1'),
+      ('http://author/post/permalink2', 'https://fa.ke/post/url2'),
+      (None, 'https://fa.ke/post/url3'))
+
   def test_no_duplicate_links(self):
     """Make sure that a link found by both original-post-discovery and
     posse-post-discovery will not result in two webmentions being sent.
@@ -802,6 +851,33 @@ class OriginalPostDiscoveryTest(testutil.ModelsTest):
       ('http://author/article-permalink', 'https://fa.ke/article'),
       (None, u'https://fa.ke/post/url'))
 
+  def test_rel_feed_error_doesnt_drop_later_feeds(self):
+    """If one rel-feed fails, we should still process the others, but not store
+    validators, so that we don't skip this author next time."""
+    original_post_discovery.CONDITIONAL_GET = True
+
+    self.expect_requests_get('http://author', """
+    <html>
+      <head>
+        <link rel="feed" href="/articles" type="text/html">
+        <link rel="feed" href="/notes" type="text/html">
+      </head>
+    </html>""")
+    self.expect_requests_get('http://author/articles', status_code=500)
+    self.expect_requests_get('http://author/notes', """
+    <html class="h-feed">
+      <article class="h-entry">
+        <a class="u-url" href="/note-permalink"></a>
+        <a class="u-syndication" href="https://fa.ke/post/url"></a>
+      </article>
+    </html>""")
+
+    self.mox.ReplayAll()
+    self.assert_discover(['http://author/note-permalink'])
+    self.assert_syndicated_posts(
+      ('http://author/note-permalink', 'https://fa.ke/post/url'))
+    self.assertEquals([], models.FetchValidators.query().fetch())
+
   def test_avoid_author_page_with_bad_content_type(self):
     """Confirm that we check the author page's content type before
     fetching and parsing it
@@ -1468,3 +1544,204 @@ class OriginalPostDiscoveryTest(testutil.ModelsTest):
 
     self.mox.ReplayAll()
     self.assert_discover(['http://author/post/url'])
+
+  def test_prefetch_permalinks_in_parallel(self):
+    """Permalinks should be fetched concurrently, but only a few per host."""
+    util.MAX_FETCH_THREADS = 4
+    self.mox.stubs.Set(original_post_discovery,
+                       'MAX_PERMALINK_FETCHES_PER_HOST', 2)
+
+    permalinks = ['http://author/post/%d' % i for i in range(6)]
+    feed = '<html class="h-feed">%s</html>' % ''.join(
+      '<div class="h-entry"><a class="u-url" href="%s"></a></div>' % url
+      for url in permalinks)
+
+    running = [0]
+    max_running = [0]
+    lock = threading.Lock()
+
+    def requests_get(url, **kwargs):
+      if url == 'http://author':
+        html = feed
+      else:
+        with lock:
+          running[0] += 1
+          max_running[0] = max(max_running[0], running[0])
+        time.sleep(.01)
+        with lock:
+          running[0] -= 1
+        html = """
+        <div class="h-entry">
+          <a class="u-url" href="%s"></a>
+          <a class="u-syndication" href="https://fa.ke/post/url%s"></a>
+        </div>""" % (url, url[-1])
+
+      resp = requests.Response()
+      resp.status_code = 200
+      resp.encoding = 'utf-8'
+      resp._content = html
+      resp.url = url
+      return resp
+
+    self.mox.stubs.Set(util, 'requests_get', requests_get)
+    self.mox.stubs.Set(util, 'get_webmention_target', lambda url, **kwargs:
+                       (url, util.domain_from_link(url), True))
+
+    results = original_post_discovery._process_author(self.source,
+                                                      'http://author')
+    self.assertEquals(6, len(results))
+    self.assertItemsEqual(permalinks, [
+      r.original for r in SyndicatedPost.query(ancestor=self.source.key)])
+    self.assertLessEqual(max_running[0], 2)
+
+  def test_conditional_get_skips_unchanged_author_page(self):
+    """If the author page and its feeds haven't changed, we should skip them."""
+    original_post_discovery.CONDITIONAL_GET = True
+
+    self.expect_requests_get('http://author', """
+    <html class="h-feed">
+      <div class="h-entry">
+        <a class="u-url" href="http://author/post/permalink"></a>
+      </div>
+    </html>""", response_headers={'ETag': '"abc"'})
+    self.expect_requests_get('http://author/post/permalink', """
+    <div class="h-entry">
+      <a class="u-url" href="http://author/post/permalink"></a>
+      <a class="u-syndication" href="https://fa.ke/post/url"></a>
+    </div>""")
+
+    headers = dict(util.REQUEST_HEADERS)
+    headers['If-None-Match'] = '"abc"'
+    self.expect_requests_get('http://author', '', status_code=304,
+                             headers=headers)
+    self.mox.ReplayAll()
+
+    self.assert_discover(['http://author/post/permalink'])
+    self.assertEquals({}, original_post_discovery._process_author(
+      self.source, 'http://author'))
+    self.assert_syndicated_posts(('http://author/post/permalink',
+                                  'https://fa.ke/post/url'))
+
+  def test_conditional_get_domains_changed(self):
+    """If the source's domains changed, we should process the author page again
+    even if it hasn't changed."""
+    original_post_discovery.CONDITIONAL_GET = True
+
+    hfeed = """
+    <html class="h-feed">
+      <div class="h-entry">
+        <a class="u-url" href="http://author/post/permalink"></a>
+      </div>
+    </html>"""
+    self.expect_requests_get('http://author', hfeed,
+                             response_headers={'ETag': '"abc"'})
+    self.expect_requests_get('http://author/post/permalink', """
+    <div class="h-entry">
+      <a class="u-url" href="http://author/post/permalink"></a>
+    </div>""")
+
+    # no If-None-Match, since the stored validators are stale
+    self.expect_requests_get('http://author', hfeed,
+                             response_headers={'ETag': '"abc"'})
+    self.mox.ReplayAll()
+
+    original_post_discovery._process_author(self.source, 'http://author')
+    self.assertIsNotNone(models.FetchValidators.get_by_id(
+      'http://author', parent=self.source.key))
+
+    self.source.domain_urls.append('http://other')
+    self.source.domains.append('other')
+    original_post_discovery._process_author(self.source, 'http://author')
+
+  def test_conditional_get_refetch_skips_unchanged_permalink(self):
+    """Refetch should skip permalinks that haven't changed."""
+    original_post_discovery.CONDITIONAL_GET = True
+
+    hfeed = """<html class="h-feed">
+    <a class="h-entry" href="/permalink"></a>
+    </html>"""
+    last_modified = 'Mon, 01 Jan 2018 00:00:00 GMT'
+
+    self.expect_requests_get('http://author', hfeed)
+    self.expect_requests_get('http://author/permalink', """
+    <html class="h-entry">
+      <a class="u-url" href="/permalink"></a>
+      <a class="u-syndication" href="https://fa.ke/post/url"></a>
+    </html>""", response_headers={'Last-Modified': last_modified})
+
+    # refetch gets the h-feed again, but the permalink is unchanged
+    self.expect_requests_get('http://author', hfeed)
+    headers = dict(util.REQUEST_HEADERS)
+    headers['If-Modified-Since'] = last_modified
+    self.expect_requests_get('http://author/permalink', '', status_code=304,
+                             headers=headers)
+    self.mox.ReplayAll()
+
+    self.assertItemsEqual(['https://fa.ke/post/url'],
+                          refetch(self.source).keys())
+    self.assertEquals({}, refetch(self.source))
+    self.assert_syndicated_posts(('http://author/permalink',
+                                  'https://fa.ke/post/url'))
+
+  def test_preload_syndicated_posts(self):
+    """discover() should use preloaded relationships instead of querying."""
+    for i, activity in enumerate(self.activities):
+      activity['object']['url'] = 'https://fa.ke/post/url%d' % (i + 1)
+
+    SyndicatedPost(parent=self.source.key, original='http://author/post/1',
+                   syndication='https://fa.ke/post/url1').put()
+    SyndicatedPost(parent=self.source.key, original=None,
+                   syndication='https://fa.ke/post/url2').put()
+
+    preloaded = original_post_discovery.preload_syndicated_posts(
+      self.source, self.activities)
+    self.assertEquals({
+      'https://fa.ke/post/url1': ['http://author/post/1'],
+      'https://fa.ke/post/url2': [None],
+      'https://fa.ke/post/url3': [],
+    }, {url: [r.original for r in rels] for url, rels in preloaded.items()})
+
+    def fail(*args, **kwargs):
+      raise AssertionError('should use preloaded relationships')
+    self.mox.stubs.Set(SyndicatedPost, 'query', fail)
+
+    self.assertEquals(({'http://author/post/1'}, set()),
+                      discover(self.source, self.activities[0],
+                               preloaded=preloaded))
+    self.assertEquals((set(), set()),
+                      discover(self.source, self.activities[1],
+                               preloaded=preloaded))
+
+  def test_preloaded_queries_again_after_hfeed_fetched(self):
+    """If the h-feed was fetched after preloading, discover() should query for
+    relationships it found instead of storing a blank."""
+    preloaded = original_post_discovery.preload_syndicated_posts(
+      self.source, [self.activity])
+    self.assertEquals({'https://fa.ke/post/url': []}, preloaded)
+
+    SyndicatedPost(parent=self.source.key, original='http://author/post/1',
+                   syndication='https://fa.ke/post/url').put()
+    self.assertEquals(({'http://author/post/1'}, set()),
+                      discover(self.source, self.activity, preloaded=preloaded,
+                               already_fetched_hfeeds={'http://author'}))
+    self.assert_syndicated_posts(('http://author/post/1',
+                                  'https://fa.ke/post/url'))
+
+  def test_preloaded_blank_queries_again_after_hfeed_fetched(self):
+    """If a preloaded blank was replaced by an h-feed fetched after preloading,
+    discover() should find the new relationship."""
+    blank = SyndicatedPost(parent=self.source.key, original=None,
+                           syndication='https://fa.ke/post/url')
+    blank.put()
+    preloaded = original_post_discovery.preload_syndicated_posts(
+      self.source, [self.activity])
+    self.assertEquals({'https://fa.ke/post/url': [None]},
+                      {url: [r.original for r in rels]
+                       for url, rels in preloaded.items()})
+
+    blank.key.delete()
+    SyndicatedPost(parent=self.source.key, original='http://author/post/1',
+                   syndication='https://fa.ke/post/url').put()
+    self.assertEquals(({'http://author/post/1'}, set()),
+                      discover(self.source, self.activity, preloaded=preloaded,
+                               already_fetched_hfeeds={'http://author'}))
@@ -67,6 +67,21 @@ class SuperfeedrTest(testutil.HandlerTest):
       [BlogPost(id='A', source=self.source.key, feed_item=item_a,
                 unsent=['http://a.com'])])  # self link should be discarded
 
+  def test_handle_feed_existing_and_duplicate_items(self):
+    item_a = {'permalinkUrl': 'A', 'content': 'a http://a.com a'}
+    item_b = {'permalinkUrl': 'B', 'content': 'b http://b.com b'}
+    existing = BlogPost(id='A', source=self.source.key, feed_item=item_a,
+                        unsent=['http://a.com'], status='complete')
+    existing.put()
+
+    superfeedr.handle_feed(json.dumps({'items': [item_a, item_b, item_b]}),
+                           self.source)
+    self.assertEquals('complete', existing.key.get().status)
+
+    tasks = self.taskqueue_stub.GetTasks('propagate-blogpost')
+    self.assert_equals([{'key': BlogPost(id='B').key.urlsafe()}],
+                       [testutil.get_task_params(t) for t in tasks])
+
   def test_handle_feed_no_items(self):
     superfeedr.handle_feed('{}', self.source)
     self.assert_blogposts([])
@@ -2,6 +2,7 @@
 """Unit tests for tasks.py.
 """
 import bz2
+import collections
 import copy
 import datetime
 import httplib
@@ -11,6 +12,7 @@ import mox
 import socket
 import string
 import StringIO
+import threading
 import time
 import urllib
 import urllib2
@@ -165,6 +167,205 @@ class PollTest(TaskQueueTest):
     params = testutil.get_task_params(tasks[0])
     self.assert_equals(source.key.urlsafe(), params['source_key'])
 
+  def test_poll_stores_responses_in_chunks(self):
+    self.mox.stubs.Set(tasks.Poll, 'BACKFEED_CHUNK_SIZE', 5)
+    self.post_task()
+    self.assertEqual(12, Response.query().count())
+    self.assert_responses()
+    self.assertEqual(12, len(self.taskqueue_stub.GetTasks('propagate')))
+
+  def test_poll_sets_next_poll_at(self):
+    self.post_task()
+    source = self.sources[0].key.get()
+    self.assertAlmostEqual(NOW + FakeSource.FAST_POLL, source.next_poll_at,
+                           delta=FakeSource.FAST_POLL * .2)
+
+    tasks = self.taskqueue_stub.GetTasks('poll')
+    self.assertEqual(1, len(tasks))
+    self.assert_task_eta(source.next_poll_at - NOW)
+
+  def test_poll_scheduler(self):
+    """With the poll scheduler, polls don't add new poll tasks."""
+    self.mox.stubs.Set(FakeSource, 'USE_POLL_SCHEDULER', True)
+    self.post_task()
+    self.assertEqual(12, Response.query().count())
+    self.assertEqual([], self.taskqueue_stub.GetTasks('poll'))
+    self.assertLess(NOW, self.sources[0].key.get().next_poll_at)
+
+  def test_poll_scheduler_clears_dispatch_marker(self):
+    """Finished polls should let the scheduler add the next task right away."""
+    self.mox.stubs.Set(FakeSource, 'USE_POLL_SCHEDULER', True)
+    marker = util.poll_dispatch_marker(self.sources[0].key)
+    memcache.set(marker, True)
+    self.post_task()
+    self.assertIsNone(memcache.get(marker))
+
+  def test_scheduled_poll_not_due(self):
+    """Scheduled tasks for sources that aren't due yet should be dropped."""
+    source = self.sources[0]
+    source.next_poll_at = NOW + datetime.timedelta(minutes=1)
+    source.put()
+
+    super(PollTest, self).post_task(params={'source_key': source.key.urlsafe()})
+    self.assertEqual(0, Response.query().count())
+    self.assertEqual(util.EPOCH, source.key.get().last_poll_attempt)
+
+  def test_scheduled_poll_retry_not_due(self):
+    """The queue's retries of failed scheduled polls should still poll."""
+    source = self.sources[0]
+    source.next_poll_at = NOW + datetime.timedelta(minutes=1)
+    source.put()
+
+    super(PollTest, self).post_task(params={'source_key': source.key.urlsafe()},
+                                    headers={'X-AppEngine-TaskRetryCount': '1'})
+    self.assertEqual(12, Response.query().count())
+
+  def test_scheduled_poll_due(self):
+    source = self.sources[0]
+    source.next_poll_at = NOW - datetime.timedelta(minutes=1)
+    source.put()
+
+    super(PollTest, self).post_task(params={'source_key': source.key.urlsafe()})
+    self.assertEqual(12, Response.query().count())
+
+  def test_incremental_poll(self):
+    self.mox.stubs.Set(FakeSource, 'INCREMENTAL_POLL', True)
+
+    # simulate a silo that returns likes and shares along with posts, e.g.
+    # Facebook and Instagram, so that their counts are in the summaries.
+    get_activities_response = FakeGrSource.get_activities_response
+    def with_reactions(self, **kwargs):
+      kwargs.update(fetch_likes=True, fetch_shares=True)
+      return get_activities_response(self, **kwargs)
+    self.mox.stubs.Set(FakeGrSource, 'get_activities_response', with_reactions)
+
+    # first poll is a full poll
+    self.post_task()
+    self.assertEqual(12, Response.query().count())
+    source = self.sources[0].key.get()
+    self.assertEqual(NOW, source.last_full_poll)
+    self.assertEqual(
+      {a['id']: {'replies': 1, 'likes': 1, 'shares': 1, 'tags': 3,
+                 'updated': None}
+       for a in self.activities},
+      json.loads(source.last_activities_summary_json))
+
+    # new reply on the second post, new like on the third. only those posts
+    # should be refetched.
+    obj = self.activities[1]['object']
+    obj['replies']['items'].append({
+      'objectType': 'comment',
+      'id': 'tag:source.com,2013:1_2_new',
+      'url': 'http://fa.ke/comment/new',
+      'content': 'new reply',
+    })
+    obj['replies']['totalItems'] = 2
+
+    self.activities[2]['object']['tags'].append({
+      'objectType': 'activity',
+      'verb': 'like',
+      'id': 'tag:source.com,2013:c_liked_by_eve',
+      'object': {'url': 'http://example.com/abc'},
+      'author': {'url': 'http://example.com/eve'},
+    })
+
+    self.mox.StubOutWithMock(FakeSource, 'get_activities')
+    for activity, id in (self.activities[1], 'b'), (self.activities[2], 'c'):
+      FakeSource.get_activities(
+        fetch_replies=True, fetch_likes=True, fetch_shares=True,
+        activity_id=id, user_id=source.key.id()
+      ).AndReturn([copy.deepcopy(activity)])
+    self.mox.ReplayAll()
+
+    self.post_task(reset=True)
+    self.assertEqual(14, Response.query().count())
+    self.assertIsNotNone(Response.get_by_id('tag:source.com,2013:1_2_new'))
+    self.assertIsNotNone(Response.get_by_id('tag:source.com,2013:c_liked_by_eve'))
+
+    # responses to the other posts weren't fetched, but should still be seen
+    source = self.sources[0].key.get()
+    self.assertEqual(14, len(source.seen_response_fingerprints))
+    self.assertEqual(NOW, source.last_full_poll)
+
+  def test_incremental_poll_summaries(self):
+    self.mox.stubs.Set(FakeSource, 'INCREMENTAL_POLL', True)
+    get_activities_response = FakeGrSource.get_activities_response
+    def with_reactions(self, **kwargs):
+      kwargs.update(fetch_likes=True, fetch_shares=True)
+      return get_activities_response(self, **kwargs)
+    self.mox.stubs.Set(FakeGrSource, 'get_activities_response', with_reactions)
+
+    self.post_task()
+    source = self.sources[0].key.get()
+    summaries = json.loads(source.last_activities_summary_json)
+    self.assertEqual(3, len(summaries))
+
+    # a poll that returns just some posts keeps the others' summaries
+    FakeGrSource.activities = self.activities[:1]
+    self.post_task(reset=True)
+    source = self.sources[0].key.get()
+    self.assertEqual(summaries, json.loads(source.last_activities_summary_json))
+
+    # if backfeed fails, the new summaries shouldn't be stored
+    self.activities[0]['object']['replies']['totalItems'] = 2
+    self.mox.StubOutWithMock(tasks.Poll, 'backfeed')
+    tasks.Poll.backfeed(mox.IgnoreArg(), mox.IgnoreArg(),
+                        activities=mox.IgnoreArg(), incremental=True
+                        ).AndRaise(ValueError('boom'))
+    self.mox.StubOutWithMock(FakeSource, 'get_activities')
+    FakeSource.get_activities(
+      fetch_replies=True, fetch_likes=True, fetch_shares=True,
+      activity_id='a', user_id=source.key.id()
+    ).AndReturn([copy.deepcopy(self.activities[0])])
+    self.mox.ReplayAll()
+
+    self.post_task(expected_status=500, reset=True)
+    source = self.sources[0].key.get()
+    self.assertEqual(summaries, json.loads(source.last_activities_summary_json))
+
+  def test_poll_stats(self):
+    self.activities[0]['published'] = '2017-01-01T00:00:00'
+    self.post_task()
+    source = self.sources[0].key.get()
+    self.assertEqual({'responses': 12, 'posts': 1}, source.poll_stats)
+
+    # timings for /admin/poll_stats
+    poll_stats = models.PollStats.get_by_id(source.key.urlsafe())
+    self.assertEqual(1, len(poll_stats.polls))
+    self.assertIn('store', poll_stats.polls[0]['phases'])
+
+    # nothing new, and the old counts decay away since the last poll was so
+    # long ago
+    self.post_task(reset=True)
+    source = self.sources[0].key.get()
+    self.assertEqual({'responses': 0, 'posts': 0}, source.poll_stats)
+
+  def test_store_failure_only_saves_stored_fingerprints(self):
+    """If storing responses fails partway, only the stored responses should be
+    marked seen."""
+    self.mox.stubs.Set(tasks.Poll, 'BACKFEED_CHUNK_SIZE', 5)
+    get_or_save_multi = Response.get_or_save_multi
+    calls = []
+    def fail_second_chunk(source, responses, **kwargs):
+      calls.append(responses)
+      if len(calls) == 2:
+        raise ValueError('boom')
+      return get_or_save_multi(source, responses, **kwargs)
+    self.mox.stubs.Set(Response, 'get_or_save_multi',
+                       staticmethod(fail_second_chunk))
+
+    self.post_task(expected_status=500)
+    stored = [r.key.id() for r in Response.query()]
+    self.assertEqual(5, len(stored))
+    self.assertItemsEqual(
+      stored, self.sources[0].key.get().seen_response_fingerprints.keys())
+    self.assertEqual(5, len(self.taskqueue_stub.GetTasks('propagate')))
+
+  def test_poll_stats_sampled(self):
+    models.PollStats.SAMPLE_RATE = 0
+    self.post_task()
+    self.assertEqual(0, models.PollStats.query().count())
+
   def test_poll_status_polling(self):
     def check_poll_status(*args, **kwargs):
       self.assertEqual('polling', self.sources[0].key.get().poll_status)
@@ -1173,12 +1374,13 @@ class PollTest(TaskQueueTest):
     self._change_response_and_poll()
 
     # return new response *and* existing response. both should be stored in
-    # Source.seen_responses_cache_json
+    # Source.seen_response_fingerprints
     replies = activity['object']['replies']['items']
     replies.append(self.activities[1]['object']['replies']['items'][0])
 
     self.post_task(reset=True)
-    self.assert_equals(replies, json.loads(source.key.get().seen_responses_cache_json))
+    self.assert_equals(self._fingerprints(replies),
+                       source.key.get().seen_response_fingerprints)
     self.responses[4].key.delete()
 
     # new responses that don't include existing response. cache will have
@@ -1189,7 +1391,28 @@ class PollTest(TaskQueueTest):
     self.post_task(reset=True)
     self.assert_equals([r.key for r in self.responses[:4]],
                        list(Response.query().iter(keys_only=True)))
-    self.assert_equals(tags, json.loads(source.key.get().seen_responses_cache_json))
+    self.assert_equals(self._fingerprints(tags),
+                       source.key.get().seen_response_fingerprints)
+
+  def test_migrate_seen_responses_cache_json(self):
+    """The old seen responses cache should be converted to fingerprints."""
+    source = self.sources[0]
+    FakeGrSource.activities = [self.activities[0]]
+    replies = self.activities[0]['object']['replies']['items']
+    tags = self.activities[0]['object']['tags']
+
+    source.seen_responses_cache_json = json.dumps(replies + tags)
+    source.put()
+
+    self.post_task()
+    self.assertEqual(0, Response.query().count())
+    source = source.key.get()
+    self.assertIsNone(source.seen_responses_cache_json)
+    self.assert_equals(self._fingerprints(replies + tags),
+                       source.seen_response_fingerprints)
+
+  def _fingerprints(self, responses):
+    return {r['id']: util.response_fingerprint(r) for r in responses}
 
   def _change_response_and_poll(self):
     resp = self.responses[0].key.get() or self.responses[0]
@@ -1218,7 +1441,8 @@ class PollTest(TaskQueueTest):
     self.taskqueue_stub.FlushQueue('propagate')
 
     source = self.sources[0].key.get()
-    self.assert_equals([reply], json.loads(source.seen_responses_cache_json))
+    self.assert_equals(self._fingerprints([reply]),
+                       source.seen_response_fingerprints)
 
   def test_in_blocklist(self):
     """Responses from blocked users should be ignored."""
@@ -1437,7 +1661,33 @@ class PropagateTest(TaskQueueTest):
       self.assert_response_is('complete', now + LEASE_LENGTH,
                               sent=['http://target1/post/url'], response=r)
       self.assert_equals(now, self.sources[0].key.get().last_webmention_sent)
-      memcache.flush_all()
+      util.WebmentionEndpoint.invalidate(['http://target1/post/url'])
+
+  def test_propagate_multiple_responses(self):
+    """A task with multiple responses leases and sends each one separately."""
+    # responses[1] is already leased by another task
+    self.responses[1].status = 'processing'
+    leased_until = NOW + datetime.timedelta(minutes=1)
+    self.responses[1].leased_until = leased_until
+    self.responses[1].put()
+
+    id = self.sources[0].key.string_id()
+    self.expect_webmention().AndReturn(True)
+    self.expect_webmention(source_url='http://localhost/repost/fake/%s/a/bob' % id,
+                           input_endpoint='http://webmention/endpoint'
+                           ).AndReturn(True)
+    self.mox.ReplayAll()
+
+    TaskQueueTest.post_task(self, expected_status=ERROR_HTTP_RETURN_CODE, params=[
+      ('response_key', r.key.urlsafe()) for r in self.responses[:3]])
+
+    sent = ['http://target1/post/url']
+    self.assert_response_is('complete', NOW + LEASE_LENGTH, sent=sent,
+                            response=self.responses[0])
+    self.assert_response_is('processing', leased_until, unsent=sent,
+                            response=self.responses[1])
+    self.assert_response_is('complete', NOW + LEASE_LENGTH, sent=sent,
+                            response=self.responses[2])
 
   def test_propagate_from_error(self):
     """A normal propagate task, with a response starting as 'error'."""
@@ -1544,35 +1794,48 @@ class PropagateTest(TaskQueueTest):
     self.expect_webmention().AndReturn(True)
     self.mox.ReplayAll()
 
-    # inject a fake time.time into the memcache stub.
-    #
-    # ideally i'd do this:
-    #
-    #   self.testbed.init_memcache_stub(gettime=time_fn)
-    #
-    # but testbed doesn't pass kwargs to the memcache stub ctor like it does for
-    # most other stubs. :( i started to file a patch against the app engine SDK,
-    # but i eventually got impatient and gave up. background:
-    # https://code.google.com/p/googleappengine/
-    # https://code.google.com/p/googleappengine/issues/list?can=1&q=patch&sort=-id
-    now = time.time()
-    self.testbed.get_stub('memcache')._gettime = lambda: now
+    now = NOW
+    util.now_fn = lambda: now
 
     self.post_task()
     self.assert_response_is('complete', skipped=['http://target1/post/url'])
 
-    now += tasks.WEBMENTION_DISCOVERY_CACHE_TIME - 1
+    now += util.WEBMENTION_ENDPOINT_FRESH - datetime.timedelta(seconds=1)
     self.responses[0].status = 'new'
     self.responses[0].put()
     self.post_task()
     self.assert_response_is('complete', skipped=['http://target1/post/url'])
 
-    now += 2
+    now += datetime.timedelta(seconds=2)
     self.responses[0].status = 'new'
     self.responses[0].put()
     self.post_task()
     self.assert_response_is('complete', sent=['http://target1/post/url'])
 
+  def test_stale_webmention_endpoint_rediscovered_in_background(self):
+    """A stale cached endpoint should be used, and rediscovered in a task."""
+    util.WebmentionEndpoint.store('http://target1/post/url',
+                                  endpoint='http://stale/endpoint')
+    self.expect_webmention(input_endpoint='http://stale/endpoint'
+                           ).AndReturn(True)
+    self.expect_webmention(input_endpoint='http://stale/endpoint'
+                           ).AndReturn(True)
+    self.mox.ReplayAll()
+
+    util.now_fn = lambda: NOW + util.WEBMENTION_ENDPOINT_FRESH
+    self.post_task()
+    self.assert_response_is('complete', sent=['http://target1/post/url'])
+
+    # only one rediscovery task at a time
+    self.responses[0].status = 'new'
+    self.responses[0].put()
+    self.post_task()
+
+    added = self.taskqueue_stub.GetTasks('discover-endpoint')
+    self.assertEqual(1, len(added))
+    self.assertEqual({'url': 'http://target1/post/url'},
+                     testutil.get_task_params(added[0]))
+
   def test_webmention_blacklist(self):
     """Target URLs with domains in the blacklist should be ignored.
 
@@ -1766,6 +2029,32 @@ class PropagateTest(TaskQueueTest):
     self.post_task()
     self.assert_equals('yes', self.sources[0].key.get().webmention_endpoint)
 
+  def test_source_updates_written_once(self):
+    """Source bookkeeping for all sent targets should be one write."""
+    self.responses[0].unsent = ['http://foo/1', 'http://bar/2', 'http://baz/3']
+    self.responses[0].put()
+    self.sources[0].domains = ['foo']
+    self.sources[0].put()
+
+    for target in self.responses[0].unsent:
+      self.expect_webmention(target=target, discovered_endpoint='yes'
+                             ).InAnyOrder().AndReturn(True)
+    self.mox.ReplayAll()
+
+    puts = []
+    put_updates = models.Source.put_updates
+    def count_put_updates(source):
+      puts.append(dict(source.updates))
+      return put_updates(source)
+    self.mox.stubs.Set(models.Source, 'put_updates', count_put_updates)
+
+    self.post_task()
+    self.assertEquals([{'last_webmention_sent': NOW,
+                        'webmention_endpoint': 'yes'}], puts)
+    source = self.sources[0].key.get()
+    self.assert_equals(NOW, source.last_webmention_sent)
+    self.assert_equals('yes', source.webmention_endpoint)
+
   def test_leased(self):
     """If the response is processing and the lease hasn't expired, do nothing."""
     self.responses[0].status = 'processing'
@@ -1793,6 +2082,25 @@ class PropagateTest(TaskQueueTest):
     self.assert_response_is('complete', NOW + LEASE_LENGTH,
                            sent=['http://target1/post/url'])
 
+  def test_lease_stolen(self):
+    """If another task leases the response after us, we shouldn't complete it."""
+    leased_until = NOW + LEASE_LENGTH + datetime.timedelta(minutes=1)
+
+    def steal(*args, **kwargs):
+      response = self.responses[0].key.get()
+      self.assertEqual(1, response.lease_version)
+      response.lease_version = 2
+      response.leased_until = leased_until
+      response.put()
+
+    self.expect_webmention().WithSideEffects(steal).AndReturn(True)
+    self.mox.ReplayAll()
+
+    self.post_task()
+    self.assert_response_is('processing', leased_until,
+                            unsent=['http://target1/post/url'])
+    self.assertEqual(2, self.responses[0].key.get().lease_version)
+
   def test_no_response(self):
     """If the response doesn't exist, the request should fail."""
     self.responses[0].key.delete()
@@ -1872,6 +2180,90 @@ class PropagateTest(TaskQueueTest):
                             sent=['http://good'])
     self.assert_equals(NOW, self.sources[0].key.get().last_webmention_sent)
 
+  def test_send_in_parallel(self):
+    """Targets are sent concurrently but recorded in target order."""
+    util.MAX_FETCH_THREADS = 4
+    targets = ['http://a/1', 'http://a/2', 'http://a/3', 'http://b/1',
+               'http://c/1', 'http://d/1']
+    self.responses[0].unsent = targets
+    self.responses[0].put()
+
+    running = collections.defaultdict(int)
+    max_running = collections.defaultdict(int)
+    lock = threading.Lock()
+
+    class FakeSend(object):
+      def __init__(self, source_url, target_url, endpoint=None):
+        self.target_url = target_url
+        self.receiver_endpoint = endpoint or 'http://webmention/endpoint'
+        self.response = 'used in logging'
+        self.error = None
+
+      def send(self, **kwargs):
+        domain = util.domain_from_link(self.target_url)
+        with lock:
+          running[domain] += 1
+          max_running[domain] = max(max_running[domain], running[domain])
+        time.sleep(.01)
+        with lock:
+          running[domain] -= 1
+
+        if domain == 'c':
+          self.error = {'code': 'FOO'}
+        elif domain == 'd':
+          self.error = {'code': 'NO_ENDPOINT'}
+        return not self.error
+
+    self.mox.stubs.Set(send, 'WebmentionSend', FakeSend)
+    self.post_task(expected_status=ERROR_HTTP_RETURN_CODE)
+    self.assert_response_is('error', None, error=['http://c/1'],
+                            skipped=['http://d/1'], sent=targets[:4])
+    self.assertLessEqual(max_running['a'],
+                         tasks.SendWebmentions.MAX_SENDS_PER_DOMAIN)
+
+  def test_circuit_breaker(self):
+    """Targets whose receivers keep failing should be deferred, not sent."""
+    self.responses[0].unsent = ['http://target1/a', 'http://target1/b',
+                                'http://target2/c']
+    self.responses[0].put()
+    for _ in range(util.CIRCUIT_BREAKER_THRESHOLD - 1):
+      util.record_receiver_result('target1', ok=False)
+
+    # this failure trips target1's breaker, so we shouldn't send to b
+    self.expect_webmention(target='http://target1/a', error={
+      'code': 'RECEIVER_ERROR', 'http_status': 503}).AndReturn(False)
+    self.expect_webmention(target='http://target2/c').AndReturn(True)
+    self.mox.ReplayAll()
+
+    self.post_task(expected_status=ERROR_HTTP_RETURN_CODE)
+    self.assert_response_is('error', None, sent=['http://target2/c'],
+                            error=['http://target1/a', 'http://target1/b'])
+    self.assertEqual(0, len(self.taskqueue_stub.GetTasks('propagate')))
+
+    # now every remaining target is blocked, so the task should defer itself
+    self.post_task()
+    self.assert_response_is('error', None, sent=['http://target2/c'],
+                            error=['http://target1/a', 'http://target1/b'])
+    added = self.taskqueue_stub.GetTasks('propagate')
+    self.assertEqual(1, len(added))
+    eta = testutil.get_task_eta(added[0])
+    expected = datetime.datetime.now() + util.CIRCUIT_BREAKER_OPEN_TIME
+    self.assertLess(abs(eta - expected), datetime.timedelta(seconds=10))
+
+  def test_circuit_breaker_past_max_defer_age(self):
+    """Old responses blocked by circuit breakers should fail and be retried."""
+    self.responses[0].unsent = ['http://target1/a']
+    self.responses[0].created = (testutil.NOW -
+                                 tasks.SendWebmentions.MAX_DEFER_AGE -
+                                 datetime.timedelta(hours=1))
+    self.responses[0].put()
+    for _ in range(util.CIRCUIT_BREAKER_THRESHOLD):
+      util.record_receiver_result('target1', ok=False)
+
+    self.post_task(expected_status=ERROR_HTTP_RETURN_CODE)
+    self.assert_response_is('error', None, error=['http://target1/a'])
+    self.assertEqual(0, len(self.taskqueue_stub.GetTasks('propagate')))
+
   def test_dns_failure(self):
     """If DNS lookup fails for a URL, we should give up.
     https://github.com/snarfed/bridgy/issues/254
@@ -1972,6 +2364,15 @@ class PropagateTest(TaskQueueTest):
     self.post_task(expected_status=500)
     self.assert_response_is('error', None, sent=['http://target1/post/url'])
 
+  def test_prepare_source_urls_exception(self):
+    """If preparing source URLs raises an exception, the lease should be
+    released."""
+    self.responses[0].urls_to_activity = 'not json'
+    self.responses[0].put()
+
+    self.post_task(expected_status=500)
+    self.assert_response_is('error', None, unsent=['http://target1/post/url'])
+
   def test_source_url_key_error(self):
     """We should gracefully retry when we hit the KeyError bug.
 
@@ -2060,3 +2461,44 @@ class PropagateTest(TaskQueueTest):
                           ).AndReturn(True)
     self.mox.ReplayAll()
     self.post_task()
+
+
+class DiscoverEndpointTest(TaskQueueTest):
+
+  post_url = '/_ah/queue/discover-endpoint'
+
+  def post_task(self, **kwargs):
+    super(DiscoverEndpointTest, self).post_task(
+      params={'url': 'http://target/post'}, **kwargs)
+
+  def test_discover(self):
+    util.WebmentionEndpoint.store('http://target/post', endpoint='http://old')
+    self.expect_webmention_requests_get(
+      'http://target/post', '<link rel="webmention" href="http://new">',
+      timeout=appengine_config.HTTP_TIMEOUT, verify=False)
+    self.mox.ReplayAll()
+
+    self.post_task()
+    self.assertEqual('http://new',
+                     util.WebmentionEndpoint.load('http://target/post').endpoint)
+
+  def test_no_endpoint(self):
+    self.expect_webmention_requests_get(
+      'http://target/post', 'no endpoint here',
+      timeout=appengine_config.HTTP_TIMEOUT, verify=False)
+    self.mox.ReplayAll()
+
+    self.post_task()
+    cached = util.WebmentionEndpoint.load('http://target/post')
+    self.assertEqual('NO_ENDPOINT', cached.error['code'])
+
+  def test_fetch_fails_keeps_cached_endpoint(self):
+    util.WebmentionEndpoint.store('http://target/post', endpoint='http://old')
+    self.expect_webmention_requests_get(
+      'http://target/post', status_code=500,
+      timeout=appengine_config.HTTP_TIMEOUT, verify=False)
+    self.mox.ReplayAll()
+
+    self.post_task()
+    self.assertEqual('http://old',
+                     util.WebmentionEndpoint.load('http://target/post').endpoint)
@@ -3,6 +3,7 @@
 import copy
 import datetime
 import json
+import threading
 import time
 import urllib
 import urlparse
@@ -10,7 +11,10 @@ import urlparse
 from appengine_config import HTTP_TIMEOUT
 
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
+import requests
+from requests_toolbelt.adapters import appengine
 import webapp2
 from webmentiontools import send
 from webob import exc
@@ -123,6 +127,27 @@ class UtilTest(testutil.ModelsTest):
       ):
       self.assert_equals(expected, util.prune_activity(orig, self.sources[0]))
 
+  def test_response_fingerprint(self):
+    resp = {'id': 'tag:x,2013:1', 'objectType': 'comment', 'content': 'X',
+            'object': {'content': 'Y'}}
+    fingerprint = util.response_fingerprint(resp)
+
+    # fields that activity_changed() ignores don't matter, nor do empty values
+    for same in (
+        dict(resp, url='http://other', published='2016-01-01'),
+        dict(resp, location=None, to=[]),
+        dict(resp, object={'content': 'Y', 'id': 'other', 'image': {}}),
+      ):
+      self.assertEquals(fingerprint, util.response_fingerprint(same))
+
+    for changed in (
+        dict(resp, content='Z'),
+        dict(resp, verb='like'),
+        dict(resp, object={'content': 'Z'}),
+        dict(resp, to=[{'objectType': 'group', 'alias': '@public'}]),
+      ):
+      self.assertNotEquals(fingerprint, util.response_fingerprint(changed))
+
   def test_webmention_tools_relative_webmention_endpoint_in_body(self):
     super(testutil.HandlerTest, self).expect_requests_get('http://target/', """
 <html><meta>
@@ -416,3 +441,293 @@ class UtilTest(testutil.ModelsTest):
 
     self.assertEquals(102, memcache.get('timed foo'))
     self.assertEquals(3, memcache.get('timed foo size'))
+
+  def test_map_in_parallel(self):
+    self.assertEquals([], util.map_in_parallel(lambda x: x * 2, [], max_threads=3))
+    self.assertEquals([2, 4, 6, 8, 10], util.map_in_parallel(
+      lambda x: x * 2, [1, 2, 3, 4, 5], max_threads=3))
+
+  def test_map_in_parallel_serial(self):
+    threads = set()
+    def fn(x):
+      threads.add(threading.current_thread())
+      return x
+
+    self.assertEquals([1, 2, 3], util.map_in_parallel(fn, [1, 2, 3]))
+    self.assertEquals({threading.current_thread()}, threads)
+
+  def test_map_in_parallel_reraises_first_exception(self):
+    done = []
+    def fn(x):
+      if x % 2:
+        raise ValueError(x)
+      done.append(x)
+
+    with self.assertRaises(ValueError) as e:
+      util.map_in_parallel(fn, [2, 3, 4, 5, 6], max_threads=3)
+    self.assertEquals((3,), e.exception.args)
+    self.assertEquals([2, 4, 6], sorted(done))
+
+  def test_map_in_parallel_max_per_key(self):
+    lock = threading.Lock()
+    running = {'a': 0, 'b': 0}
+    max_running = {'a': 0, 'b': 0}
+
+    def fn(x):
+      with lock:
+        running[x] += 1
+        max_running[x] = max(max_running[x], running[x])
+      time.sleep(.01)
+      with lock:
+        running[x] -= 1
+      return x
+
+    args = ['a'] * 6 + ['b'] * 2
+    self.assertEquals(args, util.map_in_parallel(
+      fn, args, max_threads=4, key=lambda x: x, max_per_key=2))
+    self.assertEquals({'a': 2, 'b': 2}, max_running)
+
+  def test_batch_tasks(self):
+    source = self.sources[0]
+    with util.batch_tasks():
+      for i in range(taskqueue.MAX_TASKS_PER_ADD + 1):
+        util.add_discover_task(source, str(i))
+
+      with util.batch_tasks():  # nested block joins the outer batch
+        util.add_poll_task(source)
+
+      self.assertEquals([], self.taskqueue_stub.GetTasks('discover'))
+      self.assertEquals([], self.taskqueue_stub.GetTasks('poll'))
+
+    tasks = self.taskqueue_stub.GetTasks('discover')
+    self.assertEquals(taskqueue.MAX_TASKS_PER_ADD + 1, len(tasks))
+    self.assertItemsEqual(
+      [str(i) for i in range(taskqueue.MAX_TASKS_PER_ADD + 1)],
+      [testutil.get_task_params(t)['post_id'] for t in tasks])
+    self.assertEquals(1, len(self.taskqueue_stub.GetTasks('poll')))
+
+  def test_batch_tasks_transactional(self):
+    @ndb.transactional
+    def add():
+      util.add_poll_task(self.sources[0], transactional=True)
+
+    with util.batch_tasks():
+      add()
+      self.assertEquals(1, len(self.taskqueue_stub.GetTasks('poll')))
+
+  def test_batch_tasks_flushes_on_exception(self):
+    with self.assertRaises(ValueError):
+      with util.batch_tasks():
+        util.add_poll_task(self.sources[0])
+        raise ValueError()
+
+    self.assertEquals(1, len(self.taskqueue_stub.GetTasks('poll')))
+
+  def test_webmention_endpoint_per_path(self):
+    WebmentionEndpoint = util.WebmentionEndpoint
+    self.assertIsNone(WebmentionEndpoint.load('http://site/a'))
+
+    WebmentionEndpoint.store('http://site/a', endpoint='http://site/wm')
+    self.assertEqual('http://site/wm',
+                     WebmentionEndpoint.load('http://site/b').value)
+
+    # a page with a different endpoint gets its own result
+    error = {'code': 'NO_ENDPOINT'}
+    WebmentionEndpoint.store('http://site/b', error=error)
+    self.assertEqual(error, WebmentionEndpoint.load('http://site/b').value)
+    self.assertEqual('http://site/wm',
+                     WebmentionEndpoint.load('http://site/a').value)
+    self.assertEqual('http://site/wm',
+                     WebmentionEndpoint.load('http://site/c').value)
+
+    # ...until it matches its site again
+    WebmentionEndpoint.store('http://site/b', endpoint='http://site/wm')
+    self.assertIsNone(WebmentionEndpoint.get_by_id('W http site /b'))
+    self.assertEqual('http://site/wm',
+                     WebmentionEndpoint.load('http://site/b').value)
+
+    WebmentionEndpoint.invalidate(['http://site/b'])
+    self.assertIsNone(WebmentionEndpoint.load('http://site/a'))
+
+  def test_webmention_endpoint_load_multi(self):
+    WebmentionEndpoint = util.WebmentionEndpoint
+    WebmentionEndpoint.store('http://site/a', endpoint='http://site/wm')
+    error = {'code': 'NO_ENDPOINT'}
+    WebmentionEndpoint.store('http://site/b', error=error)
+    util._webmention_endpoints.clear()
+
+    # one datastore batch for all of the URLs
+    get_multi = ndb.get_multi
+    calls = []
+    def count_get_multi(keys, **kwargs):
+      calls.append(keys)
+      return get_multi(keys, **kwargs)
+    self.mox.stubs.Set(ndb, 'get_multi', count_get_multi)
+
+    found = WebmentionEndpoint.load_multi(
+      ['http://site/a', 'http://site/b', 'http://site/c', 'http://other/'])
+    self.assertEqual(1, len(calls))
+    self.assertEqual('http://site/wm', found['http://site/a'].value)
+    self.assertEqual(error, found['http://site/b'].value)
+    self.assertEqual('http://site/wm', found['http://site/c'].value)
+    self.assertIsNone(found['http://other/'])
+
+  def test_webmention_endpoint_refreshes_stale_site_result(self):
+    WebmentionEndpoint = util.WebmentionEndpoint
+    WebmentionEndpoint.store('http://site/a', endpoint='http://site/old')
+
+    # rediscovery on another page finds a new endpoint for the whole site
+    util.now_fn = lambda: (testutil.NOW + util.WEBMENTION_ENDPOINT_LRU_TTL +
+                           util.WEBMENTION_ENDPOINT_FRESH)
+    WebmentionEndpoint.store('http://site/b', endpoint='http://site/new')
+    self.assertIsNone(WebmentionEndpoint.get_by_id('W http site /b'))
+    for url in 'http://site/a', 'http://site/b', 'http://site/c':
+      self.assertEqual('http://site/new', WebmentionEndpoint.load(url).value)
+
+  def test_add_discover_endpoint_task_per_path(self):
+    util.add_discover_endpoint_task('http://site/a')
+    util.add_discover_endpoint_task('http://site/a')
+    util.add_discover_endpoint_task('http://site/b')
+    self.assertEqual(
+      [{'url': 'http://site/a'}, {'url': 'http://site/b'}],
+      [testutil.get_task_params(task) for task in
+       self.taskqueue_stub.GetTasks('discover-endpoint')])
+
+  def test_webmention_endpoint_lru_and_max_age(self):
+    WebmentionEndpoint = util.WebmentionEndpoint
+    WebmentionEndpoint.store('http://site/a', endpoint='http://site/wm')
+    cached = WebmentionEndpoint.load('http://site/a')
+    self.assertTrue(cached.is_fresh())
+
+    # served from the in-process cache until it expires
+    cached.key.delete()
+    self.assertEqual(cached, WebmentionEndpoint.load('http://site/a'))
+    util.now_fn = lambda: testutil.NOW + util.WEBMENTION_ENDPOINT_LRU_TTL
+    self.assertIsNone(WebmentionEndpoint.load('http://site/a'))
+
+    # stale results are still returned, until they hit the max age
+    WebmentionEndpoint.store('http://site/a', endpoint='http://site/wm')
+    util.now_fn = lambda: (testutil.NOW + util.WEBMENTION_ENDPOINT_LRU_TTL +
+                           util.WEBMENTION_ENDPOINT_FRESH)
+    self.assertFalse(WebmentionEndpoint.load('http://site/a').is_fresh())
+    util.now_fn = lambda: (testutil.NOW + util.WEBMENTION_ENDPOINT_LRU_TTL +
+                           util.WEBMENTION_ENDPOINT_MAX_AGE)
+    self.assertIsNone(WebmentionEndpoint.load('http://site/a'))
+
+  def test_http_session(self):
+    self.assertIsNone(util.http_session())
+
+    util.USE_HTTP_SESSION = True
+    session = util.http_session()
+    self.assertIs(session, util.http_session())
+    self.assertEqual(util.REQUEST_HEADERS['User-Agent'],
+                     session.headers['User-Agent'])
+    self.assertIsInstance(session.get_adapter('https://foo'),
+                          appengine.AppEngineAdapter)
+
+    # one per thread, since sessions aren't thread safe
+    other = []
+    thread = threading.Thread(target=lambda: other.append(util.http_session()))
+    thread.start()
+    thread.join()
+    self.assertIsNot(session, other[0])
+
+    resp = requests.Response()
+    resp.status_code = 200
+    self.mox.StubOutWithMock(session, 'request')
+    session.request('GET', 'http://foo', stream=True, timeout=HTTP_TIMEOUT,
+                    headers=util.REQUEST_HEADERS).AndReturn(resp)
+    session.request('POST', 'http://foo', data='x', timeout=HTTP_TIMEOUT,
+                    headers=util.REQUEST_HEADERS).AndReturn(resp)
+    self.mox.ReplayAll()
+
+    self.assertIs(resp, util.requests_get('http://foo', session=session))
+    self.assertIs(resp, util.requests_post('http://foo', session=session,
+                                           data='x'))
+
+  def test_circuit_breaker(self):
+    self.assertIsNone(util.receiver_blocked_for('foo.com'))
+
+    # trips after enough consecutive failures
+    for _ in range(util.CIRCUIT_BREAKER_THRESHOLD - 1):
+      util.record_receiver_result('foo.com', ok=False)
+    self.assertIsNone(util.receiver_blocked_for('foo.com'))
+    util.record_receiver_result('foo.com', ok=False)
+    open_time = util.CIRCUIT_BREAKER_OPEN_TIME
+    self.assertEqual(open_time, util.receiver_blocked_for('foo.com'))
+    self.assertIsNone(util.receiver_blocked_for('bar.com'))
+
+    # half open: lets one probe through at a time
+    util.now_fn = lambda: testutil.NOW + open_time
+    self.assertIsNone(util.receiver_blocked_for('foo.com'))
+    self.assertEqual(util.CIRCUIT_BREAKER_PROBE_TIMEOUT,
+                     util.receiver_blocked_for('foo.com'))
+
+    # probe fails, trips again for twice as long
+    util.record_receiver_result('foo.com', ok=False)
+    self.assertEqual(open_time * 2, util.receiver_blocked_for('foo.com'))
+
+    # probe succeeds, closes
+    util.now_fn = lambda: testutil.NOW + open_time * 3
+    self.assertIsNone(util.receiver_blocked_for('foo.com'))
+    util.record_receiver_result('foo.com', ok=True)
+    self.assertIsNone(util.receiver_blocked_for('foo.com'))
+    self.assertIsNone(util.receiver_blocked_for('foo.com'))
+
+    # a success resets the failure count
+    for _ in range(util.CIRCUIT_BREAKER_THRESHOLD - 1):
+      util.record_receiver_result('foo.com', ok=False)
+    util.record_receiver_result('foo.com', ok=True)
+    util.record_receiver_result('foo.com', ok=False)
+    self.assertIsNone(util.receiver_blocked_for('foo.com'))
+
+  def test_propagate_queue_shards(self):
+    keys = [source.key for source in self.sources]
+    self.assertEqual(['propagate'] * len(keys),
+                     [util.propagate_queue('propagate', key) for key in keys])
+
+    util.PROPAGATE_QUEUE_SHARDS = 4
+    self.assertEqual('propagate', util.propagate_queue('propagate', None))
+    for key in keys:
+      queue = util.propagate_queue('propagate', key)
+      self.assertIn(queue, ('propagate', 'propagate-1', 'propagate-2',
+                            'propagate-3'))
+      # stable
+      self.assertEqual(queue, util.propagate_queue('propagate', key))
+
+    # tasks still go to the propagate handler
+    response = self.responses[0]
+    response.source = keys[0]
+    util.add_propagate_task(response)
+    queue = util.propagate_queue('propagate', keys[0])
+    tasks = self.taskqueue_stub.GetTasks(queue)
+    self.assertEqual(1, len(tasks))
+    self.assertEqual('/_ah/queue/propagate', tasks[0]['url'])
+
+  def test_collect_stats(self):
+    # no-op outside collect_stats()
+    with util.phase('x'):
+      pass
+
+    with util.collect_stats() as stats:
+      with util.phase('a'):
+        pass
+      with util.phase('a'):
+        pass
+
+      def fn(_):
+        with util.phase('b'):
+          pass
+      util.map_in_parallel(fn, [1, 2])
+
+    self.assertItemsEqual(['a', 'b'], stats.phases.keys())
+    self.assertEqual({'phases': stats.phases, 'http_calls': 0, 'http_bytes': 0},
+                     stats.to_dict())
+
+    # restores the outer stats, if any
+    with util.collect_stats() as outer:
+      with util.collect_stats():
+        pass
+      with util.phase('c'):
+        pass
+    self.assertEqual(['c'], outer.phases.keys())
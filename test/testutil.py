@@ -12,7 +12,7 @@ import appengine_config
 from granary import source as gr_source
 from google.appengine.datastore import datastore_stub_util
 from google.appengine.ext import ndb
-from models import BlogPost, Publish, PublishedPage, Response, Source
+from models import BlogPost, PollStats, Publish, PublishedPage, Response, Source
 from oauth_dropins.models import BaseAuth
 from oauth_dropins.webutil import testutil
 # mirror some methods from webutil.testutil
@@ -20,6 +20,7 @@ from oauth_dropins import handlers as oauth_handlers
 from oauth_dropins.webutil.testutil import get_task_eta, get_task_params
 import requests
 
+import original_post_discovery
 import util
 
 NOW = datetime.datetime.utcnow()
@@ -224,6 +225,26 @@ class HandlerTest(testutil.HandlerTest):
     FakeGrSource.clear()
     util.now_fn = lambda: NOW
 
+    # mox expects calls in a fixed order, so run concurrent fetches serially.
+    # tests that exercise concurrency pass max_threads explicitly.
+    util.MAX_FETCH_THREADS = 1
+
+    # use just the original propagate queues, not their shards
+    util.PROPAGATE_QUEUE_SHARDS = 1
+
+    # don't use per-thread sessions, so that tests can mock requests.get() etc.
+    util.USE_HTTP_SESSION = False
+
+    # the in-process webmention endpoint cache outlives each test's datastore
+    util._webmention_endpoints.clear()
+
+    # many tests fetch the same page more than once and expect original post
+    # discovery to process it each time
+    original_post_discovery.CONDITIONAL_GET = False
+
+    # record every poll's stats, so that tests are deterministic
+    PollStats.SAMPLE_RATE = 1
+
     # we use global queries in tests to verify entities in the datastore, so
     # make the datastore stub always return consistent data. not ideal, since it
     # doesn't simulate eventual consistency, but oh well.
@@ -6,27 +6,36 @@ import collections
 import copy
 import Cookie
 import contextlib
+import cookielib
 import datetime
+import hashlib
+import itertools
 import json
 import logging
 import re
+import sys
+import threading
 import time
 import urllib
 import urlparse
+import zlib
 
 import webapp2
 
-from appengine_config import DEBUG
+from appengine_config import DEBUG, HTTP_TIMEOUT
 import bs4
 from granary import source as gr_source
 import humanize
 import mf2py
+import requests
+from requests_toolbelt.adapters import appengine
 from oauth_dropins.webutil import handlers as webutil_handlers
 from oauth_dropins.webutil.models import StringIdModel
 from oauth_dropins.webutil import util
 from oauth_dropins.webutil.util import *
 from webob import exc
 
+from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import mail
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
@@ -86,6 +95,12 @@ with open(os.path.join(_dir, 'beta_users.txt')) as f:
 # http://httparchive.org/interesting.php#bytesperpage
 MAX_HTTP_RESPONSE_SIZE = 500000
 
+# Whether http_session() returns a per-thread requests.Session for callers to
+# pass to requests_get() and requests_post(). It shares headers and config, but
+# not connections, since requests go through urlfetch. Tests turn this off so
+# that they can mock requests.get() etc.
+USE_HTTP_SESSION = True
+
 # Returned as the HTTP status code when an upstream API fails. Not 5xx so that
 # it doesn't show up as a server error in graphs or trigger StackDriver's error
 # reporting.
@@ -94,6 +109,68 @@ ERROR_HTTP_RETURN_CODE = 304  # "Not Modified"
 # Returned as the HTTP status code when we refuse to make or finish a request.
 HTTP_REQUEST_REFUSED_STATUS_CODE = 599
 
+# Max number of threads that map_in_parallel() uses for concurrent outbound
+# fetches inside a single request, e.g. silo API calls in Poll. 1 runs
+# everything serially in the calling thread.
+MAX_FETCH_THREADS = 10
+
+# The fields that granary.source.Source.activity_changed() compares, in both an
+# activity and its object. Used by response_fingerprint().
+ACTIVITY_CHANGED_FIELDS = ('objectType', 'verb', 'to', 'content', 'location',
+                           'image')
+
+# Webmention endpoint discovery results are fresh for this long. After that,
+# sends keep using a cached endpoint while a discover-endpoint task rediscovers
+# it in the background. Results older than the max age are ignored. See
+# WebmentionEndpoint.
+WEBMENTION_ENDPOINT_FRESH = datetime.timedelta(hours=2)
+WEBMENTION_ENDPOINT_MAX_AGE = datetime.timedelta(days=30)
+# How long to wait before adding another discover-endpoint task for the same
+# stale result.
+WEBMENTION_ENDPOINT_REDISCOVER_INTERVAL = datetime.timedelta(minutes=10)
+
+# Number of shards of the propagate and propagate-blogpost queues. Shard 0 is
+# the original queue, e.g. propagate, and the rest are propagate-1,
+# propagate-2, etc, each in queue.yaml. Each shard runs one task at a time, and
+# all of a source's tasks go to the same shard, so tasks for a given entity
+# never run concurrently, but different sources propagate in parallel. See
+# propagate_queue(). Changing this moves sources to different shards, so
+# briefly, two tasks for the same entity may run at once. Leases still
+# protect against that.
+PROPAGATE_QUEUE_SHARDS = 4
+
+# Circuit breakers for webmention receivers, per domain, shared across
+# instances in memcache. After CIRCUIT_BREAKER_THRESHOLD consecutive retryable
+# failures, e.g. 5xx or timeouts, a domain's breaker opens and we don't send to
+# it for CIRCUIT_BREAKER_OPEN_TIME, doubling every time it trips again, up to
+# CIRCUIT_BREAKER_MAX_OPEN_TIME. After that it's half open: one send at a time
+# goes through as a probe, for up to CIRCUIT_BREAKER_PROBE_TIMEOUT. A success
+# closes the breaker. See receiver_blocked_for().
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_OPEN_TIME = datetime.timedelta(minutes=5)
+CIRCUIT_BREAKER_MAX_OPEN_TIME = datetime.timedelta(hours=6)
+CIRCUIT_BREAKER_PROBE_TIMEOUT = datetime.timedelta(minutes=2)
+
+# In-process LRU cache of WebmentionEndpoint entities, in front of the
+# datastore. OrderedDict that maps key id to (entity or None, time loaded),
+# least recently used first. Entries expire quickly since other instances may
+# update or invalidate them.
+_webmention_endpoints = collections.OrderedDict()
+_webmention_endpoints_lock = threading.Lock()
+WEBMENTION_ENDPOINT_LRU_SIZE = 2000
+WEBMENTION_ENDPOINT_LRU_TTL = datetime.timedelta(minutes=5)
+
+# per-thread requests.Session. see http_session().
+_http_sessions = threading.local()
+
+# tasks collected by batch_tasks(), per thread. queues is an OrderedDict that
+# maps queue name to list of taskqueue.Task, or None when we're not batching.
+_task_batches = threading.local()
+
+# the RequestStats that phase() and HTTP calls are recorded in, per thread, or
+# None. see collect_stats().
+_request_stats = threading.local()
+
 # Unpacked representation of logged in account in the logins cookie.
 Login = collections.namedtuple('Login', ('site', 'name', 'path'))
 
@@ -112,27 +189,74 @@ def add_poll_task(source, now=False, **kwargs):
   """
   last_polled_str = source.last_polled.strftime(POLL_TASK_DATETIME_FORMAT)
   queue = 'poll-now' if now else 'poll'
-  task = taskqueue.add(queue_name=queue,
-                       params={'source_key': source.key.urlsafe(),
-                               'last_polled': last_polled_str},
-                       **kwargs)
-  logging.info('Added %s task %s with args %s', queue, task.name, kwargs)
+  task = _add_task(queue, {'source_key': source.key.urlsafe(),
+                           'last_polled': last_polled_str},
+                   **kwargs)
+  if task:
+    logging.info('Added %s task %s with args %s', queue, task.name, kwargs)
+
+
+def poll_dispatch_marker(key):
+  """Returns the memcache key that cron.DispatchPolls uses to mark a source's
+  scheduled poll task as queued. :class:`tasks.Poll` deletes it when it's done.
+
+  Args:
+    key: :class:`ndb.Key` of a source
+  """
+  return 'P ' + key.urlsafe()
+
 
+def add_scheduled_poll_task(key, **kwargs):
+  """Adds a poll task for the given source key, for cron.DispatchPolls.
+
+  Unlike :func:`add_poll_task`, these tasks don't include last_polled. Poll
+  checks the source's next_poll_at instead.
+  """
+  task = _add_task('poll', {'source_key': key.urlsafe()}, **kwargs)
+  if task:
+    logging.info('Added scheduled poll task %s with args %s', task.name, kwargs)
 
-def add_propagate_task(entity, **kwargs):
-  """Adds a propagate task for the given response entity."""
-  task = taskqueue.add(queue_name='propagate',
-                       params={'response_key': entity.key.urlsafe()},
-                       **kwargs)
-  logging.info('Added propagate task: %s', task.name)
+
+def add_propagate_task(*entities, **kwargs):
+  """Adds a propagate task for the given response entity or entities.
+
+  They should all have the same source.
+  """
+  keys = [entity.key.urlsafe() for entity in entities]
+  params = {'response_key': keys if len(keys) > 1 else keys[0]}
+  task = _add_task(propagate_queue('propagate', entities[0].source), params,
+                   url='/_ah/queue/propagate', **kwargs)
+  if task:
+    logging.info('Added propagate task: %s', task.name)
 
 
 def add_propagate_blogpost_task(entity, **kwargs):
   """Adds a propagate-blogpost task for the given response entity."""
-  task = taskqueue.add(queue_name='propagate-blogpost',
-                       params={'key': entity.key.urlsafe()},
-                       **kwargs)
-  logging.info('Added propagate-blogpost task: %s', task.name)
+  task = _add_task(propagate_queue('propagate-blogpost', entity.source),
+                   {'key': entity.key.urlsafe()},
+                   url='/_ah/queue/propagate-blogpost', **kwargs)
+  if task:
+    logging.info('Added propagate-blogpost task: %s', task.name)
+
+
+def propagate_queue(name, source_key):
+  """Returns the shard of a propagate queue to use for a given source.
+
+  Shards are picked by a stable hash of the source key, so all of a source's
+  tasks go to the same shard. See PROPAGATE_QUEUE_SHARDS.
+
+  Args:
+    name: string base queue name, e.g. 'propagate'
+    source_key: :class:`ndb.Key`, or None
+
+  Returns:
+    string queue name
+  """
+  if not source_key or PROPAGATE_QUEUE_SHARDS <= 1:
+    return name
+  hash = zlib.crc32(source_key.urlsafe()) & 0xffffffff
+  shard = hash % PROPAGATE_QUEUE_SHARDS
+  return '%s-%d' % (name, shard) if shard else name
 
 def add_discover_task(source, post_id, type=None, **kwargs):
   """Adds a propagate-blogpost task for the given source and silo post id."""
@@ -143,9 +267,87 @@ def add_discover_task(source, post_id, type=None, **kwargs):
   if type:
     params['type'] = type
 
-  task = taskqueue.add(queue_name='discover', params=params)
-  logging.info('Added discover task for post %s for %s: %s', post_id,
-               source.label(), task.name)
+  task = _add_task('discover', params)
+  if task:
+    logging.info('Added discover task for post %s for %s: %s', post_id,
+                 source.label(), task.name)
+
+
+def add_discover_endpoint_task(url):
+  """Adds a discover-endpoint task to rediscover a URL's webmention endpoint.
+
+  Adds at most one task per URL path every
+  WEBMENTION_ENDPOINT_REDISCOVER_INTERVAL, tracked in memcache, so that pages
+  sharing a stale site-wide result are each rediscovered.
+
+  Args:
+    url: string target URL
+  """
+  _, path_id = WebmentionEndpoint._ids(url)
+  marker = 'E ' + hashlib.sha1(path_id.encode('utf-8')).hexdigest()
+  if not memcache.add(marker, '', time=int(
+      WEBMENTION_ENDPOINT_REDISCOVER_INTERVAL.total_seconds())):
+    return
+
+  task = _add_task('discover-endpoint', {'url': url})
+  if task:
+    logging.info('Added discover-endpoint task for %s: %s', url, task.name)
+
+
+def _add_task(queue_name, params, **kwargs):
+  """Adds a task, or collects it if we're inside :func:`batch_tasks()`.
+
+  Transactional tasks are always added immediately, since they have to be added
+  inside their transaction.
+
+  Args:
+    queue_name: string
+    params: dict, task parameters
+    kwargs: passed through to :class:`taskqueue.Task`
+
+  Returns:
+    the added :class:`taskqueue.Task`, or None if it was collected into a batch
+  """
+  batches = getattr(_task_batches, 'queues', None)
+  if batches is None or kwargs.get('transactional'):
+    return taskqueue.add(queue_name=queue_name, params=params, **kwargs)
+
+  batches.setdefault(queue_name, []).append(
+    taskqueue.Task(params=params, **kwargs))
+
+
+@contextlib.contextmanager
+def batch_tasks():
+  """Context manager that batches tasks added by the add_*_task() functions.
+
+  Collects non-transactional tasks added inside it, in this thread, and adds
+  them in batches of up to :const:`taskqueue.MAX_TASKS_PER_ADD` when it exits,
+  even if it exits due to an exception. Nested blocks are part of the outermost
+  block's batch.
+
+  Example::
+
+    with util.batch_tasks():
+      for source in sources:
+        util.add_poll_task(source)
+  """
+  if getattr(_task_batches, 'queues', None) is not None:
+    yield
+    return
+
+  _task_batches.queues = collections.OrderedDict()
+  try:
+    yield
+  finally:
+    batches = _task_batches.queues
+    _task_batches.queues = None
+    for queue_name, tasks in batches.items():
+      queue = taskqueue.Queue(queue_name)
+      for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        added = queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+        logging.info('Added %d %s tasks: %s', len(added), queue_name,
+                     ' '.join(task.name for task in added))
+
 
 def webmention_endpoint_cache_key(url):
   """Returns memcache key for a cached webmention endpoint for a given URL.
@@ -157,6 +359,69 @@ def webmention_endpoint_cache_key(url):
   return ' '.join(('W', scheme, domain))
 
 
+def receiver_blocked_for(domain):
+  """Checks a webmention receiver domain's circuit breaker.
+
+  If the breaker is half open and no other send is probing the domain, lets
+  this one through as the probe.
+
+  Args:
+    domain: string
+
+  Returns:
+    :class:`datetime.timedelta`, how long until we should try the domain again,
+    or None if we can send to it now
+  """
+  failures_key, open_key, probe_key = [
+    'CB%s %s' % (kind, domain) for kind in ('F', 'O', 'P')]
+  cached = memcache.get_multi((failures_key, open_key))
+  open_until = cached.get(open_key)
+  now = now_fn()
+  if open_until and now < open_until:
+    return open_until - now
+  elif cached.get(failures_key, 0) < CIRCUIT_BREAKER_THRESHOLD:
+    return None
+  elif memcache.add(probe_key, '',
+                    time=int(CIRCUIT_BREAKER_PROBE_TIMEOUT.total_seconds())):
+    logging.info('Circuit breaker for %s is half open, probing', domain)
+    return None
+  else:
+    return CIRCUIT_BREAKER_PROBE_TIMEOUT
+
+
+def record_receiver_result(domain, ok):
+  """Updates a webmention receiver domain's circuit breaker after a send.
+
+  Args:
+    domain: string
+    ok: boolean, False if the send failed in a way that's worth retrying, e.g.
+      a 5xx or a timeout, True otherwise
+  """
+  failures_key, trips_key, open_key, probe_key = [
+    'CB%s %s' % (kind, domain) for kind in ('F', 'T', 'O', 'P')]
+  if ok:
+    memcache.delete_multi((failures_key, trips_key, open_key, probe_key))
+    return
+
+  failures = memcache.incr(failures_key, initial_value=0)
+  if failures < CIRCUIT_BREAKER_THRESHOLD:
+    return
+
+  now = now_fn()
+  open_until = memcache.get(open_key)
+  if open_until and now < open_until:
+    return  # already open
+
+  trips = memcache.incr(trips_key, initial_value=0)
+  open_time = min(CIRCUIT_BREAKER_OPEN_TIME * 2 ** min(trips - 1, 10),
+                  CIRCUIT_BREAKER_MAX_OPEN_TIME)
+  logging.warning('Opening circuit breaker for %s for %s after %s failures',
+                  domain, open_time, failures)
+  memcache.set(open_key, now + open_time,
+               time=int(CIRCUIT_BREAKER_MAX_OPEN_TIME.total_seconds()))
+  memcache.delete(probe_key)
+
+
 def email_me(**kwargs):
   """Thin wrapper around :func:`mail.send_mail()` that handles errors."""
   try:
@@ -166,7 +431,52 @@ def email_me(**kwargs):
     logging.warning('Error sending notification email', exc_info=True)
 
 
-def requests_get(url, **kwargs):
+def http_session():
+  """Returns this thread's :class:`requests.Session`, creating it if needed.
+
+  :class:`requests.Session` isn't thread safe, so each thread gets its own,
+  e.g. each :func:`map_in_parallel()` worker. It sends through urlfetch with
+  requests_toolbelt's App Engine adapter, like the monkeypatched requests
+  module does, and uses our user agent by default. It doesn't store cookies,
+  since it's shared across requests to all sites.
+
+  urlfetch makes each request itself, so this doesn't pool connections or keep
+  them alive. It only shares headers and configuration across requests.
+
+  Pass it to :func:`requests_get()` and :func:`requests_post()`.
+  :func:`follow_redirects()` and webmentiontools can't take a session, so they
+  use the requests module directly, which also goes through urlfetch.
+
+  Returns:
+    :class:`requests.Session`, or None if :const:`USE_HTTP_SESSION` is False
+  """
+  if not USE_HTTP_SESSION:
+    return None
+
+  session = getattr(_http_sessions, 'session', None)
+  if session is None:
+    session = requests.Session()
+    adapter = appengine.AppEngineAdapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update(REQUEST_HEADERS)
+    session.cookies.set_policy(cookielib.DefaultCookiePolicy(allowed_domains=[]))
+    _http_sessions.session = session
+  return session
+
+
+def _session_request(session, method, url, **kwargs):
+  """Sends an HTTP request with a :class:`requests.Session`.
+
+  Logs and sets the default timeout like :mod:`oauth_dropins.webutil.util`'s
+  requests_* functions do.
+  """
+  logging.info('requests.%s %s %s', method, url, util._prune(kwargs))
+  kwargs.setdefault('timeout', HTTP_TIMEOUT)
+  return session.request(method.upper(), url, **kwargs)
+
+
+def requests_get(url, session=None, **kwargs):
   """Wraps :func:`requests.get` with extra semantics and our user agent.
 
   If a server tells us a response will be too big (based on Content-Length), we
@@ -176,6 +486,12 @@ def requests_get(url, **kwargs):
   :attr:`requests.Response.text`).
 
   http://docs.python-requests.org/en/latest/user/advanced/#body-content-workflow
+
+  Args:
+    url: string
+    session: optional :class:`requests.Session`, usually from
+      :func:`http_session()`. Uses the requests module if not provided.
+    kwargs: passed through to :func:`requests.get`
   """
   if url in URL_BLACKLIST:
     resp = requests.Response()
@@ -184,7 +500,10 @@ def requests_get(url, **kwargs):
     return resp
 
   kwargs.setdefault('headers', {}).update(request_headers(url=url))
-  resp = util.requests_get(url, stream=True, **kwargs)
+  if session:
+    resp = _session_request(session, 'get', url, stream=True, **kwargs)
+  else:
+    resp = util.requests_get(url, stream=True, **kwargs)
 
   length = resp.headers.get('Content-Length', 0)
   if util.is_int(length) and int(length) > MAX_HTTP_RESPONSE_SIZE:
@@ -195,9 +514,18 @@ def requests_get(url, **kwargs):
   return resp
 
 
-def requests_post(url, **kwargs):
-  """Wraps :func:`requests.get` with our user agent."""
+def requests_post(url, session=None, **kwargs):
+  """Wraps :func:`requests.post` with our user agent.
+
+  Args:
+    url: string
+    session: optional :class:`requests.Session`, usually from
+      :func:`http_session()`. Uses the requests module if not provided.
+    kwargs: passed through to :func:`requests.post`
+  """
   kwargs.setdefault('headers', {}).update(request_headers(url=url))
+  if session:
+    return _session_request(session, 'post', url, **kwargs)
   return util.requests_post(url, **kwargs)
 
 
@@ -312,6 +640,29 @@ def prune_response(response):
   return trim_nulls({k: v for k, v in response.items() if k not in drop})
 
 
+def response_fingerprint(response):
+  """Returns a short, stable hash of a response's meaningful content.
+
+  Only covers :const:`ACTIVITY_CHANGED_FIELDS`, so two responses have the same
+  fingerprint if and only if :meth:`granary.source.Source.activity_changed()`
+  says they're the same, modulo hash collisions. Like it, treats all empty
+  values as equivalent.
+
+  Args:
+    response: ActivityStreams response object
+
+  Returns:
+    string
+  """
+  obj = response.get('object')
+  if not isinstance(obj, dict):
+    obj = {}
+
+  fields = [{f: o[f] for f in ACTIVITY_CHANGED_FIELDS if o.get(f)}
+            for o in (response, obj)]
+  return hashlib.sha1(json.dumps(fields, sort_keys=True)).hexdigest()[:16]
+
+
 def replace_test_domains_with_localhost(url):
   """Replace domains in LOCALHOST_TEST_DOMAINS with localhost for local
   testing when in DEBUG mode.
@@ -594,6 +945,145 @@ class CachedPage(StringIdModel):
     CachedPage(id=path).key.delete()
 
 
+class WebmentionEndpoint(StringIdModel):
+  """A cached webmention endpoint discovery result.
+
+  Key id is :func:`webmention_endpoint_cache_key()` for a site-wide result. A
+  page that declares a different endpoint than the rest of its site gets its
+  own result, with its URL path appended to the key id after a space.
+
+  Loaded through an in-process LRU cache in front of the datastore, which ndb
+  also caches in memcache.
+  """
+  endpoint = ndb.StringProperty(indexed=False)
+  # WebmentionSend error dict if discovery failed (semi-)permanently, e.g.
+  # NO_ENDPOINT
+  error = ndb.JsonProperty()
+  # the URL this was discovered on
+  url = ndb.StringProperty(indexed=False)
+  discovered = ndb.DateTimeProperty()
+
+  @property
+  def value(self):
+    """The error dict if discovery failed, otherwise the endpoint URL."""
+    return self.error or self.endpoint
+
+  def is_fresh(self):
+    return now_fn() - self.discovered < WEBMENTION_ENDPOINT_FRESH
+
+  @staticmethod
+  def _ids(url):
+    """Returns (site id, path id) for a URL."""
+    site_id = webmention_endpoint_cache_key(url)
+    return site_id, '%s %s' % (site_id, urlparse.urlparse(url).path or '/')
+
+  @classmethod
+  def _get_multi(cls, ids):
+    """Returns a dict mapping key id to entity or None. Uses the LRU cache."""
+    now = now_fn()
+    found = {}
+    with _webmention_endpoints_lock:
+      for id in ids:
+        cached = _webmention_endpoints.pop(id, None)
+        if cached and now - cached[1] < WEBMENTION_ENDPOINT_LRU_TTL:
+          _webmention_endpoints[id] = cached
+          found[id] = cached[0]
+
+    missing = [id for id in ids if id not in found]
+    if missing:
+      entities = ndb.get_multi(ndb.Key(cls, id) for id in missing)
+      for id, entity in zip(missing, entities):
+        found[id] = entity
+        cls._cache(id, entity)
+
+    return {id: entity if (entity and
+                           now - entity.discovered < WEBMENTION_ENDPOINT_MAX_AGE)
+                       else None
+            for id, entity in found.items()}
+
+  @staticmethod
+  def _cache(id, entity):
+    with _webmention_endpoints_lock:
+      _webmention_endpoints.pop(id, None)
+      _webmention_endpoints[id] = (entity, now_fn())
+      while len(_webmention_endpoints) > WEBMENTION_ENDPOINT_LRU_SIZE:
+        _webmention_endpoints.popitem(last=False)
+
+  @classmethod
+  def load(cls, url):
+    """Returns the cached result for a URL, or None.
+
+    Prefers a result for the URL's own path over its site-wide result. May be
+    stale; check :meth:`is_fresh()`.
+
+    Args:
+      url: string target URL
+    """
+    return cls.load_multi((url,))[url]
+
+  @classmethod
+  def load_multi(cls, urls):
+    """Returns the cached results for multiple URLs, with one datastore batch.
+
+    Same as :meth:`load()` for each URL.
+
+    Args:
+      urls: sequence of string target URLs
+
+    Returns:
+      dict mapping each URL to its :class:`WebmentionEndpoint` or None
+    """
+    ids = {url: cls._ids(url) for url in urls}
+    found = cls._get_multi(set(itertools.chain(*ids.values())))
+    return {url: found[path_id] or found[site_id]
+            for url, (site_id, path_id) in ids.items()}
+
+  @classmethod
+  def store(cls, url, endpoint=None, error=None):
+    """Stores a new discovery result for a URL.
+
+    Stored site-wide unless the site already has a different, fresh result
+    that was discovered on another page, in which case it's stored for just
+    this URL's path. A stale site-wide result is refreshed, so that
+    rediscovery on any page updates it for the whole site.
+
+    Args:
+      url: string target URL
+      endpoint: string endpoint URL
+      error: WebmentionSend error dict
+    """
+    site_id, path_id = cls._ids(url)
+    site = cls._get_multi((site_id,))[site_id]
+    if (site and site.is_fresh() and site.url != url and
+        site.value != (error or endpoint)):
+      id = path_id
+    else:
+      id = site_id
+      if site and site.url != url:
+        # this page matches its site again, so drop its own result, if any
+        ndb.Key(cls, path_id).delete()
+        cls._cache(path_id, None)
+
+    logging.info('Storing webmention endpoint for %s: %s', id, error or endpoint)
+    entity = cls(id=id, endpoint=endpoint, error=error, url=url,
+                 discovered=now_fn())
+    entity.put()
+    cls._cache(id, entity)
+
+  @classmethod
+  def invalidate(cls, urls):
+    """Deletes the cached results for the given URLs, site-wide and per path.
+
+    Args:
+      urls: sequence of string URLs
+    """
+    ids = set(itertools.chain(*(cls._ids(url) for url in urls)))
+    ndb.delete_multi(ndb.Key(cls, id) for id in ids)
+    with _webmention_endpoints_lock:
+      for id in ids:
+        _webmention_endpoints.pop(id, None)
+
+
 def unwrap_t_umblr_com(url):
   """If url is a t.umblr.com short link, extract its destination URL.
 
@@ -644,3 +1134,169 @@ def mf2py_parse(input, url):
   # instrumenting, disabled for now:
   # with cache_time('mf2py', 1):
   return mf2py.parse(url=url, doc=input)
+
+
+class RequestStats(object):
+  """Per-phase timings and HTTP call stats for a single request or task.
+
+  Thread safe, so that threads started by :func:`map_in_parallel` can record
+  into their caller's stats.
+
+  Attributes:
+    phases: dict mapping phase name to total milliseconds spent in it
+    http_calls: integer, number of HTTP requests made
+    http_bytes: integer, total size of HTTP response bodies
+  """
+  def __init__(self):
+    self.phases = collections.defaultdict(int)
+    self.http_calls = 0
+    self.http_bytes = 0
+    self._lock = threading.Lock()
+
+  def add_phase(self, name, ms):
+    with self._lock:
+      self.phases[name] += ms
+
+  def add_http(self, bytes):
+    with self._lock:
+      self.http_calls += 1
+      self.http_bytes += bytes
+
+  def to_dict(self):
+    with self._lock:
+      return {
+        'phases': dict(self.phases),
+        'http_calls': self.http_calls,
+        'http_bytes': self.http_bytes,
+      }
+
+
+@contextlib.contextmanager
+def collect_stats():
+  """Context manager that records phases and HTTP calls in a new RequestStats.
+
+  Applies to :func:`phase()` blocks and HTTP calls in this thread, and in
+  threads started by :func:`map_in_parallel`, inside it.
+
+  Example::
+
+    with util.collect_stats() as stats:
+      with util.phase('fetch'):
+        ...
+    logging.info('HTTP calls: %s', stats.http_calls)
+  """
+  outer = getattr(_request_stats, 'current', None)
+  _request_stats.current = stats = RequestStats()
+  try:
+    yield stats
+  finally:
+    _request_stats.current = outer
+
+
+@contextlib.contextmanager
+def phase(name):
+  """Times a block of code as a named phase of the current RequestStats.
+
+  Wall clock time, not CPU time, since most phases are dominated by I/O. A
+  no-op outside :func:`collect_stats()`.
+  """
+  stats = getattr(_request_stats, 'current', None)
+  start = time.time()
+  try:
+    yield
+  finally:
+    if stats:
+      stats.add_phase(name, int((time.time() - start) * 1000))
+
+
+def _record_urlfetch(service, call, request, response):
+  """API proxy post-call hook that records URL fetches in the current stats.
+
+  requests and urllib2 both use urlfetch under the hood on App Engine.
+  """
+  stats = getattr(_request_stats, 'current', None)
+  if stats and call == 'Fetch':
+    stats.add_http(len(response.content()))
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+  'request_stats', _record_urlfetch, 'urlfetch')
+
+
+def map_in_parallel(fn, args, max_threads=None, key=None, max_per_key=None):
+  """Calls fn on each element of args in a bounded pool of threads.
+
+  Results are returned in the same order as args. If any calls raise, waits for
+  the rest to finish, then reraises the first exception in args order.
+
+  If key and max_per_key are provided, at most max_per_key calls with the same
+  key run at once, e.g. to limit concurrent requests to a single host. Pending
+  args for other keys skip ahead of them instead of waiting.
+
+  Runs serially in the calling thread if max_threads or len(args) is 1. Calls in
+  other threads record phases and HTTP calls in the caller's
+  :func:`collect_stats()` stats, if any.
+
+  Args:
+    fn: callable that takes a single argument
+    args: sequence of arguments
+    max_threads: integer, defaults to MAX_FETCH_THREADS
+    key: callable that takes an argument and returns its group, or None
+    max_per_key: integer, max number of concurrent calls per group
+
+  Returns:
+    list of fn return values
+  """
+  args = list(args)
+  if max_threads is None:
+    max_threads = MAX_FETCH_THREADS
+  num_threads = min(max_threads, len(args))
+  if num_threads <= 1:
+    return [fn(arg) for arg in args]
+
+  keys = [key(arg) if key else None for arg in args]
+  stats = getattr(_request_stats, 'current', None)
+  pending = collections.deque(xrange(len(args)))
+  running = collections.defaultdict(int)
+  results = [None] * len(args)
+  errors = [None] * len(args)
+  cond = threading.Condition()
+
+  def runnable(i):
+    return (not max_per_key or keys[i] is None or
+            running[keys[i]] < max_per_key)
+
+  def worker():
+    _request_stats.current = stats
+    while True:
+      with cond:
+        i = None
+        while pending:
+          i = next((i for i in pending if runnable(i)), None)
+          if i is not None:
+            break
+          cond.wait()
+        if i is None:
+          return
+        pending.remove(i)
+        running[keys[i]] += 1
+
+      try:
+        results[i] = fn(args[i])
+      except BaseException:
+        errors[i] = sys.exc_info()
+      finally:
+        with cond:
+          running[keys[i]] -= 1
+          cond.notify_all()
+
+  threads = [threading.Thread(target=worker) for _ in xrange(num_threads)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  for error in errors:
+    if error:
+      raise error[0], error[1], error[2]
+
+  return results
@@ -58,7 +58,7 @@ class WebmentionHandler(WebmentionGetHandler):
       (:class:`requests.Response`, mf2 data dict) on success, None on failure
     """
     try:
-      fetched = util.requests_get(url)
+      fetched = util.requests_get(url, session=util.http_session())
       fetched.raise_for_status()
     except BaseException as e:
       util.interpret_http_exception(e)  # log exception